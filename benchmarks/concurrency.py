@@ -0,0 +1,142 @@
+"""
+Compare the API reads while the crawler writes, with the previous engine (default pool, rollback journal, one
+engine for everything) and with the engines of db.engine (WAL, read-only reader pool, one writer connection).
+
+    $ python -m benchmarks.concurrency --rows 100000 --readers 16 --seconds 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from db.engine import create_sqlite_engine
+from db.facets import create_facet_tables
+from db.geo import create_geo_index
+from db.models import Specimen
+from db.search import create_search_index
+from specimen.dal import SpecimenDal
+from specimen.writer import SpecimenWriter
+
+
+def synthetic_specimen(i):
+    return {
+        'identifier': f'sinica-{i}',
+        'species_name': f'species {random.randint(0, 9999)}',
+        'scientific_name': f'Genus{random.randint(0, 999)} species{random.randint(0, 9999)}',
+        'collector': f'collector {random.randint(0, 499)}',
+        'country': random.choice(['Taiwan', 'Japan', 'Philippines']),
+        'area': f'area {random.randint(0, 199)}',
+        'latitude': random.uniform(21.9, 25.3),
+        'longitude': random.uniform(120.0, 122.0),
+    }
+
+
+def create_database(path, rows):
+    engine = create_engine(f'sqlite:///{path}')
+    SQLModel.metadata.create_all(engine, tables=[Specimen.__table__])
+    with engine.begin() as conn:
+        for create in (create_search_index, create_geo_index, create_facet_tables):
+            create(conn)
+        for start in range(0, rows, 10000):
+            conn.execute(Specimen.__table__.insert(), [
+                synthetic_specimen(i) for i in range(start, min(start + 10000, rows))
+            ])
+    engine.dispose()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else None
+
+
+async def read_loop(read_db_session, rows, deadline, latencies, errors):
+    """Requests of the API, a detail or a page of the list, each with its own session"""
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            async with read_db_session() as session:
+                if random.random() < 0.5:
+                    await SpecimenDal(session).get(random.randint(1, rows))
+                else:
+                    await SpecimenDal(session).page(limit=20, offset=random.randint(0, rows - 20))
+        except OperationalError:
+            errors['read'] += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def write_loop(async_db_session, rows, deadline, errors):
+    """The crawler updating existing specimens through the batched writer"""
+    async with SpecimenWriter(async_db_session, flush_interval=0.2) as writer:
+        while time.monotonic() < deadline:
+            await writer.upsert(synthetic_specimen(random.randint(0, rows - 1)))
+    errors['write'] = writer.errors
+    return writer.rows
+
+
+async def measure(name, path, rows, readers, seconds):
+    if name == 'legacy':
+        async_engine = create_async_engine(url=f'sqlite+aiosqlite:///{path}', echo=False)
+        read_engine = async_engine
+    else:
+        async_engine = create_sqlite_engine(path)
+        read_engine = create_sqlite_engine(path, read_only=True)
+    async_db_session = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+    read_db_session = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+    # Switch the database to WAL before the readers open it
+    async with async_engine.connect():
+        pass
+
+    latencies = []
+    errors = {'read': 0, 'write': 0}
+    deadline = time.monotonic() + seconds
+    written, *_ = await asyncio.gather(
+        write_loop(async_db_session, rows, deadline, errors),
+        *[read_loop(read_db_session, rows, deadline, latencies, errors) for _ in range(readers)],
+    )
+
+    await async_engine.dispose()
+    await read_engine.dispose()
+
+    return {
+        'name': name,
+        'reads': len(latencies),
+        'reads_per_second': len(latencies) / seconds,
+        'read_p50_ms': percentile(latencies, 0.5),
+        'read_p99_ms': percentile(latencies, 0.99),
+        'written_rows': written,
+        'write_rows_per_second': written / seconds,
+        'lock_errors': errors,
+    }
+
+
+async def main(rows, readers, seconds, seed):
+    results = []
+    for name in ('legacy', 'tuned'):
+        random.seed(seed)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.db')
+            create_database(path, rows)
+            results.append(await measure(name, path, rows, readers, seconds))
+    print(json.dumps({'rows': rows, 'readers': readers, 'seconds': seconds, 'scenarios': results}, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the API reads during the crawler writes')
+    parser.add_argument('--rows', type=int, default=50000, help='Number of synthetic specimens')
+    parser.add_argument('--readers', type=int, default=16, help='Number of concurrent readers')
+    parser.add_argument('--seconds', type=float, default=10.0, help='Duration of each scenario')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows, args.readers, args.seconds, args.seed))
@@ -0,0 +1,100 @@
+"""
+Check the single-pass parser against the BeautifulSoup parsers on every page in example_html, then compare the
+parse throughput of both, in one process and in a process pool.
+
+    $ python -m benchmarks.parser --rounds 5 --workers 4
+
+Exits with status 1 when the parsers disagree on any page.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from specimen.crawl_utils import parse_specimen_from_sinica, parse_specimen_from_sinica_v2
+from specimen.parser import ParseError, parse_specimen
+
+
+def load_example_pages():
+    pages = {}
+    for filename in sorted(os.listdir('example_html')):
+        with open(os.path.join('example_html', filename)) as f:
+            pages[filename] = f.read()
+    return pages
+
+
+def parse_with_soup(html):
+    """The fallback chain of crawl_specimens before the single-pass parser"""
+    for parse_function in [parse_specimen_from_sinica, parse_specimen_from_sinica_v2]:
+        try:
+            return parse_function(html)
+        except Exception:
+            continue
+    return None
+
+
+def parse_single_pass(html):
+    try:
+        return parse_specimen(html)
+    except ParseError:
+        return None
+
+
+def check_golden(pages):
+    mismatches = []
+    for filename, html in pages.items():
+        expected, actual = parse_with_soup(html), parse_single_pass(html)
+        if expected != actual:
+            mismatches.append({'file': filename, 'expected': expected, 'actual': actual})
+    return mismatches
+
+
+def measure(name, parse, documents, workers=0):
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            # Start the workers before the clock, the crawler keeps its pool for the whole run
+            list(pool.map(parse, documents[:workers]))
+            start = time.perf_counter()
+            list(pool.map(parse, documents, chunksize=16))
+            elapsed = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        for html in documents:
+            parse(html)
+        elapsed = time.perf_counter() - start
+
+    return {
+        'name': name, 'workers': workers, 'documents': len(documents), 'seconds': elapsed,
+        'documents_per_second': len(documents) / elapsed,
+    }
+
+
+def main(rounds, workers):
+    pages = load_example_pages()
+    mismatches = check_golden(pages)
+
+    documents = list(pages.values()) * rounds
+    results = {
+        'golden': {'pages': len(pages), 'mismatches': mismatches},
+        # A pool is only faster than the in-process parser with spare cores
+        'cpus': os.cpu_count(),
+        'throughput': [
+            measure('soup', parse_with_soup, documents),
+            measure('single_pass', parse_single_pass, documents),
+        ] + ([measure('single_pass', parse_single_pass, documents, workers=workers)] if workers else []),
+    }
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check and benchmark the specimen html parser')
+    parser.add_argument('--rounds', type=int, default=5, help='Number of passes over example_html')
+    parser.add_argument('--workers', type=int, default=4, help='Number of processes of the pool run, 0 to skip it')
+    args = parser.parse_args()
+
+    sys.exit(main(args.rounds, args.workers))
@@ -0,0 +1,89 @@
+"""
+Compare the full-text search index with the LIKE scan it replaces.
+
+    $ python -m benchmarks.search --rows 200000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlmodel import SQLModel
+
+from db.models import Specimen
+from db.search import SEARCH_FIELDS, build_match_query, create_search_index
+
+
+CJK_CHARACTERS = '山香圓葉草奴屬臺灣蘭花木竹松杉柏櫻桃李梅菊蓮荷楓樟榕茶藤蕨苔'
+
+
+def random_name(length):
+    return ''.join(random.choice(CJK_CHARACTERS) for _ in range(length))
+
+
+def create_database(path, rows):
+    engine = create_engine(f'sqlite:///{path}')
+    SQLModel.metadata.create_all(engine, tables=[Specimen.__table__])
+    with engine.begin() as conn:
+        create_search_index(conn)
+        conn.execute(Specimen.__table__.insert(), [
+            {
+                'identifier': f'sinica-{i}',
+                'species_name': random_name(random.randint(2, 6)),
+                'scientific_name': f'Genus{random.randint(0, 999)} species{random.randint(0, 9999)}',
+                'collector': random_name(3),
+                'area': random_name(4),
+            } for i in range(rows)
+        ])
+    return engine
+
+
+def measure(conn, sql, params, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rows = conn.exec_driver_sql(sql, params).fetchall()
+    return (time.perf_counter() - start) / repeat * 1000, len(rows)
+
+
+def main(rows, queries, repeat, seed):
+    random.seed(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_database(os.path.join(directory, 'bench.db'), rows)
+
+        like_sql = 'SELECT id FROM specimens WHERE {} ORDER BY id LIMIT 20'.format(
+            ' OR '.join(f'{field} LIKE ?' for field in SEARCH_FIELDS)
+        )
+        fts_sql = (
+            'SELECT specimens.id FROM specimens_fts JOIN specimens ON specimens.id = specimens_fts.rowid '
+            'WHERE specimens_fts MATCH ? ORDER BY bm25(specimens_fts) LIMIT 20'
+        )
+
+        results = []
+        with engine.connect() as conn:
+            for _ in range(queries):
+                term = random_name(3)
+                like_ms, _ = measure(conn, like_sql, tuple([f'%{term}%'] * len(SEARCH_FIELDS)), repeat)
+                fts_ms, matched = measure(conn, fts_sql, (build_match_query(term),), repeat)
+                results.append({'term': term, 'like_ms': like_ms, 'fts_ms': fts_ms, 'matched': matched})
+        engine.dispose()
+
+    print(json.dumps({
+        'rows': rows,
+        'like_ms_avg': sum(result['like_ms'] for result in results) / len(results),
+        'fts_ms_avg': sum(result['fts_ms'] for result in results) / len(results),
+        'queries': results,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the full-text search against LIKE')
+    parser.add_argument('--rows', type=int, default=100000, help='Number of synthetic specimens')
+    parser.add_argument('--queries', type=int, default=10, help='Number of random queries')
+    parser.add_argument('--repeat', type=int, default=5, help='Repeat of each query')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    main(args.rows, args.queries, args.repeat, args.seed)
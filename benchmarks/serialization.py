@@ -0,0 +1,126 @@
+"""
+Compare the list responses of every field validated by the response model, as GET /specimens/ did before, with
+the rows serialized straight from the selected columns, with every field and with a sparse fieldset.
+
+    $ python -m benchmarks.serialization --rows 100000
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+from typing import List
+
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from db.engine import create_sqlite_engine
+from db.models import Specimen
+from specimen.dal import SpecimenDal
+from specimen.schemas import SPECIMEN_FIELDS, SpecimenPublic
+from specimen.serializers import dumps, orjson
+
+# The fields must include id for the cursor
+SPARSE_FIELDS = ['species_name', 'scientific_name', 'collection_date', 'id']
+
+
+def create_database(path, rows):
+    engine = create_engine(f'sqlite:///{path}')
+    SQLModel.metadata.create_all(engine, tables=[Specimen.__table__])
+    with engine.begin() as conn:
+        for start in range(0, rows, 10000):
+            conn.execute(Specimen.__table__.insert(), [
+                {
+                    'identifier': f'sinica-{i}',
+                    'species_name': f'物種{random.randint(0, 9999)}',
+                    'scientific_name': f'Genus{random.randint(0, 999)} species{random.randint(0, 9999)}',
+                    'collection_number': str(random.randint(0, 999999)),
+                    'catalog_number': f'Collector {random.randint(0, 9999)}',
+                    'reference': '作者不詳（2007-03-14）。[中文種名:物種] 國立臺灣大學植物標本館數位典藏。' * 4,
+                    'collection_date': datetime.date(random.randint(1900, 2020), random.randint(1, 12), 1),
+                    'collector': f'collector {random.randint(0, 499)}',
+                    'latitude': random.uniform(21.9, 25.3),
+                    'longitude': random.uniform(120.0, 122.0),
+                    'country': 'Taiwan',
+                    'area': f'area {random.randint(0, 199)}',
+                    'minimum_altitude': random.uniform(0, 3000),
+                    'image_url': f'https://sinica.digitalarchives.tw/images/{i}.jpg',
+                } for i in range(start, min(start + 10000, rows))
+            ])
+    engine.dispose()
+
+
+async def validated_page(dal, cursor, limit):
+    """The response model path, validate the specimens then encode them with the default JSON encoder"""
+    adapter = TypeAdapter(List[SpecimenPublic])
+    specimens, next_cursor = await dal.page(cursor=cursor, limit=limit)
+    content = adapter.dump_python(adapter.validate_python(specimens, from_attributes=True), mode='json')
+    body = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return len(specimens), body, next_cursor
+
+
+def projected_page(fields):
+    async def page(dal, cursor, limit):
+        rows, next_cursor = await dal.page(cursor=cursor, limit=limit, columns=fields)
+        return len(rows), dumps([dict(zip(fields, row)) for row in rows]), next_cursor
+    return page
+
+
+async def measure(name, read_engine, page, limit):
+    rows = 0
+    payload = 0
+    cursor = None
+    start = time.perf_counter()
+    async with AsyncSession(read_engine) as session:
+        dal = SpecimenDal(session)
+        while True:
+            count, body, cursor = await page(dal, cursor, limit)
+            session.expunge_all()
+            rows += count
+            payload += len(body)
+            if cursor is None:
+                break
+    elapsed = time.perf_counter() - start
+
+    return {
+        'name': name,
+        'limit': limit,
+        'rows': rows,
+        'rows_per_second': rows / elapsed,
+        'bytes_per_row': payload / rows,
+    }
+
+
+async def main(rows, seed):
+    random.seed(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        create_database(path, rows)
+        read_engine = create_sqlite_engine(path, read_only=True)
+
+        results = [
+            await measure('validated', read_engine, validated_page, 100),
+            await measure('projected', read_engine, projected_page(list(SPECIMEN_FIELDS)), 100),
+            await measure('projected', read_engine, projected_page(list(SPECIMEN_FIELDS)), 1000),
+            await measure('sparse', read_engine, projected_page(SPARSE_FIELDS), 1000),
+        ]
+        await read_engine.dispose()
+
+    print(json.dumps({
+        'rows': rows, 'encoder': 'orjson' if orjson is not None else 'json', 'sparse_fields': SPARSE_FIELDS,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the serialization of the specimen list')
+    parser.add_argument('--rows', type=int, default=50000, help='Number of synthetic specimens')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows, args.seed))
@@ -0,0 +1,140 @@
+"""
+Local stand-in of the sinica website serving example_page and example_html, with injected latency and errors.
+
+List pages past the example pages repeat them with shifted ids, so any number of pages can be crawled. A
+specimen page of a shifted id is the example page of the original id, with the shifted id in its url.
+
+    $ python -m benchmarks.sinica_stub --port 8765 --latency 0.05 --error-rate 0.01
+    $ SINICA_BASE_URL=http://127.0.0.1:8765 PAGE_ARCHIVE_ENABLED=false python crawl.py --end-page 30 --rate 0
+"""
+import argparse
+import asyncio
+import collections
+import io
+import json
+import os
+import random
+
+from aiohttp import web
+from PIL import Image
+
+# Ids of the repeated list pages are shifted by a multiple of ID_SHIFT
+ID_SHIFT = 10 ** 8
+
+
+def load_fixtures():
+    pages = []
+    for filename in sorted(os.listdir('example_page'), key=lambda name: int(name.split('-')[1].split('.')[0])):
+        with open(os.path.join('example_page', filename)) as f:
+            pages.append(json.load(f))
+
+    specimens = {}
+    for filename in os.listdir('example_html'):
+        with open(os.path.join('example_html', filename), 'rb') as f:
+            specimens[int(filename.split('.')[0])] = f.read()
+
+    image = io.BytesIO()
+    Image.new('RGB', (800, 600), (120, 140, 100)).save(image, format='JPEG', quality=85)
+
+    return pages, specimens, image.getvalue()
+
+
+def create_stub_app(
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    image_latency: float | None = None,
+) -> web.Application:
+    """
+    Params:
+        latency: the mean delay of the responses in seconds.
+        jitter: the delay is uniformly distributed in latency +- jitter.
+        error_rate: the probability of a `503 Service Unavailable` response.
+        image_latency: the mean delay of the image responses, `latency` by default.
+    """
+    pages, specimens, image = load_fixtures()
+    stats = collections.Counter()
+
+    @web.middleware
+    async def inject(request, handler):
+        stats['requests'] += 1
+        mean = image_latency if image_latency is not None and request.path.startswith('/images/') else latency
+        delay = max(0.0, mean + random.uniform(-jitter, jitter))
+        if delay:
+            await asyncio.sleep(delay)
+        if random.random() < error_rate:
+            stats['errors'] += 1
+            raise web.HTTPServiceUnavailable()
+        return await handler(request)
+
+    async def collection(request):
+        response = web.Response(text='<html></html>', content_type='text/html')
+        response.set_cookie('PHPSESSID', 'stub')
+        return response
+
+    async def collection_list(request):
+        page = int((await request.post()).get('page', 1))
+        source = pages[(page - 1) % len(pages)]
+        shift = (page - 1) // len(pages) * ID_SHIFT
+        stats['list'] += 1
+        return web.json_response(
+            source | {'list': [item | {'id': str(int(item['id']) + shift)} for item in source['list']]},
+        )
+
+    async def specimen(request):
+        sinica_id = int(request.match_info['id'])
+        html = specimens.get(sinica_id % ID_SHIFT)
+        if html is None:
+            raise web.HTTPNotFound()
+        if sinica_id >= ID_SHIFT:
+            # The parser takes the identifier from the url of the page
+            html = html.replace(
+                f'collection_{sinica_id % ID_SHIFT}.html'.encode(), f'collection_{sinica_id}.html'.encode(),
+            )
+        stats['detail'] += 1
+        return web.Response(body=html, content_type='text/html', charset='utf-8')
+
+    async def specimen_image(request):
+        stats['image'] += 1
+        return web.Response(body=image, content_type='image/jpeg')
+
+    async def stub_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application(middlewares=[inject])
+    app.add_routes([
+        web.get('/collection.php', collection),
+        web.post('/_partial/_collection_list.php', collection_list),
+        web.get(r'/collection_{id:\d+}.html', specimen),
+        web.get(r'/images/{name}', specimen_image),
+        web.get('/_stats', stub_stats),
+    ])
+    return app
+
+
+async def start_stub(host: str = '127.0.0.1', port: int = 0, **options) -> tuple[web.AppRunner, str]:
+    """Start the stub in the running loop, returns the runner to clean up and the base url"""
+    runner = web.AppRunner(create_stub_app(**options), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://{host}:{port}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the example sinica pages')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean response delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Maximum deviation of the delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of a 503 response')
+    parser.add_argument('--image-latency', type=float, default=None, help='Mean image delay, default is --latency')
+    args = parser.parse_args()
+
+    web.run_app(
+        create_stub_app(args.latency, args.jitter, args.error_rate, args.image_latency),
+        host=args.host,
+        port=args.port,
+        access_log=None,
+    )
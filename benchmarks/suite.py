@@ -0,0 +1,387 @@
+"""
+Performance benchmarks of the whole app, emitted as one JSON document so the results of two commits can be
+compared:
+
+- parser: specimen pages parsed per second by the single-pass parser.
+- writer: rows per second written by the batched SpecimenWriter.
+- crawler: pages per second of crawl.py, end to end against the local sinica stub (benchmarks/sinica_stub.py).
+- api: p50/p99 latencies of the list, detail, search and PDF routes under concurrent requests, on a synthetic
+  database. The app is served by uvicorn in a separate process.
+- mixed: latencies of the list, detail and search routes alone, then while PDFs and ZIPs of specimens with slow
+  images are downloaded, on the same database. It fails, and the suite exits with 1, when the loaded p99 of a
+  route is more than --max-p99-ratio times its idle p99.
+
+    $ python -m benchmarks.suite --output bench.json
+    $ python -m benchmarks.suite --section api --api-rows 500000 --api-concurrency 32
+    $ python -m benchmarks.suite --section mixed --image-latency 4 --heavy-clients 20
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import aiohttp
+from sqlalchemy import create_engine
+from sqlmodel import SQLModel
+
+from benchmarks import parser as parser_benchmark
+from benchmarks import writer as writer_benchmark
+from benchmarks.concurrency import percentile
+from benchmarks.sinica_stub import start_stub
+from db.facets import create_facet_tables
+from db.geo import create_geo_index
+from db.models import Specimen
+from db.search import create_search_index
+from db.version import create_data_version
+from specimen.dal import encode_cursor
+from specimen.utils import PDF_FONT_FILE
+
+SECTIONS = ('parser', 'writer', 'crawler', 'api', 'mixed')
+
+
+def create_database(path, rows=0, image_base_url=''):
+    """Create every table of the app, with `rows` synthetic specimens"""
+    engine = create_engine(f'sqlite:///{path}')
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for start in range(0, rows, 10000):
+            conn.execute(Specimen.__table__.insert(), [
+                {
+                    'identifier': f'sinica-{i}',
+                    'species_name': f'物種{random.randint(0, 9999)}',
+                    'scientific_name': f'Genus{random.randint(0, 999)} species{random.randint(0, 9999)}',
+                    'collection_number': str(random.randint(0, 999999)),
+                    'catalog_number': f'Collector {random.randint(0, 9999)}',
+                    'reference': '作者不詳（2007-03-14）。[中文種名:物種] 國立臺灣大學植物標本館數位典藏。',
+                    'collection_date': datetime.date(random.randint(1900, 2020), random.randint(1, 12), 1),
+                    'collector': f'collector {random.randint(0, 499)}',
+                    'latitude': random.uniform(21.9, 25.3),
+                    'longitude': random.uniform(120.0, 122.0),
+                    'country': 'Taiwan',
+                    'area': f'area {random.randint(0, 199)}',
+                    'minimum_altitude': random.uniform(0, 3000),
+                    'image_url': f'{image_base_url}/images/{i}.jpg',
+                } for i in range(start, min(start + 10000, rows))
+            ])
+        # Built after the rows are inserted, from the whole table at once
+        for create in (create_search_index, create_geo_index, create_facet_tables, create_data_version):
+            create(conn)
+    engine.dispose()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def bench_parser(rounds):
+    documents = list(parser_benchmark.load_example_pages().values()) * rounds
+    return parser_benchmark.measure('single_pass', parser_benchmark.parse_single_pass, documents)
+
+
+async def bench_writer(rows):
+    specimen_rows = writer_benchmark.create_rows(writer_benchmark.load_example_specimens(), rows)
+    return await writer_benchmark.measure('batched', writer_benchmark.write_batched, specimen_rows)
+
+
+async def bench_crawler(directory, pages, concurrency, parse_workers, stub_options):
+    path = os.path.join(directory, 'crawl.db')
+    create_database(path)
+    runner, base_url = await start_stub(**stub_options)
+
+    env = os.environ | {'DB_FILENAME': path, 'SINICA_BASE_URL': base_url, 'PAGE_ARCHIVE_ENABLED': 'false'}
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, 'crawl.py', '--end-page', str(pages), '--limit', '0', '--rate', '0',
+        '--concurrency', str(concurrency), '--parse-workers', str(parse_workers),
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    await process.wait()
+    elapsed = time.perf_counter() - start
+    await runner.cleanup()
+
+    engine = create_engine(f'sqlite:///{path}')
+    with engine.connect() as conn:
+        states = dict(conn.exec_driver_sql('SELECT status, count(*) FROM crawl_state GROUP BY status').all())
+    engine.dispose()
+
+    crawled = pages + states.get('done', 0)
+    return {
+        'returncode': process.returncode,
+        'list_pages': pages,
+        'specimen_pages': states.get('done', 0),
+        'failed_specimens': sum(count for status, count in states.items() if status != 'done'),
+        'seconds': elapsed,
+        'pages_per_second': crawled / elapsed,
+    }
+
+
+def summarize(latencies, errors, seconds):
+    return {
+        'requests': len(latencies),
+        'requests_per_second': len(latencies) / seconds,
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        'errors': dict(errors),
+    }
+
+
+async def load(session, base_url, make_path, concurrency, seconds):
+    """Send requests from `concurrency` clients for `seconds`, each waits for its response before the next one"""
+    return (await load_routes(session, base_url, {'route': make_path}, concurrency, seconds))['route']
+
+
+async def load_routes(session, base_url, routes, concurrency, seconds):
+    """
+    Like load, with every request of a client sent to a random route of `routes`, so that all of them are measured
+    over the same period. Returns the results by route.
+    """
+    latencies = {route: [] for route in routes}
+    errors = {route: collections.Counter() for route in routes}
+    deadline = time.monotonic() + seconds
+
+    async def client():
+        while time.monotonic() < deadline:
+            route = random.choice(list(routes))
+            start = time.perf_counter()
+            try:
+                async with session.get(base_url + routes[route]()) as response:
+                    await response.read()
+            except aiohttp.ClientError as e:
+                errors[route][type(e).__name__] += 1
+                continue
+            if response.status != 200:
+                errors[route][str(response.status)] += 1
+                continue
+            latencies[route].append(time.perf_counter() - start)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return {route: summarize(latencies[route], errors[route], seconds) for route in routes}
+
+
+@contextlib.asynccontextmanager
+async def serve_app(directory, path):
+    """Serve the app by uvicorn on the database, yield a client session and the base url once it answers"""
+    port = free_port()
+    env = os.environ | {
+        'DB_FILENAME': path,
+        'IMAGE_CACHE_DIR': os.path.join(directory, 'images'),
+        'PDF_CACHE_DIR': os.path.join(directory, 'pdfs'),
+        'THUMBNAIL_DIR': os.path.join(directory, 'thumbnails'),
+    }
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level', 'warning'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            for _ in range(100):
+                try:
+                    async with session.get(base_url + '/') as response:
+                        if response.status == 200:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.2)
+            else:
+                raise RuntimeError('the app did not start')
+
+            yield session, base_url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def cheap_routes(rows):
+    """Paths of the routes which read a few rows, they must stay fast whatever the PDF load"""
+    def random_id():
+        return random.randint(1, rows)
+
+    return {
+        'list': lambda: f'/specimens/?limit=20&cursor={encode_cursor("id", types.SimpleNamespace(id=random_id()))}',
+        'detail': lambda: f'/specimens/{random_id()}/',
+        'search': lambda: f'/specimens/search/?q=collector%20{random.randint(0, 499)}',
+    }
+
+
+async def bench_api(directory, database, rows, concurrency, seconds, stub_options):
+    """Latencies of the list, detail, search and PDF routes, one route at a time"""
+    runner, _ = await start_stub(**stub_options)
+    routes = cheap_routes(rows) | {'pdf': lambda: f'/specimens/{random.randint(1, rows)}/download/'}
+    results = {'rows': rows, 'concurrency': concurrency}
+    try:
+        async with serve_app(directory, database) as (session, base_url):
+            for route, make_path in routes.items():
+                results[route] = await load(session, base_url, make_path, concurrency, seconds)
+    finally:
+        await runner.cleanup()
+    return results
+
+
+async def heavy_load(session, base_url, rows, kind, outcomes, latencies):
+    """Download PDFs or ZIPs of specimens with uncached images until cancelled"""
+    while True:
+        start = time.perf_counter()
+        try:
+            if kind == 'pdf':
+                request = session.get(f'{base_url}/specimens/{random.randint(1, rows)}/download/')
+            else:
+                ids = [random.randint(1, rows) for _ in range(10)]
+                request = session.post(f'{base_url}/specimens/download/', json={'ids': ids, 'format': 'zip'})
+            async with request as response:
+                await response.read()
+        except aiohttp.ClientError as e:
+            outcomes[f'{kind} {type(e).__name__}'] += 1
+            continue
+        outcomes[f'{kind} {response.status}'] += 1
+        if response.status == 200:
+            latencies[kind].append(time.perf_counter() - start)
+
+
+async def bench_mixed(directory, database, rows, concurrency, seconds, heavy_clients, image_latency, max_p99_ratio,
+                      stub_options):
+    """
+    Latencies of the cheap routes alone, then while `heavy_clients` clients download PDFs and ZIPs of specimens
+    whose images take `image_latency` seconds to fetch. The cheap routes should barely slow down, the heavy
+    downloads are limited by the render queue and answered 503 when it's full. The section fails when the loaded
+    p99 of a cheap route is more than `max_p99_ratio` times its idle p99.
+    """
+    runner, _ = await start_stub(**stub_options | {'image_latency': image_latency})
+    routes = cheap_routes(rows)
+    results = {'rows': rows, 'concurrency': concurrency, 'heavy_clients': heavy_clients, 'image_latency': image_latency}
+    try:
+        async with serve_app(directory, database) as (session, base_url):
+            # The routes are interleaved, the first one measured would otherwise take the whole burst of the
+            # heavy downloads starting
+            results['idle'] = await load_routes(session, base_url, routes, concurrency, seconds)
+
+            outcomes = collections.Counter()
+            latencies = {'pdf': [], 'zip': []}
+            heavy = [
+                asyncio.create_task(heavy_load(session, base_url, rows, kind, outcomes, latencies))
+                for kind in ('pdf', 'zip') for _ in range(heavy_clients // 2)
+            ]
+            # Let the heavy downloads fill the render queue first
+            await asyncio.sleep(image_latency)
+            results['loaded'] = await load_routes(session, base_url, routes, concurrency, seconds)
+            for task in heavy:
+                task.cancel()
+            await asyncio.gather(*heavy, return_exceptions=True)
+
+            results['heavy'] = {
+                'responses': dict(outcomes),
+                'pdf_p50_ms': percentile(latencies['pdf'], 0.5),
+                'zip_p50_ms': percentile(latencies['zip'], 0.5),
+            }
+    finally:
+        await runner.cleanup()
+
+    results['p99_ratio'] = {
+        route: results['loaded'][route]['p99_ms'] / results['idle'][route]['p99_ms']
+        if results['idle'][route]['p99_ms'] and results['loaded'][route]['p99_ms'] is not None else None
+        for route in routes
+    }
+    results['max_p99_ratio'] = max_p99_ratio
+    results['passed'] = all(ratio is not None and ratio <= max_p99_ratio for ratio in results['p99_ratio'].values())
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    random.seed(args.seed)
+    sections = args.section or list(SECTIONS)
+    stub_options = {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate}
+    results = {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'cpus': os.cpu_count(),
+        'options': vars(args),
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        if 'parser' in sections:
+            results['parser'] = bench_parser(args.parser_rounds)
+        if 'writer' in sections:
+            results['writer'] = await bench_writer(args.writer_rows)
+        if 'crawler' in sections:
+            results['crawler'] = await bench_crawler(
+                directory, args.crawl_pages, args.crawl_concurrency, args.parse_workers, stub_options,
+            )
+        if {'api', 'mixed'} & set(sections):
+            if not os.path.exists(PDF_FONT_FILE):
+                results['api'] = {'skipped': f'the app needs {PDF_FONT_FILE}'}
+            else:
+                # One database for both sections, its image urls point to the stub port of the sections
+                api_stub_options = stub_options | {'port': free_port()}
+                database = os.path.join(directory, 'api.db')
+                start = time.perf_counter()
+                create_database(database, args.api_rows, image_base_url=f'http://127.0.0.1:{api_stub_options["port"]}')
+                results['api_database_seconds'] = time.perf_counter() - start
+
+                if 'api' in sections:
+                    results['api'] = await bench_api(
+                        os.path.join(directory, 'api'), database, args.api_rows, args.api_concurrency,
+                        args.api_seconds, api_stub_options,
+                    )
+                if 'mixed' in sections:
+                    results['mixed'] = await bench_mixed(
+                        os.path.join(directory, 'mixed'), database, args.api_rows, args.mixed_concurrency,
+                        args.api_seconds, args.heavy_clients, args.image_latency, args.max_p99_ratio,
+                        api_stub_options,
+                    )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    # A non-zero status when the cheap routes slowed down too much under the PDF and ZIP downloads
+    return 0 if results.get('mixed', {}).get('passed', True) else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the parser, the writer, the crawler and the API')
+    parser.add_argument('--section', action='append', choices=SECTIONS, help='Section to run. Default is all')
+    parser.add_argument('--output', default=None, help='Also write the results to this file')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--latency', type=float, default=0.02, help='Mean response delay of the sinica stub')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Maximum deviation of the stub delay')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of a 503 from the stub')
+    parser.add_argument('--parser-rounds', type=int, default=5, help='Parses of every example page')
+    parser.add_argument('--writer-rows', type=int, default=5000, help='Rows written by the writer')
+    parser.add_argument('--crawl-pages', type=int, default=30, help='List pages crawled')
+    parser.add_argument('--crawl-concurrency', type=int, default=16, help='Maximum concurrent sinica requests')
+    parser.add_argument('--parse-workers', type=int, default=0, help='Parser processes of the crawler')
+    parser.add_argument('--api-rows', type=int, default=500000, help='Specimens of the synthetic database')
+    parser.add_argument('--api-concurrency', type=int, default=16, help='Concurrent API clients')
+    parser.add_argument('--api-seconds', type=float, default=10.0, help='Duration of the load of each route')
+    parser.add_argument('--mixed-concurrency', type=int, default=4, help='Concurrent clients of the cheap routes')
+    parser.add_argument('--heavy-clients', type=int, default=20, help='Concurrent PDF and ZIP downloads')
+    parser.add_argument('--image-latency', type=float, default=4.0, help='Mean image delay of the stub in mixed')
+    parser.add_argument(
+        '--max-p99-ratio', type=float, default=2.0,
+        help='Maximum loaded to idle p99 of the cheap routes in mixed, the section fails above it',
+    )
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,104 @@
+"""
+Compare the batched SpecimenWriter with the previous per-specimen select/update/commit, writing the specimens
+parsed from example_html.
+
+    $ python -m benchmarks.writer --rows 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel import SQLModel
+
+from db.engine import create_sqlite_engine
+from db.facets import create_facet_tables
+from db.geo import create_geo_index
+from db.models import Specimen
+from db.search import create_search_index
+from specimen.crawl_utils import parse_specimen_from_sinica, parse_specimen_from_sinica_v2
+from specimen.writer import SpecimenWriter
+
+
+def load_example_specimens():
+    specimens = []
+    for filename in sorted(os.listdir('example_html')):
+        with open(os.path.join('example_html', filename)) as f:
+            html = f.read()
+        for parse_function in [parse_specimen_from_sinica, parse_specimen_from_sinica_v2]:
+            try:
+                specimens.append(parse_function(html))
+                break
+            except Exception:
+                continue
+    return specimens
+
+
+def create_rows(specimens, rows):
+    return [
+        specimens[i % len(specimens)] | {'identifier': f'sinica-{i}'} for i in range(rows)
+    ]
+
+
+async def create_database(path, identifiers):
+    async_engine = create_sqlite_engine(path)
+    async with async_engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all, tables=[Specimen.__table__])
+        for create in (create_search_index, create_geo_index, create_facet_tables):
+            await conn.run_sync(create)
+        await conn.execute(Specimen.__table__.insert(), [{'identifier': identifier} for identifier in identifiers])
+    return async_engine
+
+
+async def write_row_by_row(async_db_session, rows):
+    """The write path of crawl_specimens before the batched writer"""
+    for specimen_data in rows:
+        async with async_db_session() as session:
+            async with session.begin():
+                statement = select(Specimen).where(Specimen.identifier == specimen_data['identifier']).limit(1)
+                result = await session.execute(statement)
+                specimen = result.scalars().one()
+                for field, value in specimen_data.items():
+                    setattr(specimen, field, value)
+                await session.commit()
+
+
+async def write_batched(async_db_session, rows):
+    async with SpecimenWriter(async_db_session) as writer:
+        for specimen_data in rows:
+            await writer.upsert(specimen_data)
+
+
+async def measure(name, write, rows):
+    with tempfile.TemporaryDirectory() as directory:
+        async_engine = await create_database(os.path.join(directory, 'bench.db'), [row['identifier'] for row in rows])
+        async_db_session = async_sessionmaker(async_engine, expire_on_commit=False)
+
+        start = time.perf_counter()
+        await write(async_db_session, rows)
+        elapsed = time.perf_counter() - start
+
+        await async_engine.dispose()
+
+    return {'name': name, 'rows': len(rows), 'seconds': elapsed, 'rows_per_second': len(rows) / elapsed}
+
+
+async def main(rows):
+    specimen_rows = create_rows(load_example_specimens(), rows)
+    results = [
+        await measure('row_by_row', write_row_by_row, specimen_rows),
+        await measure('batched', write_batched, specimen_rows),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the crawler write path')
+    parser.add_argument('--rows', type=int, default=2000, help='Number of specimens to write')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows))
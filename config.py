@@ -4,5 +4,83 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     db_filename: str = 'specimen_app.db'
 
+    # SQLite connections, the pragmas are set on every new connection. The API reads through a pool of read-only
+    # connections, the writes go through a separate writer pool
+    db_echo: bool = False
+    db_busy_timeout: int = 5000
+    db_synchronous: str = 'NORMAL'
+    db_mmap_size: int = 256 * 1024 * 1024
+    db_cache_size: int = -64 * 1024
+    db_reader_pool_size: int = 8
+    db_writer_pool_size: int = 1
+
+    # Sinica website crawled by the crawlers, e.g. the stub server of the benchmarks
+    sinica_base_url: str = 'https://sinica.digitalarchives.tw'
+
+    # Shared aiohttp session used for requests to sinica
+    http_pool_size: int = 20
+
+    # On-disk cache of specimen images downloaded from sinica
+    image_cache_dir: str = 'cache/images'
+    image_cache_max_bytes: int = 512 * 1024 * 1024
+    image_cache_ttl: int = 7 * 24 * 60 * 60
+    # Seconds a failed image download is remembered, the requests of the image fail at once meanwhile
+    image_cache_failure_ttl: int = 30
+
+    # On-disk cache of rendered specimen PDFs
+    pdf_cache_dir: str = 'cache/pdfs'
+    pdf_cache_max_bytes: int = 256 * 1024 * 1024
+    pdf_cache_ttl: int = 30 * 24 * 60 * 60
+
+    # Resized specimen images, created on their first request or by generate_thumbnails.py. The sizes are the
+    # maximum width and height
+    thumbnail_dir: str = 'cache/thumbnails'
+    thumbnail_max_bytes: int = 2 * 1024 * 1024 * 1024
+    thumbnail_ttl: int = 365 * 24 * 60 * 60
+    thumbnail_sizes: dict[str, int] = {'small': 200, 'medium': 600, 'large': 1200}
+    thumbnail_quality: int = 80
+    thumbnail_max_age: int = 30 * 24 * 60 * 60
+
+    # Process pool rendering the PDFs, requests are rejected with 503 when the queue is full. With
+    # pdf_render_idle_priority the workers only get the CPU the API routes leave, e.g. on a single core host
+    pdf_render_workers: int = 2
+    pdf_render_concurrency: int = 2
+    pdf_render_queue_size: int = 16
+    pdf_render_retry_after: int = 5
+    pdf_render_idle_priority: bool = True
+
+    # Bulk PDF / ZIP download. A multi-page PDF is rendered whole before it's sent, reportlab writes the document
+    # structure at the end, so it's capped by bulk_pdf_max_specimens. The ZIP is streamed whatever its size
+    bulk_download_max_ids: int = 5000
+    bulk_download_prefetch: int = 8
+    bulk_pdf_max_specimens: int = 200
+
+    # In-memory cache of the JSON responses of the specimen and list routes. The data version, which drops the cached
+    # responses on every write, is read at most once every response_cache_version_ttl seconds
+    response_cache_max_entries: int = 10000
+    response_cache_max_bytes: int = 64 * 1024 * 1024
+    response_cache_ttl: int = 5 * 60
+    response_cache_version_ttl: float = 1.0
+
+    # Maximum page size of the specimen list, lower it if most clients request every field
+    list_max_limit: int = 1000
+
+    # Batch lookup of specimens by ids or identifiers, resolved with IN queries of batch_lookup_chunk_size keys
+    batch_lookup_max_ids: int = 5000
+    batch_lookup_chunk_size: int = 500
+
+    # Rows fetched per batch by the full dataset export
+    export_batch_size: int = 1000
+
+    # Compressed archive of the raw pages fetched by the crawlers, read back by reparse_specimens.py
+    page_archive_enabled: bool = True
+    page_archive_dir: str = 'archive'
+    page_archive_segment_bytes: int = 64 * 1024 * 1024
+
+    # Prometheus metrics, served by the API at /metrics. The crawlers serve them on --metrics-port or write them to
+    # --metrics-file every metrics_textfile_interval seconds
+    metrics_enabled: bool = True
+    metrics_textfile_interval: float = 15.0
+
 
 settings = Settings()
@@ -0,0 +1,173 @@
+import datetime
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+import argparse
+import asyncio
+
+from config import settings
+from db.engine import async_db_session, async_engine
+from metrics import CRAWLER_METRIC_PREFIXES, REGISTRY, start_metrics_server, write_textfile_periodically
+from specimen.archive import PageArchive
+from specimen.crawl_utils import DEFAULT_HEADERS, SINICA_BASE_URL
+from specimen.frontier import CrawlFrontier, KnownSinicaIds, utcnow
+from specimen.pipeline import CrawlPipeline
+from specimen.writer import SpecimenWriter
+
+# Crawl the list pages, the claimed specimens, or both in one pipeline
+CRAWL_MODES = ('all', 'lists', 'specimens')
+
+
+def default_parse_workers() -> int:
+    """Parser processes by default: up to 2 while a core is left to the crawler, in-process on a single core"""
+    cpu_count = os.cpu_count() or 1
+    return min(2, cpu_count - 1) if cpu_count > 1 else 0
+
+
+async def main(
+    mode='all',
+    start_page=1,
+    end_page=100,
+    limit=100,
+    incremental=False,
+    stop_after=3,
+    rate=2.0,
+    concurrency=8,
+    parse_workers=0,
+    max_attempts=5,
+    retry_delay=3600.0,
+    refresh_age=None,
+    test_mode=False,
+    metrics_port=0,
+    metrics_file=None,
+):
+    crawl_lists = mode in ('all', 'lists')
+    crawl_details = mode in ('all', 'specimens')
+
+    archive = PageArchive(settings.page_archive_dir, settings.page_archive_segment_bytes) \
+        if settings.page_archive_enabled and not test_mode else None
+    parse_pool = ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn')) \
+        if crawl_details and parse_workers else None
+
+    metrics_runner = None
+    metrics_writer = None
+    # The pools, the metrics server and the engine are released whether the crawl succeeds or not
+    try:
+        # Expose the stage latencies, throughput and errors while the crawl is running
+        if metrics_port:
+            metrics_runner = await start_metrics_server('0.0.0.0', metrics_port, CRAWLER_METRIC_PREFIXES)
+        if metrics_file:
+            metrics_writer = asyncio.create_task(
+                write_textfile_periodically(metrics_file, settings.metrics_textfile_interval, CRAWLER_METRIC_PREFIXES),
+            )
+
+        async with aiohttp.ClientSession() as session, SpecimenWriter(async_db_session) as writer:
+            if crawl_lists and not test_mode:
+                # Need to get Cookie first for get correct list response
+                async with session.get(
+                        url=f'{SINICA_BASE_URL}/collection.php?type=3799',
+                        headers=DEFAULT_HEADERS,
+                        timeout=7,
+                ) as response:
+                    session.cookie_jar.update_cookies(response.cookies)
+
+            frontier = None
+            specimen_identifiers = []
+            fetched_before = utcnow() - datetime.timedelta(days=refresh_age) if refresh_age is not None else None
+            if crawl_details:
+                # Claim the due specimens from the crawl frontier, the ones left in flight by a dead crawler
+                # included. In refresh mode, claim the crawled specimens older than refresh_age days instead
+                frontier = CrawlFrontier(
+                    async_db_session, writer, max_attempts=max_attempts, retry_delay=retry_delay,
+                )
+                await frontier.recover()
+                specimen_identifiers = await frontier.claim(limit, fetched_before=fetched_before)
+
+            known = None
+            if crawl_lists and incremental:
+                known = await KnownSinicaIds.load(async_db_session)
+                logging.warning(f'[crawl] loaded {len(known)} known specimens')
+
+            pipeline = CrawlPipeline(
+                session, writer, frontier, parse_pool,
+                archive=archive,
+                rate=rate,
+                concurrency=concurrency,
+                parse_workers=parse_workers,
+                test_mode=test_mode,
+            )
+            stats = await pipeline.run(
+                pages=range(start_page, end_page + 1) if crawl_lists else None,
+                identifiers=specimen_identifiers,
+                known=known,
+                stop_after=stop_after,
+                crawl_details=crawl_details,
+                fetched_before=fetched_before,
+            )
+            logging.warning(f'[crawl] finished: {stats}')
+
+        logging.warning(f'[crawl] writer: {writer.stats()}')
+        if frontier is not None:
+            logging.warning(f'[crawl] frontier: {await frontier.stats()}')
+        if archive is not None:
+            logging.warning(f'[crawl] archive: {archive.stats()}')
+    finally:
+        if archive is not None:
+            archive.close()
+        if parse_pool is not None:
+            parse_pool.shutdown(cancel_futures=True)
+        if metrics_writer is not None:
+            metrics_writer.cancel()
+            REGISTRY.write_textfile(metrics_file, CRAWLER_METRIC_PREFIXES)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+        await async_engine.dispose()
+
+
+def add_list_arguments(parser):
+    parser.add_argument('--start-page', type=int, default=1, help='Start page number')
+    parser.add_argument('--end-page', type=int, default=100, help='End page number')
+    parser.add_argument(
+        '--incremental', action='store_true', help='Skip the known specimens and stop when no new specimen is found',
+    )
+    parser.add_argument(
+        '--stop-after', type=int, default=3, help='Stop after this many consecutive pages without new specimens',
+    )
+
+
+def add_specimen_arguments(parser):
+    parser.add_argument('--limit', type=int, default=100, help='Limit of claimed specimen to crawl')
+    parser.add_argument(
+        '--parse-workers', type=int, default=default_parse_workers(),
+        help='Number of parser processes, 0 to parse in the crawler process. Default is up to 2 on multi-core hosts',
+    )
+    parser.add_argument('--max-attempts', type=int, default=5, help='Give up on a specimen after failed attempts')
+    parser.add_argument('--retry-delay', type=float, default=3600.0, help='Delay before the first retry in seconds')
+    parser.add_argument(
+        '--refresh-age', type=float, default=None, help='Refresh the specimens crawled more than this many days ago',
+    )
+
+
+def add_common_arguments(parser):
+    parser.add_argument('--rate', type=float, default=2.0, help='Maximum requests per second to sinica')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum concurrency')
+    parser.add_argument('--test-mode', type=bool, default=False, help='Enable test mode')
+    parser.add_argument('--metrics-port', type=int, default=0, help='Serve the metrics on this port, 0 to disable')
+    parser.add_argument('--metrics-file', default=None, help='Write the metrics to this file, for a textfile collector')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Crawl the list pages and the specimen pages of sinica in one pipeline',
+    )
+    parser.add_argument('--mode', choices=CRAWL_MODES, default='all', help='Stages to run')
+    add_list_arguments(parser)
+    add_specimen_arguments(parser)
+    add_common_arguments(parser)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.mode, **{name: value for name, value in vars(args).items() if name != 'mode'}))
@@ -0,0 +1,65 @@
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import settings
+from metrics import instrument_engine
+
+
+def create_sqlite_engine(filename: str | None = None, read_only: bool = False) -> AsyncEngine:
+    """
+    Create an engine of the SQLite database with the pragmas of the settings set on every connection.
+
+    The writer engine switches the database to WAL, so the readers never block the writer and the writer never
+    blocks the readers. Read-only engines open the database with `mode=ro`.
+
+    Params:
+        filename (str): the database file, default is `settings.db_filename`.
+        read_only (bool): create a pool of read-only connections.
+
+    Returns:
+        AsyncEngine: the engine.
+    """
+    filename = filename or settings.db_filename
+    pool_options = {}
+    if read_only:
+        url = f'sqlite+aiosqlite:///file:{filename}?mode=ro&uri=true'
+        pool_size = settings.db_reader_pool_size
+        # Every aiosqlite connection is a thread, the most recently used ones are reused first so a light load keeps
+        # few threads busy. A read-only connection is never in a transaction (sqlite3 only begins one before a write),
+        # so it goes back to the pool without the rollback, one round trip to its thread less per session
+        pool_options = {'pool_use_lifo': True, 'pool_reset_on_return': None}
+    else:
+        url = f'sqlite+aiosqlite:///{filename}'
+        pool_size = settings.db_writer_pool_size
+
+    # aiosqlite defaults to a NullPool, which opens a connection and sets the pragmas again for every session
+    engine = create_async_engine(
+        url=url, echo=settings.db_echo, poolclass=AsyncAdaptedQueuePool, pool_size=pool_size, max_overflow=0,
+        **pool_options,
+    )
+
+    @event.listens_for(engine.sync_engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not read_only:
+            cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute(f'PRAGMA busy_timeout = {settings.db_busy_timeout}')
+        cursor.execute(f'PRAGMA synchronous = {settings.db_synchronous}')
+        cursor.execute(f'PRAGMA mmap_size = {settings.db_mmap_size}')
+        cursor.execute(f'PRAGMA cache_size = {settings.db_cache_size}')
+        cursor.close()
+
+    if settings.metrics_enabled:
+        instrument_engine(engine.sync_engine, 'read' if read_only else 'write')
+
+    return engine
+
+
+# Engines and session factories shared by the API and the scripts
+async_engine = create_sqlite_engine()
+read_engine = create_sqlite_engine(read_only=True)
+
+async_db_session = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+read_db_session = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
@@ -0,0 +1,132 @@
+from sqlalchemy import column, table
+
+# Summary tables of the specimen counts per facet, kept up to date by triggers on the specimens table, so that
+# facet queries never scan the specimens table.
+#
+# specimen_facet_counts holds the count of every value of every facet and answers unfiltered queries.
+# specimen_facet_cube holds the count of every combination of facet values and answers filtered queries.
+
+FACETS = ('country', 'area', 'collector', 'year', 'altitude_band')
+
+ALTITUDE_BAND_SIZE = 500
+
+specimen_facet_counts = table('specimen_facet_counts', column('facet'), column('value'), column('count'))
+specimen_facet_cube = table('specimen_facet_cube', *(column(facet) for facet in FACETS), column('count'))
+
+_FACET_EXPRESSIONS = {
+    'country': '{row}.country',
+    'area': '{row}.area',
+    'collector': '{row}.collector',
+    'year': "COALESCE(substr({row}.collection_date, 1, 4), '')",
+    'altitude_band': (
+        "CASE WHEN typeof({row}.minimum_altitude) IN ('real', 'integer') THEN printf('%d-%d', "
+        f"CAST({{row}}.minimum_altitude / {ALTITUDE_BAND_SIZE} AS INTEGER) * {ALTITUDE_BAND_SIZE}, "
+        f"CAST({{row}}.minimum_altitude / {ALTITUDE_BAND_SIZE} AS INTEGER) * {ALTITUDE_BAND_SIZE} + {ALTITUDE_BAND_SIZE}"
+        ") ELSE '' END"
+    ),
+}
+
+_SOURCE_COLUMNS = 'country, area, collector, collection_date, minimum_altitude'
+_CUBE_COLUMNS = ', '.join(FACETS)
+
+
+def _values(row: str) -> list[str]:
+    return [_FACET_EXPRESSIONS[facet].format(row=row) for facet in FACETS]
+
+
+def _add_statements(row: str) -> str:
+    values = _values(row)
+    counts = ' UNION ALL '.join(f"SELECT '{facet}', {value}, 1" for facet, value in zip(FACETS, values))
+    return f"""
+        INSERT INTO specimen_facet_counts(facet, value, count) {counts} WHERE true
+        ON CONFLICT(facet, value) DO UPDATE SET count = count + 1;
+        INSERT INTO specimen_facet_cube({_CUBE_COLUMNS}, count) VALUES ({', '.join(values)}, 1)
+        ON CONFLICT({_CUBE_COLUMNS}) DO UPDATE SET count = count + 1;
+    """
+
+
+def _remove_statements(row: str) -> str:
+    values = _values(row)
+    statements = []
+    for facet, value in zip(FACETS, values):
+        statements.append(
+            f"UPDATE specimen_facet_counts SET count = count - 1 WHERE facet = '{facet}' AND value = {value};"
+        )
+    cube_key = ' AND '.join(f'{facet} = {value}' for facet, value in zip(FACETS, values))
+    statements.append(f"UPDATE specimen_facet_cube SET count = count - 1 WHERE {cube_key};")
+    for facet, value in zip(FACETS, values):
+        statements.append(
+            f"DELETE FROM specimen_facet_counts WHERE facet = '{facet}' AND value = {value} AND count <= 0;"
+        )
+    statements.append(f"DELETE FROM specimen_facet_cube WHERE {cube_key} AND count <= 0;")
+    return '\n'.join(statements)
+
+
+CREATE_FACET_TABLE_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS specimen_facet_counts (
+        facet TEXT NOT NULL,
+        value TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (facet, value)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_specimen_facet_counts_count ON specimen_facet_counts (facet, count)",
+    f"""
+    CREATE TABLE IF NOT EXISTS specimen_facet_cube (
+        {', '.join(f'{facet} TEXT NOT NULL' for facet in FACETS)},
+        count INTEGER NOT NULL,
+        PRIMARY KEY ({_CUBE_COLUMNS})
+    ) WITHOUT ROWID
+    """,
+    *(
+        f"CREATE INDEX IF NOT EXISTS ix_specimen_facet_cube_{facet} ON specimen_facet_cube ({facet})"
+        for facet in FACETS[1:]
+    ),
+    f"""
+    CREATE TRIGGER IF NOT EXISTS specimen_facets_insert AFTER INSERT ON specimens BEGIN
+        {_add_statements('new')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS specimen_facets_delete AFTER DELETE ON specimens BEGIN
+        {_remove_statements('old')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS specimen_facets_update AFTER UPDATE OF {_SOURCE_COLUMNS} ON specimens BEGIN
+        {_remove_statements('old')}
+        {_add_statements('new')}
+    END
+    """,
+]
+
+
+def rebuild_facet_tables(conn) -> None:
+    """Recompute the facet summary tables from the specimens table"""
+    values = _values('specimens')
+
+    conn.exec_driver_sql("DELETE FROM specimen_facet_counts")
+    conn.exec_driver_sql("DELETE FROM specimen_facet_cube")
+    conn.exec_driver_sql(f"""
+        INSERT INTO specimen_facet_cube({_CUBE_COLUMNS}, count)
+        SELECT {', '.join(values)}, count(*) FROM specimens GROUP BY {', '.join(str(i + 1) for i in range(len(FACETS)))}
+    """)
+    for facet in FACETS:
+        conn.exec_driver_sql(f"""
+            INSERT INTO specimen_facet_counts(facet, value, count)
+            SELECT '{facet}', {facet}, sum(count) FROM specimen_facet_cube GROUP BY {facet}
+        """)
+
+
+def create_facet_tables(conn) -> None:
+    """Create the facet summary tables and their triggers, and fill them when created on an existing table"""
+    existed = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = 'specimen_facet_cube'"
+    ).first() is not None
+
+    for statement in CREATE_FACET_TABLE_STATEMENTS:
+        conn.exec_driver_sql(statement)
+
+    if not existed:
+        rebuild_facet_tables(conn)
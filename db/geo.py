@@ -0,0 +1,66 @@
+from sqlalchemy import column, table
+
+# R*Tree index of the specimen coordinates, kept in sync with the specimens table by triggers. Each specimen is a
+# point, so the min and max of each dimension are equal.
+specimens_rtree = table(
+    'specimens_rtree',
+    column('id'), column('min_latitude'), column('max_latitude'), column('min_longitude'), column('max_longitude'),
+)
+
+_HAS_COORDINATES = "typeof({row}.latitude) IN ('real', 'integer') AND typeof({row}.longitude) IN ('real', 'integer')"
+
+_INSERT_NEW = f"""
+    INSERT INTO specimens_rtree
+    SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude
+    WHERE {_HAS_COORDINATES.format(row='new')};
+"""
+
+CREATE_GEO_INDEX_STATEMENTS = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS specimens_rtree USING rtree(
+        id, min_latitude, max_latitude, min_longitude, max_longitude
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS specimens_rtree_insert AFTER INSERT ON specimens BEGIN
+        {_INSERT_NEW}
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS specimens_rtree_delete AFTER DELETE ON specimens BEGIN
+        DELETE FROM specimens_rtree WHERE id = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS specimens_rtree_update AFTER UPDATE OF latitude, longitude ON specimens BEGIN
+        DELETE FROM specimens_rtree WHERE id = old.id;
+        {_INSERT_NEW}
+    END
+    """,
+]
+
+# Kilometers per degree of latitude
+KM_PER_DEGREE = 111.32
+
+
+def rebuild_geo_index(conn) -> None:
+    """Rebuild the R*Tree index from the specimens table"""
+    conn.exec_driver_sql("DELETE FROM specimens_rtree")
+    conn.exec_driver_sql(f"""
+        INSERT INTO specimens_rtree
+        SELECT id, latitude, latitude, longitude, longitude FROM specimens
+        WHERE {_HAS_COORDINATES.format(row='specimens')}
+    """)
+
+
+def create_geo_index(conn) -> None:
+    """Create the R*Tree index and its triggers, and fill the index when it's created on an existing table"""
+    existed = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = 'specimens_rtree'"
+    ).first() is not None
+
+    for statement in CREATE_GEO_INDEX_STATEMENTS:
+        conn.exec_driver_sql(statement)
+
+    if not existed:
+        rebuild_geo_index(conn)
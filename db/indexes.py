@@ -0,0 +1,14 @@
+from db.facets import create_facet_tables, rebuild_facet_tables
+from db.geo import create_geo_index, rebuild_geo_index
+from db.search import create_search_index, rebuild_search_index
+from db.version import bump_data_version, create_data_version
+
+# The tables derived from the specimens table, by name: the functions creating them and rebuilding their content
+# from the specimens, both run on a sync connection
+INDEX_REBUILDERS = {
+    'search': (create_search_index, rebuild_search_index),
+    'geo': (create_geo_index, rebuild_geo_index),
+    'facets': (create_facet_tables, rebuild_facet_tables),
+    # Drops the cached API responses
+    'version': (create_data_version, bump_data_version),
+}
@@ -1,11 +1,18 @@
-from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
-from sqlalchemy.orm import sessionmaker
 
-from config import settings
+from db.engine import async_engine, read_db_session
+from db.facets import create_facet_tables
+from db.geo import create_geo_index
+from db.search import create_search_index
+from db.version import create_data_version
 
-async_engine = create_async_engine(url=f'sqlite+aiosqlite:///{settings.db_filename}', echo=True)
+
+def create_indexes(conn):
+    """Create the indexes added after the tables were created, since create_all skips existing tables"""
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
 
 
 async def init_db():
@@ -13,15 +20,14 @@ async def init_db():
     async with async_engine.begin() as conn:
         from .models import Specimen
         await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(create_indexes)
+        await conn.run_sync(create_search_index)
+        await conn.run_sync(create_geo_index)
+        await conn.run_sync(create_facet_tables)
+        await conn.run_sync(create_data_version)
 
 
 async def get_db_async_session() -> AsyncSession:
-    """Dependency to provide the db session object"""
-    async_session = sessionmaker(
-        bind=async_engine,
-        class_=AsyncSession,
-        expire_on_commit=False,
-    )
-
-    async with async_session() as session:
+    """Dependency to provide the db session object, the API only reads so it's a read-only session"""
+    async with read_db_session() as session:
         yield session
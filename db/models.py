@@ -1,5 +1,6 @@
 import datetime
 
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field
 
 
@@ -26,11 +27,52 @@ class SpecimenBase(SQLModel):
 class Specimen(SpecimenBase, table=True):
 
     __tablename__ = 'specimens'
+    __table_args__ = (
+        # Support keyset pagination sorted by these fields
+        Index('ix_specimens_collection_date_id', 'collection_date', 'id'),
+        Index('ix_specimens_species_name_id', 'species_name', 'id'),
+    )
 
     id: int | None = Field(default=None, primary_key=True)
     identifier: str = Field(unique=True)
 
 
+class CrawlState(SQLModel, table=True):
+    """Crawl frontier of the specimen pages, one row per specimen identifier"""
+
+    __tablename__ = 'crawl_state'
+    __table_args__ = (
+        # Claim the next batch of eligible specimens
+        Index('ix_crawl_state_status_next_attempt_at', 'status', 'next_attempt_at'),
+        # Claim the oldest crawled specimens to refresh
+        Index('ix_crawl_state_status_last_fetched_at', 'status', 'last_fetched_at'),
+    )
+
+    identifier: str = Field(primary_key=True)
+    status: str = Field(default='pending', description='pending, in_flight, done or failed')
+    attempts: int = Field(default=0)
+    last_error: str = Field(default='')
+    next_attempt_at: datetime.datetime = Field(default=datetime.datetime(1970, 1, 1))
+    last_fetched_at: datetime.datetime | None = Field(default=None, nullable=True)
+
+    # Validators of the last fetched page, to skip unchanged pages on refresh
+    etag: str | None = Field(default=None, nullable=True)
+    last_modified: str | None = Field(default=None, nullable=True)
+    content_hash: str | None = Field(default=None, nullable=True)
+
+
+def create_crawl_state_table(conn):
+    """Create the crawl state table in the databases created before it, and add the columns added since"""
+    CrawlState.__table__.create(conn, checkfirst=True)
+    existing = {row[1] for row in conn.exec_driver_sql('PRAGMA table_info(crawl_state)')}
+    for column in CrawlState.__table__.columns:
+        if column.name not in existing:
+            column_type = column.type.compile(conn.dialect)
+            conn.exec_driver_sql(f'ALTER TABLE crawl_state ADD COLUMN {column.name} {column_type}')
+    for index in CrawlState.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
 def create_specimen_identifier(external_identifier: str | int, website: str = '') -> str:
     return f'{website}-{external_identifier}'
 
@@ -0,0 +1,74 @@
+from sqlalchemy import column, table
+
+# Full-text index of the specimens, kept in sync with the specimens table by triggers. The trigram tokenizer
+# matches any substring of at least 3 characters, which works for chinese names without word segmentation.
+SEARCH_FIELDS = ('species_name', 'scientific_name', 'collector', 'area')
+
+MIN_SEARCH_TERM_LENGTH = 3
+
+specimens_fts = table('specimens_fts', column('rowid'))
+
+_columns = ', '.join(SEARCH_FIELDS)
+_new_values = ', '.join(f'new.{field}' for field in SEARCH_FIELDS)
+_old_values = ', '.join(f'old.{field}' for field in SEARCH_FIELDS)
+
+CREATE_SEARCH_INDEX_STATEMENTS = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS specimens_fts USING fts5(
+        {_columns}, content='specimens', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS specimens_fts_insert AFTER INSERT ON specimens BEGIN
+        INSERT INTO specimens_fts(rowid, {_columns}) VALUES (new.id, {_new_values});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS specimens_fts_delete AFTER DELETE ON specimens BEGIN
+        INSERT INTO specimens_fts(specimens_fts, rowid, {_columns}) VALUES ('delete', old.id, {_old_values});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS specimens_fts_update AFTER UPDATE OF {_columns} ON specimens BEGIN
+        INSERT INTO specimens_fts(specimens_fts, rowid, {_columns}) VALUES ('delete', old.id, {_old_values});
+        INSERT INTO specimens_fts(rowid, {_columns}) VALUES (new.id, {_new_values});
+    END
+    """,
+]
+
+
+def _table_exists(conn, name: str) -> bool:
+    return conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = ?", (name,)
+    ).first() is not None
+
+
+def rebuild_search_index(conn) -> None:
+    """Rebuild the full-text index from the specimens table"""
+    conn.exec_driver_sql("INSERT INTO specimens_fts(specimens_fts) VALUES ('rebuild')")
+
+
+def create_search_index(conn) -> None:
+    """Create the full-text index and its triggers, and fill the index when it's created on an existing table"""
+    existed = _table_exists(conn, 'specimens_fts')
+
+    for statement in CREATE_SEARCH_INDEX_STATEMENTS:
+        conn.exec_driver_sql(statement)
+
+    if not existed:
+        rebuild_search_index(conn)
+
+
+def build_match_query(query: str) -> str | None:
+    """
+    Convert a user query to a FTS5 MATCH expression, where every whitespace separated term must match.
+
+    Returns:
+        str: the MATCH expression, or None if a term is too short for the trigram index.
+    """
+    terms = query.split()
+    if not terms or any(len(term) < MIN_SEARCH_TERM_LENGTH for term in terms):
+        return None
+
+    # Quote the terms so that FTS5 operators in the query are matched literally
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
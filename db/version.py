@@ -0,0 +1,36 @@
+from sqlalchemy import column, table
+
+# Version of the specimens data, bumped by triggers on every insert/update/delete of the specimens table, whoever
+# writes it. The API caches its responses with the version they were read at and drops them once it changed.
+specimens_version = table('specimens_version', column('id'), column('version'))
+
+_BUMP = "UPDATE specimens_version SET version = version + 1 WHERE id = 1;"
+
+CREATE_DATA_VERSION_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS specimens_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+    """,
+    "INSERT OR IGNORE INTO specimens_version(id, version) VALUES (1, 0)",
+    *(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS specimens_version_{event.lower()} AFTER {event} ON specimens BEGIN
+            {_BUMP}
+        END
+        """
+        for event in ('INSERT', 'UPDATE', 'DELETE')
+    ),
+]
+
+
+def bump_data_version(conn) -> None:
+    """Bump the version, e.g. after the specimens were written while the triggers were dropped"""
+    conn.exec_driver_sql(_BUMP)
+
+
+def create_data_version(conn) -> None:
+    """Create the version table and its triggers"""
+    for statement in CREATE_DATA_VERSION_STATEMENTS:
+        conn.exec_driver_sql(statement)
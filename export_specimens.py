@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+import sys
+
+from db.engine import read_db_session, read_engine
+from specimen.export import EXPORT_COMPRESSIONS, EXPORT_MEDIA_TYPES, check_export_support, iter_specimen_rows, \
+    stream_export
+from specimen.schemas import SpecimenFilter
+
+
+async def main(output, export_format, compression, batch_size, filters):
+    check_export_support(export_format, compression)
+
+    async with read_db_session() as session:
+        row_batches = iter_specimen_rows(session, filters, batch_size=batch_size)
+        with open(output, 'wb') if output != '-' else sys.stdout.buffer as f:
+            async for chunk in stream_export(row_batches, export_format, compression):
+                f.write(chunk)
+
+    await read_engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export all specimens, or the specimens matching the filters')
+    parser.add_argument('--output', default='-', help='Output file. Default is stdout')
+    parser.add_argument('--format', choices=list(EXPORT_MEDIA_TYPES), default='ndjson', help='Export format')
+    parser.add_argument('--compression', choices=EXPORT_COMPRESSIONS, default=None, help='Compression')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows fetched per batch')
+    for field in SpecimenFilter.model_fields:
+        parser.add_argument(f'--{field.replace("_", "-")}', dest=field, default=None, help=f'Filter by {field}')
+    args = parser.parse_args()
+
+    filters = {
+        field: getattr(args, field) for field in SpecimenFilter.model_fields if getattr(args, field) is not None
+    }
+
+    asyncio.run(main(args.output, args.format, args.compression, args.batch_size, filters))
@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+from sqlmodel import select
+
+from config import settings
+from db.engine import read_db_session, read_engine
+from db.models import Specimen
+from specimen.cache import ImageCache, ThumbnailCache
+from specimen.images import IMAGE_MEDIA_TYPES, derivative_key, resize_image
+from specimen.scheduler import run_work_queue
+
+
+async def load_image_urls():
+    async with read_db_session() as session:
+        result = await session.exec(select(Specimen.image_url).where(Specimen.image_url != '').distinct())
+        return result.all()
+
+
+async def main(sizes, formats, workers, concurrency, rate):
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=settings.http_pool_size)) as http_session:
+        image_cache = ImageCache(
+            directory=settings.image_cache_dir,
+            max_bytes=settings.image_cache_max_bytes,
+            ttl=settings.image_cache_ttl,
+            session=http_session,
+        )
+        thumbnail_cache = ThumbnailCache(
+            directory=settings.thumbnail_dir,
+            max_bytes=settings.thumbnail_max_bytes,
+            ttl=settings.thumbnail_ttl,
+            image_cache=image_cache,
+            sizes=settings.thumbnail_sizes,
+            quality=settings.thumbnail_quality,
+        )
+
+        def missing(image_url):
+            return [
+                (size, image_format) for size in sizes for image_format in formats
+                if derivative_key(image_url, size, image_format) not in thumbnail_cache
+            ]
+
+        image_urls = [image_url for image_url in await load_image_urls() if missing(image_url)]
+        logging.warning(f'[generate_thumbnails] {len(image_urls)} images without thumbnails')
+
+        async def create_thumbnails(image_url):
+            derivatives = missing(image_url)
+            image = await image_cache.fetch(image_url)
+            # Every size and format is created from one decode of the image, in the worker processes
+            thumbnails = await loop.run_in_executor(
+                pool,
+                resize_image,
+                image,
+                {size: settings.thumbnail_sizes[size] for size, _ in derivatives},
+                sorted({image_format for _, image_format in derivatives}),
+                settings.thumbnail_quality,
+            )
+            for (size, image_format), thumbnail in thumbnails.items():
+                thumbnail_cache.set(derivative_key(image_url, size, image_format), thumbnail)
+
+        async def creation_failed(image_url, error):
+            logging.warning(f'[generate_thumbnails] creating thumbnails of {image_url} occurs error: {error}')
+
+        stats = await run_work_queue(
+            image_urls, create_thumbnails, rate=rate, max_concurrency=concurrency, on_failed=creation_failed,
+        )
+
+    pool.shutdown()
+    logging.warning(f'[generate_thumbnails] finished: {stats}, thumbnails: {thumbnail_cache.stats()}')
+
+    await read_engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create the missing thumbnails of every crawled specimen')
+    parser.add_argument(
+        '--size', action='append', choices=list(settings.thumbnail_sizes), help='Size to create. Default is all sizes',
+    )
+    parser.add_argument(
+        '--format', action='append', choices=list(IMAGE_MEDIA_TYPES), help='Format to create. Default is all formats',
+    )
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of resizing processes')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum concurrent images')
+    parser.add_argument('--rate', type=float, default=2.0, help='Maximum images per second, 0 for no limit')
+    args = parser.parse_args()
+
+    asyncio.run(main(
+        args.size or list(settings.thumbnail_sizes),
+        args.format or list(IMAGE_MEDIA_TYPES),
+        args.workers,
+        args.concurrency,
+        args.rate,
+    ))
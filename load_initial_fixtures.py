@@ -1,31 +1,243 @@
+import argparse
 import asyncio
+import datetime
+import functools
 import json
+import logging
+import multiprocessing
 import os
+import queue
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy import Date, Float
+from sqlalchemy.dialects.sqlite import insert
 
+from db.engine import async_engine
+from db.indexes import INDEX_REBUILDERS
 from db.models import Specimen
+from db.version import bump_data_version, create_data_version
 
+FIXTURE_DIR = 'fixtures'
 
-async def save_specimens(async_db_session, specimens):
-    async with async_db_session() as session:
-        async with session.begin():
+_WHITESPACE = re.compile(r'[\s,]*')
 
-            session.add_all([Specimen.model_validate(specimen) for specimen in specimens])
+# Columns loaded from the fixtures with their default values, the ids are assigned by the database
+_COLUMNS = {
+    column.name: Specimen.model_fields[column.name].default
+    for column in Specimen.__table__.columns if column.name != 'id'
+}
+_DATE_COLUMNS = {column.name for column in Specimen.__table__.columns if isinstance(column.type, Date)}
+_FLOAT_COLUMNS = {column.name for column in Specimen.__table__.columns if isinstance(column.type, Float)}
 
+# Batches decoded by the worker processes, set by the pool initializer
+_batches = None
 
-async def main():
-    async_engine = create_async_engine(url=f'sqlite+aiosqlite:///{os.environ["DB_FILENAME"]}', echo=False)
 
-    async_db_session = async_sessionmaker(async_engine, expire_on_commit=False)
+def iter_json_array(f, chunk_size=1 << 16):
+    """Yield the items of the JSON array in the file one by one, reading `chunk_size` characters at a time"""
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError(f'{f.name} is not a JSON array')
+    position = 1
+    eof = False
 
-    fixture_list = os.listdir('fixtures')
-    for fixture in fixture_list:
-        with open(f'fixtures/{fixture}') as f:
-            specimens = json.load(f)
+    while True:
+        position = _WHITESPACE.match(buffer, position).end()
+        if buffer.startswith(']', position):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The item continues in the next chunk
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+        position = end
 
-        await save_specimens(async_db_session, specimens)
+
+def normalize_specimen(row):
+    """Convert a fixture record to the values of the specimens table, instead of validating it with the model"""
+    specimen = {column: row.get(column, default) for column, default in _COLUMNS.items()}
+    for column in _DATE_COLUMNS:
+        if isinstance(specimen[column], str):
+            specimen[column] = datetime.date.fromisoformat(specimen[column]) if specimen[column] else None
+    for column in _FLOAT_COLUMNS:
+        if specimen[column] == '':
+            specimen[column] = None
+        elif specimen[column] is not None:
+            specimen[column] = float(specimen[column])
+    return specimen
+
+
+def _init_worker(batches):
+    global _batches
+    _batches = batches
+
+
+def decode_fixture(path, batch_size):
+    """Runs in the worker processes, sends the records of the fixture in batches and a None when it's finished"""
+    rows = 0
+    try:
+        batch = []
+        with open(path) as f:
+            for row in iter_json_array(f):
+                batch.append(normalize_specimen(row))
+                if len(batch) >= batch_size:
+                    _batches.put(batch)
+                    rows += len(batch)
+                    batch = []
+        if batch:
+            _batches.put(batch)
+            rows += len(batch)
+    finally:
+        _batches.put(None)
+    return rows
+
+
+async def get_batch(batches, futures, timeout=1.0):
+    """
+    Get the next batch decoded by the workers, or None when a worker finished a fixture. The queue is polled, a
+    worker which died never sends its None.
+
+    Raises:
+        Exception: the error of the decoding, or RuntimeError, when every decoding stopped and the queue is empty.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            return await loop.run_in_executor(None, functools.partial(batches.get, timeout=timeout))
+        except queue.Empty:
+            if all(future.done() for future in futures):
+                for future in futures:
+                    future.result()
+                raise RuntimeError('the decoding workers stopped without finishing their fixtures')
+
+
+def drop_deferred_schema(conn):
+    """
+    Drop the secondary indexes and the triggers of the specimens table, so they're built once after the load
+    instead of updated row by row. Returns their statements to create them again.
+    """
+    statements = conn.exec_driver_sql(
+        "SELECT type, name, sql FROM sqlite_master"
+        " WHERE tbl_name = 'specimens' AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+    ).all()
+    for statement_type, name, _ in statements:
+        conn.exec_driver_sql(f'DROP {statement_type.upper()} {name}')
+    return [sql for _, _, sql in statements]
+
+
+def restore_deferred_schema(conn, statements):
+    """
+    Create the dropped indexes and triggers again, rebuild the indexes derived from the specimens table, then bump
+    the data version once, since the load wrote the specimens while its triggers were dropped
+    """
+    for statement in statements:
+        conn.exec_driver_sql(statement)
+    for index, (create_index, rebuild_index) in INDEX_REBUILDERS.items():
+        if index != 'version':
+            create_index(conn)
+            rebuild_index(conn)
+    create_data_version(conn)
+    bump_data_version(conn)
+
+
+async def main(paths, batch_size=2000, workers=2, defer_indexes=True):
+    statement = insert(Specimen)
+    statement = statement.on_conflict_do_update(
+        index_elements=['identifier'],
+        set_={column: statement.excluded[column] for column in _COLUMNS if column != 'identifier'},
+    )
+
+    context = multiprocessing.get_context('spawn')
+    batches = context.Queue(maxsize=workers * 4)
+
+    async with async_engine.connect() as conn:
+        # Bulk load settings, restored after the load. The database stays in WAL mode, the API may be reading it,
+        # and a crash of the load only loses its last commits
+        synchronous = (await conn.exec_driver_sql('PRAGMA synchronous')).scalar()
+        await conn.exec_driver_sql('PRAGMA synchronous = NORMAL')
+        await conn.exec_driver_sql('PRAGMA cache_size = -262144')
+
+        deferred = []
+        if defer_indexes:
+            deferred = await conn.run_sync(drop_deferred_schema)
+            await conn.commit()
+
+        rows = 0
+        start = time.monotonic()
+        reported_at = start
+        try:
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(batches,),
+            ) as pool:
+                futures = [pool.submit(decode_fixture, path, batch_size) for path in paths]
+
+                finished = 0
+                try:
+                    while finished < len(paths):
+                        batch = await get_batch(batches, futures)
+                        if batch is None:
+                            finished += 1
+                            continue
+
+                        await conn.execute(statement, batch)
+                        await conn.commit()
+                        rows += len(batch)
+
+                        if time.monotonic() - reported_at >= 5:
+                            reported_at = time.monotonic()
+                            logging.warning(f'[load_initial_fixtures] {rows} rows, '
+                                            f'{rows / (reported_at - start):.0f} rows/sec')
+                except BaseException:
+                    # Unblock the workers waiting on the full queue, so the pool can shut down
+                    while finished < len(paths):
+                        try:
+                            batch = await get_batch(batches, futures)
+                        except Exception:
+                            break
+                        if batch is None:
+                            finished += 1
+                    raise
+
+                for path, future in zip(paths, futures):
+                    logging.warning(f'[load_initial_fixtures] {path}: {future.result()} rows')
+        finally:
+            if deferred:
+                build_start = time.monotonic()
+                await conn.run_sync(restore_deferred_schema, deferred)
+                await conn.commit()
+                logging.warning(f'[load_initial_fixtures] built indexes in {time.monotonic() - build_start:.1f}s')
+
+            await conn.exec_driver_sql(f'PRAGMA synchronous = {synchronous}')
+
+    elapsed = time.monotonic() - start
+    logging.warning(f'[load_initial_fixtures] loaded {rows} rows in {elapsed:.1f}s, {rows / elapsed:.0f} rows/sec')
+
+    await async_engine.dispose()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(
+        description='Load the specimen fixtures, the specimens of existing identifiers are updated',
+    )
+    parser.add_argument('paths', nargs='*', help=f'Fixture files. Default is every file in {FIXTURE_DIR}')
+    parser.add_argument('--batch-size', type=int, default=2000, help='Rows inserted per batch')
+    parser.add_argument('--workers', type=int, default=2, help='Number of decoding processes')
+    parser.add_argument(
+        '--defer-indexes', action=argparse.BooleanOptionalAction, default=True,
+        help='Drop the indexes and triggers during the load and build them once afterwards',
+    )
+    args = parser.parse_args()
+
+    paths = args.paths or [os.path.join(FIXTURE_DIR, fixture) for fixture in sorted(os.listdir(FIXTURE_DIR))]
+
+    asyncio.run(main(paths, args.batch_size, args.workers, args.defer_indexes))
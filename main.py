@@ -1,21 +1,66 @@
 import logging
 from http import HTTPStatus
 
-from fastapi import FastAPI
+import aiohttp
+from fastapi import FastAPI, Request, Response
 from contextlib import asynccontextmanager
 
+from config import settings
 from db.main import init_db
+from metrics import CONTENT_TYPE, REGISTRY, MetricsMiddleware
+from specimen.cache import ImageCache, PdfCache, ResponseCache, ThumbnailCache
 from specimen.routes import specimen_router
-from reportlab.pdfbase import pdfmetrics, ttfonts
+from specimen.utils import PdfRenderer, register_pdf_font
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logging.info("server starting")
-    pdfmetrics.registerFont(ttfonts.TTFont('openhuninn', 'jf-openhuninn-1.1.ttf'))
+    register_pdf_font()
     await init_db()
+
+    # Keep one connection pool to sinica for the whole app lifetime
+    http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=settings.http_pool_size))
+    app.state.image_cache = ImageCache(
+        directory=settings.image_cache_dir,
+        max_bytes=settings.image_cache_max_bytes,
+        ttl=settings.image_cache_ttl,
+        session=http_session,
+        failure_ttl=settings.image_cache_failure_ttl,
+    )
+    app.state.thumbnail_cache = ThumbnailCache(
+        directory=settings.thumbnail_dir,
+        max_bytes=settings.thumbnail_max_bytes,
+        ttl=settings.thumbnail_ttl,
+        image_cache=app.state.image_cache,
+        sizes=settings.thumbnail_sizes,
+        quality=settings.thumbnail_quality,
+    )
+    app.state.pdf_cache = PdfCache(
+        directory=settings.pdf_cache_dir,
+        max_bytes=settings.pdf_cache_max_bytes,
+        ttl=settings.pdf_cache_ttl,
+    )
+    app.state.response_cache = ResponseCache(
+        max_entries=settings.response_cache_max_entries,
+        max_bytes=settings.response_cache_max_bytes,
+        ttl=settings.response_cache_ttl,
+        version_ttl=settings.response_cache_version_ttl,
+    )
+    app.state.pdf_renderer = PdfRenderer(
+        max_workers=settings.pdf_render_workers,
+        max_concurrency=settings.pdf_render_concurrency,
+        max_queue=settings.pdf_render_queue_size,
+        idle_priority=settings.pdf_render_idle_priority,
+    )
     yield
     logging.info("server is shutting down")
+    app.state.pdf_renderer.shutdown()
+    logging.info(f"image cache stats: {app.state.image_cache.stats()}")
+    logging.info(f"pdf cache stats: {app.state.pdf_cache.stats()}")
+    logging.info(f"thumbnail cache stats: {app.state.thumbnail_cache.stats()}")
+    logging.info(f"response cache stats: {app.state.response_cache.stats()}")
+    await http_session.close()
 
 description = """
 simple specimen app.
@@ -42,4 +87,21 @@ app = FastAPI(
 async def index():
     return {'message': 'Hi~ This is Specimen App for specimen'}
 
+
+@app.get('/cache/', status_code=HTTPStatus.OK)
+async def cache_stats(request: Request):
+    return {
+        'responses': request.app.state.response_cache.stats(),
+        'images': request.app.state.image_cache.stats(),
+        'pdfs': request.app.state.pdf_cache.stats(),
+        'thumbnails': request.app.state.thumbnail_cache.stats(),
+    }
+
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get('/metrics', include_in_schema=False)
+    async def metrics():
+        return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
 app.include_router(specimen_router, tags=['Specimen'])
@@ -0,0 +1,370 @@
+"""
+Minimal Prometheus metrics shared by the API and the crawlers.
+
+The metrics live in the process-wide REGISTRY and are rendered in the Prometheus text format by `REGISTRY.render()`.
+The API serves them at `GET /metrics`, the crawlers serve them from a small HTTP listener or write them to a file of
+the node exporter textfile collector.
+"""
+import asyncio
+import bisect
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Sequence
+
+from aiohttp import web
+from sqlalchemy import event
+
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the latency buckets, from a fast SQLite query to a slow sinica response
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values: Dict[tuple, object] = {}
+        # The crawlers and the SQLAlchemy events may record from other threads
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} expects the labels {self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """A value which only goes up, e.g. requests or errors. Rates are computed by Prometheus"""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class Gauge(_Metric):
+    """A value which goes up and down, e.g. requests in progress"""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def _samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    """
+    Observations counted in cumulative buckets, Prometheus computes the quantiles from them.
+
+    Usage:
+        with QUERY_SECONDS.time(statement='select'):
+            ...
+    """
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # The counts of every bucket and +Inf, then the sum of the observations
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[index] += 1
+            values[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the seconds spent in the block, raised exceptions included"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        values = self._values.get(self._key(labels))
+        return sum(values[:-1]) if values else 0
+
+    def _samples(self) -> Iterator[str]:
+        for key, values in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative += count
+                labels = _format_labels(self.label_names + ('le',), key + (_format_value(bound),))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.label_names, key)
+            yield f'{self.name}_sum{labels} {_format_value(values[-1])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Registry:
+    """The metrics of a process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self, prefixes: Optional[Sequence[str]] = None) -> str:
+        """
+        Params:
+            prefixes: only render the metrics whose name starts with one of them, all metrics by default.
+
+        Returns:
+            str: the metrics in the Prometheus text format.
+        """
+        metrics = [
+            metric for name, metric in self._metrics.items()
+            if prefixes is None or name.startswith(tuple(prefixes))
+        ]
+        return ''.join(metric.render() + '\n' for metric in metrics)
+
+    def write_textfile(self, path: str, prefixes: Optional[Sequence[str]] = None) -> None:
+        """
+        Write the metrics for the node exporter textfile collector. The file is replaced atomically, so the collector
+        never reads a partial file.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write(self.render(prefixes))
+        os.replace(temporary_path, path)
+
+
+REGISTRY = Registry()
+
+# API
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'specimen_http_request_duration_seconds', 'Latency of the API requests until the last byte of the response',
+    labels=('method', 'route', 'status'),
+)
+HTTP_REQUESTS_IN_PROGRESS = REGISTRY.gauge(
+    'specimen_http_requests_in_progress', 'API requests being handled', labels=('method',),
+)
+
+# Database, the statement is the first keyword of the SQL, e.g. select
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'specimen_db_query_duration_seconds', 'Duration of the SQL statements', labels=('engine', 'statement'),
+)
+DB_QUERY_ERRORS = REGISTRY.counter(
+    'specimen_db_query_errors_total', 'SQL statements which raised', labels=('engine', 'statement'),
+)
+
+# PDFs and images
+PDF_RENDER_SECONDS = REGISTRY.histogram(
+    'specimen_pdf_render_duration_seconds', 'Duration of the PDF renders in the process pool, without the queueing',
+)
+PDF_RENDER_QUEUE_SECONDS = REGISTRY.histogram(
+    'specimen_pdf_render_queue_seconds', 'Wait of the PDF renders for a free render worker',
+)
+PDF_RENDER_REJECTED = REGISTRY.counter(
+    'specimen_pdf_render_rejected_total', 'PDF renders rejected because the render queue was full',
+)
+IMAGE_FETCH_SECONDS = REGISTRY.histogram(
+    'specimen_image_fetch_duration_seconds', 'Duration of the image downloads from sinica', labels=('outcome',),
+)
+
+# Crawlers, the stages are list, detail, parse and write
+CRAWL_STAGE_SECONDS = REGISTRY.histogram(
+    'specimen_crawl_stage_duration_seconds', 'Duration of an item of a crawl stage, a batch for the write stage',
+    labels=('stage',),
+)
+CRAWL_STAGE_ITEMS = REGISTRY.counter(
+    'specimen_crawl_stage_items_total', 'Items completed by a crawl stage, rows for the write stage', labels=('stage',),
+)
+CRAWL_STAGE_ERRORS = REGISTRY.counter(
+    'specimen_crawl_stage_errors_total', 'Failed items of a crawl stage', labels=('stage',),
+)
+CRAWL_PAGES = REGISTRY.counter(
+    'specimen_crawl_pages_total', 'Fetched specimen pages by outcome', labels=('outcome',),
+)
+
+# Metrics exported by the crawlers, the API metrics would be empty in a crawler process
+CRAWLER_METRIC_PREFIXES = ('specimen_crawl_', 'specimen_db_')
+
+
+def statement_kind(statement: str) -> str:
+    """The first keyword of a SQL statement, as a label of bounded cardinality"""
+    keyword = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+    return keyword if keyword in ('select', 'insert', 'update', 'delete', 'with', 'create', 'pragma') else 'other'
+
+
+async def start_metrics_server(host: str, port: int, prefixes: Optional[Sequence[str]] = None):
+    """
+    Serve the metrics at `GET /metrics` in the running loop, for the crawlers which have no API.
+
+    Returns:
+        AppRunner: the runner to clean up when the crawl is finished.
+    """
+    async def serve_metrics(request):
+        return web.Response(body=REGISTRY.render(prefixes).encode(), headers={'Content-Type': CONTENT_TYPE})
+
+    app = web.Application()
+    app.add_routes([web.get('/metrics', serve_metrics)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.warning(f'[metrics] serving the metrics at http://{host}:{port}/metrics')
+    return runner
+
+
+async def write_textfile_periodically(path: str, interval: float, prefixes: Optional[Sequence[str]] = None) -> None:
+    """Rewrite the textfile every `interval` seconds until it's cancelled"""
+    while True:
+        await asyncio.to_thread(REGISTRY.write_textfile, path, prefixes)
+        await asyncio.sleep(interval)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing the latency of every request, until the last body chunk is sent, so streamed
+    downloads are measured in full.
+
+    The route label is the path template of the matched route, e.g. `/specimens/{specimen_id}/`, so the label
+    values are bounded. Requests which match no route are labeled `unmatched`.
+    """
+
+    def __init__(self, app, excluded_paths: Iterable[str] = ('/metrics',)):
+        self.app = app
+        self.excluded_paths = frozenset(excluded_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.excluded_paths:
+            await self.app(scope, receive, send)
+            return
+
+        method = scope['method']
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.inc(method=method)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_PROGRESS.dec(method=method)
+            # The router stores the matched route in the scope
+            route = scope.get('route')
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                method=method,
+                route=getattr(route, 'path', 'unmatched'),
+                status=str(status),
+            )
+
+
+def instrument_engine(engine, name: str) -> None:
+    """
+    Observe the duration of every SQL statement of an engine through the SQLAlchemy cursor events.
+
+    Params:
+        engine: the Engine, or the `sync_engine` of an AsyncEngine.
+        name (str): the engine label, e.g. read or write.
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['metrics_query_start'].pop()
+        DB_QUERY_SECONDS.observe(time.perf_counter() - start, engine=name, statement=statement_kind(statement))
+
+    @event.listens_for(engine, 'handle_error')
+    def query_failed(context):
+        starts = context.connection.info.get('metrics_query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+        DB_QUERY_ERRORS.inc(engine=name, statement=statement_kind(context.statement or ''))
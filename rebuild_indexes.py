@@ -0,0 +1,27 @@
+import argparse
+import asyncio
+import logging
+
+from db.engine import async_engine
+from db.indexes import INDEX_REBUILDERS
+
+
+async def main(indexes):
+    for index in indexes:
+        create_index, rebuild_index = INDEX_REBUILDERS[index]
+        async with async_engine.begin() as conn:
+            await conn.run_sync(create_index)
+            await conn.run_sync(rebuild_index)
+        logging.warning(f'[rebuild_indexes] rebuilt {index} index')
+
+    await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the indexes derived from the specimens table')
+    parser.add_argument(
+        '--index', action='append', choices=list(INDEX_REBUILDERS), help='Index to rebuild. Default is all indexes',
+    )
+    args = parser.parse_args()
+
+    asyncio.run(main(args.index or list(INDEX_REBUILDERS)))
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+from config import settings
+from db.engine import async_db_session, async_engine
+from db.models import create_specimen_identifier
+from specimen.archive import DETAIL_PAGE, LIST_PAGE, PageArchive, read_archived_pages
+from specimen.parser import ParseError, parse_specimen
+from specimen.writer import SpecimenWriter
+
+
+def parse_archived_detail_pages(directory, entries):
+    """Runs in the worker processes, returns the parsed specimens"""
+    specimens = []
+    for entry, body in zip(entries, read_archived_pages(directory, entries)):
+        try:
+            specimens.append(parse_specimen(body.decode(entry['encoding'] or 'utf-8', errors='replace')))
+        except ParseError as e:
+            logging.warning(f'Failed to parse specimen: {entry["key"]}, error: {e}')
+    return specimens
+
+
+def parse_archived_list_pages(directory, entries):
+    """Runs in the worker processes, returns the specimen identifiers"""
+    identifiers = []
+    for entry, body in zip(entries, read_archived_pages(directory, entries)):
+        try:
+            specimen_raw_data_list = json.loads(body)
+        except ValueError:
+            continue
+        identifiers.extend(
+            create_specimen_identifier(specimen.get('id'), 'sinica') for specimen in specimen_raw_data_list.get('list', [])
+        )
+    return identifiers
+
+
+async def reparse(pool, archive, kind, parse, consume, workers, chunk_size):
+    """Parse the chunks of the archive in the pool, at most two chunks per worker are in flight"""
+    loop = asyncio.get_running_loop()
+    entries = list(archive.latest(kind))
+    window = collections.deque()
+
+    for i in range(0, len(entries), chunk_size):
+        window.append(loop.run_in_executor(pool, parse, archive.directory, entries[i:i + chunk_size]))
+        if len(window) >= workers * 2:
+            await consume(await window.popleft())
+    while window:
+        await consume(await window.popleft())
+
+    return len(entries)
+
+
+async def main(workers, chunk_size, lists):
+    archive = PageArchive(settings.page_archive_dir, settings.page_archive_segment_bytes)
+
+    async def upsert_all(specimens):
+        for specimen in specimens:
+            await writer.upsert(specimen)
+
+    start = time.monotonic()
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    async with SpecimenWriter(async_db_session, batch_size=2000) as writer:
+        if lists:
+            pages = await reparse(
+                pool, archive, LIST_PAGE, parse_archived_list_pages, writer.add_identifiers, workers, chunk_size,
+            )
+            logging.warning(f'[reparse_specimens] reparsed {pages} list pages')
+
+        pages = await reparse(
+            pool, archive, DETAIL_PAGE, parse_archived_detail_pages, upsert_all, workers, chunk_size,
+        )
+        logging.warning(f'[reparse_specimens] reparsed {pages} specimen pages')
+    pool.shutdown()
+
+    logging.warning(f'[reparse_specimens] finished in {time.monotonic() - start:.1f}s, writer: {writer.stats()}')
+
+    archive.close()
+    await async_engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse the archived sinica pages again and update the specimens')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of parser processes')
+    parser.add_argument('--chunk-size', type=int, default=200, help='Pages parsed per task')
+    parser.add_argument('--lists', action='store_true', help='Also add the specimens found in the archived list pages')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.workers, args.chunk_size, args.lists))
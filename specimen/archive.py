@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Kinds of archived pages
+LIST_PAGE = 'list'
+DETAIL_PAGE = 'detail'
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    codec TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fetches (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    status INTEGER,
+    encoding TEXT,
+    headers TEXT,
+    digest TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_fetches_kind_key ON fetches (kind, key, id);
+"""
+
+
+def compress_page(body: bytes) -> tuple[str, bytes]:
+    """Compress with zstd when zstandard is installed, zlib otherwise. Returns (codec, data)"""
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(body)
+    return 'zlib', zlib.compress(body, 9)
+
+
+def decompress_page(codec: str, data: bytes) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('the archive contains zstd pages, zstandard must be installed to read them')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class PageArchive:
+    """
+    Content-addressed archive of the raw pages fetched from sinica.
+
+    Every page body is compressed on its own and appended to a segment file `segment-NNNNNN`, a new segment is
+    started once the current one reaches `segment_max_bytes`. The index `index.db` maps the sha256 of a body to its
+    location (`blobs`) and keeps the metadata of every fetch (`fetches`), so a body fetched many times is stored once.
+    `put` blocks on the compression and the index commit, the crawlers run it in an executor.
+
+    Usage:
+        archive = PageArchive('archive')
+        archive.put(DETAIL_PAGE, '123', url, body, status=200, encoding='utf-8')
+        for entry in archive.latest(DETAIL_PAGE):
+            html = archive.read(entry).decode(entry['encoding'] or 'utf-8')
+    """
+
+    def __init__(self, directory: str, segment_max_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._index = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        self._index.execute('PRAGMA journal_mode = WAL')
+        self._index.execute('PRAGMA synchronous = NORMAL')
+        self._index.executescript(_INDEX_SCHEMA)
+
+        self._segment = self._index.execute('SELECT coalesce(max(segment), 1) FROM blobs').fetchone()[0]
+        # The current segment, opened on the first append and kept open until the next segment is started
+        self._segment_file = None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.close()
+            self._index.close()
+
+    @staticmethod
+    def segment_path(directory: str, segment: int) -> str:
+        return os.path.join(directory, f'segment-{segment:06d}')
+
+    def put(
+        self,
+        kind: str,
+        key: str,
+        url: str,
+        body: bytes,
+        status: Optional[int] = None,
+        encoding: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """
+        Archive a fetched page.
+
+        Params:
+            kind: LIST_PAGE or DETAIL_PAGE.
+            key: the list page number or the sinica id of the specimen.
+            url: the fetched url.
+            body: the raw response body.
+            status: the response status.
+            encoding: the encoding of the body.
+            headers: the response headers worth keeping.
+        Returns:
+            The sha256 digest of the body.
+        """
+        digest = hashlib.sha256(body).hexdigest()
+
+        with self._lock:
+            known = self._index.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if not known:
+                codec, data = compress_page(body)
+                offset = self._append(data)
+                self._index.execute(
+                    'INSERT INTO blobs (digest, segment, offset, length, size, codec) VALUES (?, ?, ?, ?, ?, ?)',
+                    (digest, self._segment, offset, len(data), len(body), codec),
+                )
+
+            self._index.execute(
+                'INSERT INTO fetches (kind, key, url, status, encoding, headers, digest, fetched_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, str(key), url, status, encoding, json.dumps(headers or {}), digest, time.time()),
+            )
+            self._index.commit()
+
+        return digest
+
+    def _append(self, data: bytes) -> int:
+        if self._segment_file is None:
+            self._segment_file = open(self.segment_path(self.directory, self._segment), 'ab')
+
+        offset = self._segment_file.tell()
+        if offset and offset + len(data) > self.segment_max_bytes:
+            self._segment_file.close()
+            self._segment += 1
+            self._segment_file = open(self.segment_path(self.directory, self._segment), 'ab')
+            offset = self._segment_file.tell()
+
+        # Flushed before the index commit, so the readers of the index always find the data in the segment
+        self._segment_file.write(data)
+        self._segment_file.flush()
+        return offset
+
+    def latest(self, kind: str) -> Iterator[Dict]:
+        """Yield the location of the latest fetch of every key, ordered by segment and offset for sequential reads"""
+        with self._lock:
+            rows = self._index.execute(
+                'SELECT f.key, f.url, f.status, f.encoding, f.fetched_at, b.segment, b.offset, b.length, b.codec'
+                ' FROM fetches AS f JOIN blobs AS b ON b.digest = f.digest'
+                ' WHERE f.id IN (SELECT max(id) FROM fetches WHERE kind = ? GROUP BY key)'
+                ' ORDER BY b.segment, b.offset',
+                (kind,),
+            ).fetchall()
+
+        columns = ('key', 'url', 'status', 'encoding', 'fetched_at', 'segment', 'offset', 'length', 'codec')
+        for row in rows:
+            yield dict(zip(columns, row))
+
+    def read(self, entry: Dict) -> bytes:
+        return read_archived_pages(self.directory, [entry])[0]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pages, stored, size = self._index.execute(
+                'SELECT count(*), coalesce(sum(length), 0), coalesce(sum(size), 0) FROM blobs'
+            ).fetchone()
+            fetches = self._index.execute('SELECT count(*) FROM fetches').fetchone()[0]
+        return {'pages': pages, 'fetches': fetches, 'stored_bytes': stored, 'raw_bytes': size}
+
+
+def read_archived_pages(directory: str, entries: List[Dict]) -> List[bytes]:
+    """Read the bodies of `entries` of PageArchive.latest, without the index, so that it can run in worker processes"""
+    bodies = []
+    files = {}
+    try:
+        for entry in entries:
+            if entry['segment'] not in files:
+                files[entry['segment']] = open(PageArchive.segment_path(directory, entry['segment']), 'rb')
+            f = files[entry['segment']]
+            f.seek(entry['offset'])
+            bodies.append(decompress_page(entry['codec'], f.read(entry['length'])))
+    finally:
+        for f in files.values():
+            f.close()
+    return bodies
@@ -0,0 +1,542 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable
+
+from aiohttp import ClientSession
+
+from config import settings
+from metrics import IMAGE_FETCH_SECONDS
+from specimen.crawl_utils import fetch_image_from_sinica
+from specimen.images import derivative_key, resize_image
+
+
+class DiskCache:
+    """
+    Size-bounded on-disk cache with LRU eviction and TTL.
+
+    Every entry is stored in a file named after the sha256 digest of its key, so any string can be used as a key.
+    Files that disappear behind the cache's back (e.g. removed by another process) are treated as misses.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # digest -> (size, stored_at), ordered from least to most recently used
+        self._entries: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        self._size = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        """Index the files left over by a previous run, oldest first."""
+        found = []
+        for dir_path, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                stat = os.stat(os.path.join(dir_path, filename))
+                found.append((stat.st_mtime, filename, stat.st_size))
+
+        for stored_at, digest, size in sorted(found):
+            self._entries[digest] = (size, stored_at)
+            self._size += size
+
+        self._evict()
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(self.digest(key))
+        return entry is not None and time.time() - entry[1] <= self.ttl
+
+    @staticmethod
+    def digest(key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def path(directory: str, key: str) -> str:
+        digest = DiskCache.digest(key)
+        return os.path.join(directory, digest[:2], digest)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _remove(self, digest: str) -> None:
+        size, _ = self._entries.pop(digest)
+        self._size -= size
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and self._entries:
+            digest = next(iter(self._entries))
+            self._remove(digest)
+            self.evictions += 1
+
+    def get(self, key: str) -> bytes | None:
+        """
+        Get the cached data of a key.
+
+        Params:
+            key (str): the cache key.
+
+        Returns:
+            bytes: the cached data, or None if the key is missing or expired.
+        """
+        digest = self.digest(key)
+        entry = self._entries.get(digest)
+
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            self._remove(digest)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        try:
+            with open(self._path(digest), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._entries.pop(digest)
+            self._size -= entry[0]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return data
+
+    def set(self, key: str, data: bytes) -> None:
+        """
+        Store the data of a key, evicting the least recently used entries when the cache is full.
+
+        Params:
+            key (str): the cache key.
+            data (bytes): the data to store.
+        """
+        if len(data) > self.max_bytes:
+            return
+
+        digest = self.digest(key)
+        if digest in self._entries:
+            self._remove(digest)
+
+        self._write(self._path(digest), data)
+        self._add(digest, len(data))
+
+    async def set_async(self, key: str, data: bytes) -> None:
+        """
+        Like set, with the file written in the default executor of the loop. The index of the entries is only
+        updated on the loop.
+
+        Params:
+            key (str): the cache key.
+            data (bytes): the data to store.
+        """
+        if len(data) > self.max_bytes:
+            return
+
+        digest = self.digest(key)
+        await asyncio.get_running_loop().run_in_executor(None, self._write, self._path(digest), data)
+
+        # The file of a previous entry of the key has just been replaced, only its size is forgotten
+        previous = self._entries.pop(digest, None)
+        if previous is not None:
+            self._size -= previous[0]
+        self._add(digest, len(data))
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial entry, one per thread as set_async may
+        # write the same key twice at once
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _add(self, digest: str, size: int) -> None:
+        self._entries[digest] = (size, time.time())
+        self._size += size
+        self._evict()
+
+    def delete(self, key: str) -> None:
+        digest = self.digest(key)
+        if digest in self._entries:
+            self._remove(digest)
+        else:
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class ImageUnavailable(Exception):
+    """Raised for an image whose download failed less than failure_ttl seconds ago"""
+
+
+class ImageCache(DiskCache):
+    """
+    Cache of images downloaded from sinica.
+
+    Images are downloaded through a shared client session, and concurrent requests for an image which is not
+    cached yet share a single download. A failed download is remembered for `failure_ttl` seconds, the requests
+    of the image fail at once meanwhile instead of waiting for sinica again.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float, session: ClientSession, failure_ttl: float = 0):
+        super().__init__(directory, max_bytes, ttl)
+        self.session = session
+        self.failure_ttl = failure_ttl
+        self._downloads: Dict[str, asyncio.Future] = {}
+        # url -> (failed_at, error) of the failed downloads, oldest first
+        self._failures: OrderedDict[str, tuple[float, Exception]] = OrderedDict()
+
+    async def fetch(self, url: str) -> bytes:
+        """
+        Get an image from the cache, or download it from sinica on a miss.
+
+        Params:
+            url (str): the url of the image.
+
+        Returns:
+            bytes: the image data.
+
+        Raises:
+            ImageUnavailable: if the download of the image failed less than failure_ttl seconds ago.
+        """
+        image = self.get(url)
+        if image is not None:
+            return image
+
+        failure = self._failures.get(url)
+        if failure is not None:
+            failed_at, error = failure
+            age = time.monotonic() - failed_at
+            if age < self.failure_ttl:
+                raise ImageUnavailable(f'downloading {url} failed {age:.0f}s ago: {error}') from error
+            del self._failures[url]
+
+        download = self._downloads.get(url)
+        if download is None:
+            download = asyncio.ensure_future(self._download(url))
+            self._downloads[url] = download
+            download.add_done_callback(functools.partial(self._download_done, url))
+
+        # Shield the shared download so that one cancelled request does not cancel it for the others
+        return await asyncio.shield(download)
+
+    async def _download(self, url: str) -> bytes:
+        start = time.perf_counter()
+        try:
+            image = await fetch_image_from_sinica(url, session=self.session)
+        except Exception as e:
+            IMAGE_FETCH_SECONDS.observe(time.perf_counter() - start, outcome='error')
+            self._add_failure(url, e)
+            raise
+        IMAGE_FETCH_SECONDS.observe(time.perf_counter() - start, outcome='ok')
+        try:
+            # Off the loop, a burst of downloaded images would otherwise stall every other request
+            await self.set_async(url, image)
+        except OSError as e:
+            logging.warning(f'[ImageCache] caching image {url} occurs error: {e}')
+        return image
+
+    def _download_done(self, url: str, download: asyncio.Future) -> None:
+        self._downloads.pop(url, None)
+        # Retrieve the error, it's not logged as never retrieved when all the requests waiting for it were cancelled
+        if not download.cancelled():
+            download.exception()
+
+    def _add_failure(self, url: str, error: Exception) -> None:
+        if self.failure_ttl <= 0:
+            return
+
+        now = time.monotonic()
+        self._failures.pop(url, None)
+        self._failures[url] = (now, error)
+
+        # Forget the expired failures, the oldest ones are first
+        while self._failures:
+            failed_url, (failed_at, _) = next(iter(self._failures.items()))
+            if now - failed_at < self.failure_ttl:
+                break
+            del self._failures[failed_url]
+
+
+class PdfCache(DiskCache):
+    """
+    Cache of rendered specimen PDFs.
+
+    Entries are keyed by the specimen identifier and tagged with the ETag of the row they were rendered from,
+    so a PDF of an outdated row is never served.
+    """
+
+    def get_pdf(self, identifier: str, etag: str) -> tuple[bytes, float] | None:
+        """
+        Get the cached PDF of a specimen.
+
+        Params:
+            identifier (str): the identifier of the specimen.
+            etag (str): the ETag of the current specimen row.
+
+        Returns:
+            tuple: the PDF data and the time it was rendered, or None if there is no PDF for this ETag.
+        """
+        data = self.get(identifier)
+        if data is None:
+            return None
+
+        cached_etag, rendered_at, pdf = data.split(b'\n', 2)
+        if cached_etag.decode() != etag:
+            self.hits -= 1
+            self.misses += 1
+            return None
+
+        return pdf, float(rendered_at)
+
+    async def set_pdf(self, identifier: str, etag: str, pdf: bytes) -> float:
+        """
+        Store the rendered PDF of a specimen, its file is written off the loop.
+
+        Returns:
+            float: the time the PDF was rendered.
+        """
+        rendered_at = time.time()
+        await self.set_async(identifier, f'{etag}\n{rendered_at}\n'.encode() + pdf)
+        return rendered_at
+
+
+class ThumbnailCache(DiskCache):
+    """
+    Store of the resized specimen images.
+
+    A thumbnail is created from the image of the ImageCache on its first request, concurrent requests for a
+    thumbnail which is not stored yet share a single creation. The thumbnails created by another process, e.g.
+    generate_thumbnails.py, are picked up when they're requested.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        ttl: float,
+        image_cache: ImageCache,
+        sizes: Dict[str, int],
+        quality: int,
+    ):
+        super().__init__(directory, max_bytes, ttl)
+        self.image_cache = image_cache
+        self.sizes = sizes
+        self.quality = quality
+        self._creations: Dict[str, asyncio.Future] = {}
+
+    def get(self, key: str) -> bytes | None:
+        digest = self.digest(key)
+        if digest not in self._entries:
+            try:
+                stat = os.stat(self._path(digest))
+            except FileNotFoundError:
+                pass
+            else:
+                self._entries[digest] = (stat.st_size, stat.st_mtime)
+                self._size += stat.st_size
+        return super().get(key)
+
+    async def fetch(self, image_url: str, size: str, image_format: str) -> bytes:
+        """
+        Get a thumbnail from the store, or create it on a miss.
+
+        Params:
+            image_url (str): the url of the original image.
+            size (str): a size name of `sizes`.
+            image_format (str): a format of IMAGE_MEDIA_TYPES.
+
+        Returns:
+            bytes: the thumbnail data.
+        """
+        key = derivative_key(image_url, size, image_format)
+        thumbnail = self.get(key)
+        if thumbnail is not None:
+            return thumbnail
+
+        creation = self._creations.get(key)
+        if creation is None:
+            creation = asyncio.ensure_future(self._create(key, image_url, size, image_format))
+            self._creations[key] = creation
+            creation.add_done_callback(lambda _: self._creations.pop(key, None))
+
+        # Shield the shared creation so that one cancelled request does not cancel it for the others
+        return await asyncio.shield(creation)
+
+    async def _create(self, key: str, image_url: str, size: str, image_format: str) -> bytes:
+        image = await self.image_cache.fetch(image_url)
+        thumbnails = await asyncio.get_running_loop().run_in_executor(
+            None, resize_image, image, {size: self.sizes[size]}, [image_format], self.quality,
+        )
+        thumbnail = thumbnails[(size, image_format)]
+        try:
+            self.set(key, thumbnail)
+        except OSError as e:
+            logging.warning(f'[ThumbnailCache] storing thumbnail {key!r} occurs error: {e}')
+        return thumbnail
+
+
+def invalidate_specimen_pdf(identifier: str, directory: str = settings.pdf_cache_dir) -> None:
+    """
+    Remove the cached PDF of a specimen.
+
+    It only touches the file of the specimen, so it can be used by processes that do not hold a PdfCache, e.g. the
+    crawlers.
+    """
+    try:
+        os.remove(DiskCache.path(directory, identifier))
+    except FileNotFoundError:
+        pass
+
+
+class ResponseCache:
+    """
+    Size-bounded in-memory cache of serialized API responses with LRU eviction and TTL.
+
+    Every entry is tagged with the version of the specimens data it was read at (see db/version.py), an entry of an
+    older version is dropped when it's looked up. The version is read from the database at most once every
+    `version_ttl` seconds, so a write shows up in the responses within `version_ttl` seconds.
+
+    Usage:
+        version = await cache.version(SpecimenDal(session).data_version)
+        cached = cache.get(key, version)
+        if cached is None:
+            cached = cache.set(key, version, body)
+        body, headers = cached
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float, version_ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        # key -> (version, stored_at, body, headers), ordered from least to most recently used
+        self._entries: OrderedDict[Hashable, tuple[int, float, bytes, Dict[str, str]]] = OrderedDict()
+        self._size = 0
+        self._version = None
+        self._version_read_at = 0.0
+
+    async def version(self, read_version: Callable[[], Awaitable[int]]) -> int:
+        """
+        Get the current data version, read by `read_version` when the last read is older than `version_ttl`.
+        """
+        now = time.monotonic()
+        if self._version is None or now - self._version_read_at > self.version_ttl:
+            self._version = await read_version()
+            self._version_read_at = now
+        return self._version
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, body, _ = self._entries.pop(key)
+        self._size -= len(body)
+
+    def _evict(self) -> None:
+        while (self._size > self.max_bytes or len(self._entries) > self.max_entries) and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get(self, key: Hashable, version: int) -> tuple[bytes, Dict[str, str]] | None:
+        """
+        Get the cached response of a key.
+
+        Params:
+            key (Hashable): the cache key.
+            version (int): the current data version.
+
+        Returns:
+            tuple: the body and the headers of the response, or None if the key is missing, expired or outdated.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] != version:
+            self._remove(key)
+            self.invalidations += 1
+            entry = None
+        elif entry is not None and time.monotonic() - entry[1] > self.ttl:
+            self._remove(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2], entry[3]
+
+    def set(
+        self, key: Hashable, version: int, body: bytes, headers: Dict[str, str] | None = None,
+    ) -> tuple[bytes, Dict[str, str]]:
+        """
+        Store the response of a key, evicting the least recently used entries when the cache is full.
+
+        Params:
+            key (Hashable): the cache key.
+            version (int): the data version the response was read at.
+            body (bytes): the serialized response.
+            headers (Dict): the headers of the response, the ETag of the body is added.
+
+        Returns:
+            tuple: the body and the headers of the response.
+        """
+        headers = (headers or {}) | {'ETag': f'"{hashlib.sha256(body).hexdigest()[:32]}"'}
+        if len(body) > self.max_bytes:
+            return body, headers
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (version, time.monotonic(), body, headers)
+        self._size += len(body)
+        self._evict()
+        return body, headers
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'bytes': self._size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'version': self._version,
+        }
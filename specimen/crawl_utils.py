@@ -1,4 +1,6 @@
+import asyncio
 import datetime
+import functools
 import json
 import logging
 from typing import Dict
@@ -7,7 +9,9 @@ import aiohttp
 from aiohttp import ClientSession
 from bs4 import BeautifulSoup
 
+from config import settings
 from db.models import create_specimen_identifier
+from specimen.archive import DETAIL_PAGE, LIST_PAGE, PageArchive
 from specimen.schemas import SpecimenCreate
 
 
@@ -30,21 +34,38 @@ DEFAULT_HEADERS = {
     'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
 }
 
-SINICA_BASE_URL = 'https://sinica.digitalarchives.tw'
+SINICA_BASE_URL = settings.sinica_base_url
 
+# Response headers kept with the archived pages
+ARCHIVED_HEADERS = ('content-type', 'etag', 'last-modified')
 
-async def fetch_image_from_sinica(url):
-    async with aiohttp.request(
-        'GET',
-        url,
-        headers=DEFAULT_HEADERS,
-        timeout=5,
-    ) as response:
+
+async def archive_response(archive: PageArchive | None, kind: str, key, response: aiohttp.ClientResponse):
+    if archive is None:
+        return
+    # The compression and the index commit run in a thread, not on the crawler loop
+    put = functools.partial(
+        archive.put, kind, key, str(response.url), await response.read(),
+        status=response.status,
+        encoding=response.get_encoding(),
+        headers={name: response.headers[name] for name in ARCHIVED_HEADERS if name in response.headers},
+    )
+    await asyncio.get_running_loop().run_in_executor(None, put)
+
+
+async def fetch_image_from_sinica(url, session: ClientSession | None = None):
+    if session is None:
+        request = aiohttp.request('GET', url, headers=DEFAULT_HEADERS, timeout=5)
+    else:
+        request = session.get(url, headers=DEFAULT_HEADERS, timeout=5)
+
+    async with request as response:
+        response.raise_for_status()
         image = await response.read()
         return image
 
 
-async def fetch_specimen_list_from_sinica(session: ClientSession, page: int = 1):
+async def fetch_specimen_list_from_sinica(session: ClientSession, page: int = 1, archive: PageArchive | None = None):
     async with session.post(
         url=f'{SINICA_BASE_URL}/_partial/_collection_list.php',
         data={
@@ -53,12 +74,14 @@ async def fetch_specimen_list_from_sinica(session: ClientSession, page: int = 1)
         },
         headers=DEFAULT_HEADERS | {
             'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-            'origin': 'https://sinica.digitalarchives.tw',
-            'referer': f'https://sinica.digitalarchives.tw/collection.php?type=3799&page={page}',
+            'origin': SINICA_BASE_URL,
+            'referer': f'{SINICA_BASE_URL}/collection.php?type=3799&page={page}',
         },
         timeout=7,
     ) as response:
+        response.raise_for_status()
         response_text = await response.text()
+        await archive_response(archive, LIST_PAGE, page, response)
         try:
             data = json.loads(response_text)
         except Exception as e:
@@ -68,14 +91,47 @@ async def fetch_specimen_list_from_sinica(session: ClientSession, page: int = 1)
         return data
 
 
-async def fetch_specimen_html_from_sinica(session: ClientSession, specimen_website_id):
+async def fetch_specimen_html_from_sinica(
+    session: ClientSession, specimen_website_id, archive: PageArchive | None = None,
+):
+    page = await fetch_specimen_page_from_sinica(session, specimen_website_id, archive)
+    return page['html']
+
+
+async def fetch_specimen_page_from_sinica(
+    session: ClientSession,
+    specimen_website_id,
+    archive: PageArchive | None = None,
+    etag: str | None = None,
+    last_modified: str | None = None,
+) -> Dict:
+    """
+    Fetch the specimen page, conditionally when the validators of the previous fetch are given.
+
+    Returns:
+        Dict: `html`, None when sinica answered 304 Not Modified, and the `etag` and `last_modified` validators.
+    """
+    headers = dict(DEFAULT_HEADERS)
+    if etag:
+        headers['if-none-match'] = etag
+    if last_modified:
+        headers['if-modified-since'] = last_modified
+
     async with session.get(
         url=f'{SINICA_BASE_URL}/collection_{specimen_website_id}.html',
-        headers=DEFAULT_HEADERS,
+        headers=headers,
         timeout=7,
     ) as response:
-        response_html = await response.text()
-        return response_html
+        response.raise_for_status()
+        page = {
+            'html': None,
+            'etag': response.headers.get('etag', etag),
+            'last_modified': response.headers.get('last-modified', last_modified),
+        }
+        if response.status != 304:
+            page['html'] = await response.text()
+            await archive_response(archive, DETAIL_PAGE, specimen_website_id, response)
+        return page
 
 
 def parse_specimen_from_sinica(html_text) -> Dict:
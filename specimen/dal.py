@@ -1,14 +1,71 @@
+import base64
+import datetime
+import json
+import math
+from typing import AsyncIterator, Dict, List
+
+from sqlalchemy import Integer, Select, and_, cast, func, literal_column, or_, text
 from sqlmodel.ext.asyncio.session import AsyncSession
 from db.models import Specimen
+from db.facets import FACETS, specimen_facet_counts, specimen_facet_cube
+from db.geo import KM_PER_DEGREE, specimens_rtree
+from db.search import SEARCH_FIELDS, build_match_query, specimens_fts
+from db.version import specimens_version
 from specimen.schemas import SpecimenCreate
 from sqlmodel import select
 
 
+SORT_FIELDS = ('id', 'collection_date', 'species_name')
+
+# Each map tile of a zoom level is split into CLUSTER_CELLS_PER_TILE x CLUSTER_CELLS_PER_TILE cells
+CLUSTER_CELLS_PER_TILE = 8
+
+
+def encode_cursor(sort: str, specimen: Specimen) -> str:
+    """Create an opaque cursor pointing after the specimen"""
+    value = getattr(specimen, sort)
+    if isinstance(value, datetime.date):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, specimen.id], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    """
+    Decode a cursor created by encode_cursor.
+
+    Returns:
+        tuple: the value of the sort field and the id of the last specimen of the previous page.
+
+    Raises:
+        ValueError: if the cursor is malformed or was created for another sort field.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, value, last_id = json.loads(raw)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+    if cursor_sort != sort or not isinstance(last_id, int):
+        raise ValueError(f'cursor was not created for sort={sort}')
+
+    if sort == 'collection_date' and value is not None:
+        value = datetime.date.fromisoformat(value)
+
+    return value, last_id
+
+
 class SpecimenDal:
 
     def __init__(self, session: AsyncSession):
         self.session = session
 
+    async def data_version(self) -> int:
+        """Get the version of the specimens data, which changes on every write of the specimens table"""
+        result = await self.session.exec(select(specimens_version.c.version).where(specimens_version.c.id == 1))
+
+        return result.one()
+
     async def get(self, specimen_id: int):
         """
         Get a specimen by its id.
@@ -25,6 +82,31 @@ class SpecimenDal:
 
         return result.first()
 
+    async def get_many(self, keys: List[int | str], chunk_size: int = 500) -> List[Specimen | None]:
+        """
+        Get many specimens by their ids or identifiers, with one IN query per chunk of keys.
+
+        Params:
+            keys (List[int | str]): ids, or identifiers such as `sinica-123`. Strings of digits are ids.
+            chunk_size (int): the number of keys of a query.
+
+        Returns:
+            list: the specimen of every key in the same order, None for the missing ones.
+        """
+        # isdigit() also accepts digits like '²' which int() rejects
+        keys = [int(key) if isinstance(key, int) or (key.isascii() and key.isdecimal()) else key for key in keys]
+        ids = list({key for key in keys if isinstance(key, int)})
+        identifiers = list({key for key in keys if isinstance(key, str)})
+
+        found = {}
+        for column, values in ((Specimen.id, ids), (Specimen.identifier, identifiers)):
+            for start in range(0, len(values), chunk_size):
+                result = await self.session.exec(select(Specimen).where(column.in_(values[start:start + chunk_size])))
+                for specimen in result.all():
+                    found[getattr(specimen, column.key)] = specimen
+
+        return [found.get(key) for key in keys]
+
     async def create(self, specimen: SpecimenCreate):
         """
         Create a new specimen.
@@ -59,3 +141,296 @@ class SpecimenDal:
         result = await self.session.exec(statement)
 
         return result.all()
+
+    async def page(
+        self,
+        cursor: str | None = None,
+        limit: int = 20,
+        sort: str = 'id',
+        offset: int = 0,
+        columns: List[str] | None = None,
+    ):
+        """
+        Get a page of specimens by keyset pagination, so that every page costs the same however deep it is.
+
+        Params:
+            cursor (str): the cursor returned with the previous page, or None for the first page.
+            limit (int): the limit.
+            sort (str): the field to sort by, one of SORT_FIELDS. Ties are sorted by id.
+            offset (int): the offset, only accepted without cursor for compatibility.
+            columns (List[str]): select only these columns and return rows instead of specimen objects. They must
+                include `id` and the sort field.
+
+        Returns:
+            tuple: list of specimen object and the cursor of the next page, which is None on the last page.
+
+        Raises:
+            ValueError: if the cursor is invalid, or given with an offset.
+        """
+        if cursor is not None and offset:
+            raise ValueError('offset cannot be used with cursor')
+
+        sort_column = getattr(Specimen, sort)
+        if columns:
+            # A plain Select returns rows even for a single column, where the select of sqlmodel returns scalars
+            statement = Select(*(getattr(Specimen, column) for column in columns))
+        else:
+            statement = select(Specimen)
+
+        if cursor is not None:
+            value, last_id = decode_cursor(cursor, sort)
+            if sort == 'id':
+                statement = statement.where(Specimen.id > last_id)
+            elif value is None:
+                # NULLs are sorted first by SQLite
+                statement = statement.where(or_(
+                    and_(sort_column.is_(None), Specimen.id > last_id),
+                    sort_column.is_not(None),
+                ))
+            else:
+                statement = statement.where(or_(
+                    sort_column > value,
+                    and_(sort_column == value, Specimen.id > last_id),
+                ))
+        elif offset:
+            statement = statement.offset(offset)
+
+        if sort == 'id':
+            statement = statement.order_by(Specimen.id)
+        else:
+            statement = statement.order_by(sort_column, Specimen.id)
+
+        # One more row tells whether there is a next page, so a full last page has no cursor to an empty one
+        result = await self.session.exec(statement.limit(limit + 1))
+        specimens = result.all()
+
+        next_cursor = None
+        if len(specimens) > limit:
+            specimens = specimens[:limit]
+            next_cursor = encode_cursor(sort, specimens[-1])
+
+        return specimens, next_cursor
+
+    async def search(self, query: str, offset: int = 0, limit: int = 20):
+        """
+        Search specimens by species name, scientific name, collector and area.
+
+        Params:
+            query (str): whitespace separated terms, all of them must match.
+            offset (int): the offset.
+            limit (int): the limit.
+
+        Returns:
+            list: list of specimen object, ranked by bm25. Queries with terms shorter than 3 characters can't use
+            the trigram index, they are answered by a LIKE scan ordered by id instead.
+        """
+        match_query = build_match_query(query)
+
+        if match_query is not None:
+            statement = select(Specimen).join(
+                specimens_fts, specimens_fts.c.rowid == Specimen.id
+            ).where(
+                text('specimens_fts MATCH :match_query').bindparams(match_query=match_query)
+            ).order_by(func.bm25(literal_column('specimens_fts')))
+        else:
+            statement = select(Specimen).order_by(Specimen.id)
+            for term in query.split():
+                pattern = '%{}%'.format(term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+                statement = statement.where(or_(*(
+                    getattr(Specimen, field).like(pattern, escape='\\') for field in SEARCH_FIELDS
+                )))
+
+        result = await self.session.exec(statement.offset(offset).limit(limit))
+
+        return result.all()
+
+    @staticmethod
+    def _within_bbox(statement, bbox: tuple[float, float, float, float]):
+        min_longitude, min_latitude, max_longitude, max_latitude = bbox
+        rtree = specimens_rtree.c
+        return statement.join(specimens_rtree, rtree.id == Specimen.id).where(
+            rtree.max_latitude >= min_latitude,
+            rtree.min_latitude <= max_latitude,
+            rtree.max_longitude >= min_longitude,
+            rtree.min_longitude <= max_longitude,
+            # The R*Tree stores 32-bit floats, check the exact coordinates as well
+            Specimen.latitude.between(min_latitude, max_latitude),
+            Specimen.longitude.between(min_longitude, max_longitude),
+        )
+
+    async def within_bbox(self, bbox: tuple[float, float, float, float], offset: int = 0, limit: int = 20):
+        """
+        Get the specimens inside a bounding box.
+
+        Params:
+            bbox (tuple): min longitude, min latitude, max longitude and max latitude.
+            offset (int): the offset.
+            limit (int): the limit.
+
+        Returns:
+            list: list of specimen object ordered by id.
+        """
+        statement = self._within_bbox(select(Specimen), bbox).order_by(Specimen.id)
+
+        result = await self.session.exec(statement.offset(offset).limit(limit))
+
+        return result.all()
+
+    async def within_radius(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_km: float,
+        offset: int = 0,
+        limit: int = 20,
+    ):
+        """
+        Get the specimens within a distance of a point.
+
+        The distance is approximated by an equirectangular projection around the point, which is accurate enough
+        for radiuses of a few hundred kilometers and needs no trigonometric function in SQLite.
+
+        Params:
+            latitude (float): the latitude of the point.
+            longitude (float): the longitude of the point.
+            radius_km (float): the distance in kilometers.
+            offset (int): the offset.
+            limit (int): the limit.
+
+        Returns:
+            list: list of specimen object, nearest first.
+        """
+        delta_latitude = radius_km / KM_PER_DEGREE
+        longitude_scale = max(math.cos(math.radians(latitude)), 1e-6)
+        delta_longitude = min(delta_latitude / longitude_scale, 360)
+
+        bbox = (
+            longitude - delta_longitude, latitude - delta_latitude,
+            longitude + delta_longitude, latitude + delta_latitude,
+        )
+        squared_distance = (
+            (Specimen.latitude - latitude) * (Specimen.latitude - latitude)
+            + (Specimen.longitude - longitude) * (Specimen.longitude - longitude) * longitude_scale ** 2
+        )
+
+        statement = self._within_bbox(select(Specimen), bbox).where(
+            squared_distance <= delta_latitude ** 2
+        ).order_by(squared_distance, Specimen.id)
+
+        result = await self.session.exec(statement.offset(offset).limit(limit))
+
+        return result.all()
+
+    async def clusters(self, bbox: tuple[float, float, float, float], zoom: int) -> List[Dict]:
+        """
+        Count the specimens inside a bounding box per grid cell, so that maps don't need every single specimen.
+
+        Params:
+            bbox (tuple): min longitude, min latitude, max longitude and max latitude.
+            zoom (int): the map zoom level, each level halves the cell size.
+
+        Returns:
+            list: the count, the average coordinates and the bounds of every non-empty cell.
+        """
+        cell_size = 360 / 2 ** zoom / CLUSTER_CELLS_PER_TILE
+        cell_x = cast((Specimen.longitude + 180) / cell_size, Integer)
+        cell_y = cast((Specimen.latitude + 90) / cell_size, Integer)
+
+        statement = self._within_bbox(
+            select(func.count(), func.avg(Specimen.latitude), func.avg(Specimen.longitude), cell_x, cell_y), bbox
+        ).group_by(cell_x, cell_y)
+
+        result = await self.session.exec(statement)
+
+        return [
+            {
+                'count': count,
+                'latitude': latitude,
+                'longitude': longitude,
+                'min_latitude': y * cell_size - 90,
+                'min_longitude': x * cell_size - 180,
+                'max_latitude': (y + 1) * cell_size - 90,
+                'max_longitude': (x + 1) * cell_size - 180,
+            } for count, latitude, longitude, x, y in result.all()
+        ]
+
+    async def facets(self, filters: Dict | None = None, size: int = 20) -> Dict[str, List[Dict]]:
+        """
+        Get the specimen counts per value of every facet from the facet summary tables.
+
+        Params:
+            filters (Dict): facet values the specimens must have. The counts of a facet are filtered by the other
+                facets only, so that the other values of a filtered facet are still listed.
+            size (int): the maximum number of values per facet.
+
+        Returns:
+            Dict: the values of every facet with their counts, most frequent first.
+        """
+        filters = filters or {}
+        facets = {}
+
+        for facet in FACETS:
+            other_filters = {field: value for field, value in filters.items() if field != facet}
+
+            if other_filters:
+                cube = specimen_facet_cube.c
+                count = func.sum(cube.count)
+                statement = select(cube[facet], count).where(
+                    *(cube[field] == value for field, value in other_filters.items())
+                ).group_by(cube[facet]).order_by(count.desc(), cube[facet])
+            else:
+                counts = specimen_facet_counts.c
+                statement = select(counts.value, counts.count).where(
+                    counts.facet == facet
+                ).order_by(counts.count.desc(), counts.value)
+
+            result = await self.session.exec(statement.limit(size))
+            facets[facet] = [{'value': value, 'count': count} for value, count in result.all()]
+
+        return facets
+
+    async def iter_batches(
+        self,
+        ids: List[int] | None = None,
+        filters: Dict | None = None,
+        batch_size: int = 100,
+    ) -> AsyncIterator[List[Specimen]]:
+        """
+        Iterate specimens batch by batch, so that any number of specimens can be handled in bounded memory. The
+        session is closed after every batch, so its connection goes back to the pool while the consumer handles the
+        batch, e.g. renders its PDFs.
+
+        Params:
+            ids (List[int]): the ids of the specimens. The specimens keep the same order, missing ids are skipped.
+            filters (Dict): field values the specimens must equal, used when ids is not provided.
+            batch_size (int): the number of specimens of a batch.
+
+        Returns:
+            AsyncIterator: lists of specimen object.
+        """
+        if ids is not None:
+            for start in range(0, len(ids), batch_size):
+                chunk = ids[start:start + batch_size]
+                result = await self.session.exec(select(Specimen).where(Specimen.id.in_(chunk)))
+                found = {specimen.id: specimen for specimen in result.all()}
+                batch = [found[specimen_id] for specimen_id in chunk if specimen_id in found]
+                await self.session.close()
+                if batch:
+                    yield batch
+            return
+
+        last_id = 0
+        while True:
+            statement = select(Specimen).where(Specimen.id > last_id)
+            for field, value in (filters or {}).items():
+                statement = statement.where(getattr(Specimen, field) == value)
+            statement = statement.order_by(Specimen.id).limit(batch_size)
+
+            result = await self.session.exec(statement)
+            batch = result.all()
+            await self.session.close()
+            if not batch:
+                return
+
+            yield batch
+            last_id = batch[-1].id
@@ -0,0 +1,164 @@
+import csv
+import datetime
+import io
+import json
+import zlib
+from typing import AsyncIterator, Dict, List
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from db.models import Specimen, SpecimenBase
+from specimen.utils import StreamSink
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The exported columns follow the model, so the exports never drift from the schema
+EXPORT_COLUMNS = ['id', 'identifier', *SpecimenBase.model_fields]
+
+EXPORT_MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+EXPORT_COMPRESSIONS = ('gzip', 'zstd')
+
+
+class ExportUnavailable(Exception):
+    """Raised when the optional dependency of an export format or compression is not installed"""
+
+
+def check_export_support(export_format: str, compression: str | None = None) -> None:
+    """
+    Check that the dependencies of an export format and compression are installed.
+
+    Raises:
+        ExportUnavailable: if a dependency is missing.
+    """
+    if export_format == 'parquet' and pyarrow is None:
+        raise ExportUnavailable('parquet export requires pyarrow to be installed')
+    if compression == 'zstd' and zstandard is None:
+        raise ExportUnavailable('zstd compression requires zstandard to be installed')
+
+
+def export_filename(export_format: str, compression: str | None = None) -> str:
+    extension = {'gzip': '.gz', 'zstd': '.zst'}.get(compression, '') if export_format != 'parquet' else ''
+    return f'specimens.{export_format}{extension}'
+
+
+async def iter_specimen_rows(
+    session: AsyncSession,
+    filters: Dict | None = None,
+    batch_size: int = 1000,
+) -> AsyncIterator[List[Dict]]:
+    """
+    Iterate the specimens through a server-side cursor, batch by batch.
+
+    Params:
+        session (AsyncSession): the session which runs the query.
+        filters (Dict): field values the specimens must equal.
+        batch_size (int): the number of rows of a batch.
+
+    Returns:
+        AsyncIterator: lists of rows with EXPORT_COLUMNS keys.
+    """
+    statement = select(*(getattr(Specimen, column) for column in EXPORT_COLUMNS))
+    for field, value in (filters or {}).items():
+        statement = statement.where(getattr(Specimen, field) == value)
+    statement = statement.order_by(Specimen.id).execution_options(yield_per=batch_size)
+
+    result = await session.stream(statement)
+    async for partition in result.mappings().partitions(batch_size):
+        yield [dict(row) for row in partition]
+
+
+def _json_default(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+
+def _encode_ndjson(rows: List[Dict]) -> bytes:
+    return ''.join(json.dumps(row, ensure_ascii=False, default=_json_default) + '\n' for row in rows).encode('utf-8')
+
+
+def _encode_csv(rows: List[Dict], header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def _parquet_schema():
+    types = {str: pyarrow.string(), int: pyarrow.int64(), float: pyarrow.float64(), datetime.date: pyarrow.date32()}
+    fields = [pyarrow.field('id', pyarrow.int64()), pyarrow.field('identifier', pyarrow.string())]
+    for name, field in SpecimenBase.model_fields.items():
+        annotation = field.annotation
+        nullable = getattr(annotation, '__args__', None) is not None
+        base_type = next(arg for arg in annotation.__args__ if arg is not type(None)) if nullable else annotation
+        fields.append(pyarrow.field(name, types[base_type]))
+    return pyarrow.schema(fields)
+
+
+async def stream_export(
+    row_batches: AsyncIterator[List[Dict]],
+    export_format: str,
+    compression: str | None = None,
+) -> AsyncIterator[bytes]:
+    """
+    Encode batches of rows to an export format, in constant memory.
+
+    Params:
+        row_batches (AsyncIterator): batches of rows from iter_specimen_rows.
+        export_format (str): one of EXPORT_MEDIA_TYPES.
+        compression (str): one of EXPORT_COMPRESSIONS, or None. Parquet files use it as their column codec.
+
+    Returns:
+        AsyncIterator: chunks of the exported file.
+    """
+    check_export_support(export_format, compression)
+
+    if export_format == 'parquet':
+        sink = StreamSink()
+        with pyarrow.parquet.ParquetWriter(sink, _parquet_schema(), compression=compression or 'snappy') as writer:
+            async for rows in row_batches:
+                writer.write_table(pyarrow.Table.from_pylist(rows, schema=writer.schema))
+                yield sink.drain()
+        yield sink.drain()
+        return
+
+    if compression == 'gzip':
+        compressor = zlib.compressobj(wbits=31)
+    elif compression == 'zstd':
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = None
+
+    header = True
+    async for rows in row_batches:
+        if export_format == 'csv':
+            data = _encode_csv(rows, header)
+            header = False
+        else:
+            data = _encode_ndjson(rows)
+        yield compressor.compress(data) if compressor is not None else data
+
+    if export_format == 'csv' and header:
+        data = _encode_csv([], header)
+        yield compressor.compress(data) if compressor is not None else data
+
+    if compressor is not None:
+        yield compressor.flush()
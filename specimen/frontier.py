@@ -0,0 +1,246 @@
+import array
+import bisect
+import datetime
+from typing import Dict, Iterable, List
+
+from sqlalchemy import case, func, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from db.models import CrawlState, Specimen
+from specimen.writer import SpecimenWriter
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class CrawlFrontier:
+    """
+    Persistent crawl state of the specimen pages, kept in the `crawl_state` table.
+
+    A specimen is `pending` until it's claimed, `in_flight` while it's crawled, then `done`, or back to `pending`
+    with an exponential delay when the crawl failed. After `max_attempts` failed crawls in a row it's `failed` and
+    never claimed again. `done` specimens are claimed again to be refreshed once they're older than the given age,
+    with the validators of their last fetch. The state is written through the SpecimenWriter, in the same
+    transaction as the specimen data.
+
+    Only one crawler is expected to run at a time, the specimens left `in_flight` by a crawler which died are
+    claimable again after `recover`.
+
+    Usage:
+        frontier = CrawlFrontier(async_db_session, writer)
+        await frontier.recover()
+        for identifier in await frontier.claim(100):
+            ...
+            await frontier.done(identifier)
+    """
+
+    def __init__(
+        self,
+        async_db_session: async_sessionmaker[AsyncSession],
+        writer: SpecimenWriter,
+        max_attempts: int = 5,
+        retry_delay: float = 3600.0,
+    ):
+        self.async_db_session = async_db_session
+        self.writer = writer
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        # Attempts and validators of the claimed specimens, and every specimen claimed in this run
+        self._claimed = {}
+        self._seen = set()
+
+    async def recover(self) -> None:
+        """
+        Add the specimens which have no crawl state yet and release the specimens left in flight by the previous run.
+        """
+        async with self.async_db_session() as session:
+            async with session.begin():
+                # Specimens created before the crawl state existed or written by another process, e.g. the fixture
+                # load, crawled ones have a species name. Only their rows are written, not one per specimen every run
+                specimens = Specimen.__table__
+                states = select(
+                    specimens.c.identifier,
+                    case((specimens.c.species_name == '', PENDING), else_=DONE),
+                ).where(specimens.c.identifier.not_in(select(CrawlState.identifier)))
+                await session.execute(
+                    insert(CrawlState).from_select(['identifier', 'status'], states).on_conflict_do_nothing()
+                )
+                await session.execute(
+                    update(CrawlState).where(CrawlState.status == IN_FLIGHT).values(status=PENDING)
+                )
+
+    async def claim(self, limit: int, fetched_before: datetime.datetime | None = None) -> List[str]:
+        """
+        Mark at most `limit` specimens as in flight and return their identifiers.
+
+        Params:
+            limit: the maximum number of specimens.
+            fetched_before: claim the done specimens last fetched before this time to refresh them, instead of the
+                pending specimens whose next attempt is due.
+        """
+        if fetched_before is None:
+            eligible = select(CrawlState.identifier).where(
+                CrawlState.status == PENDING,
+                CrawlState.next_attempt_at <= utcnow(),
+            ).order_by(CrawlState.next_attempt_at)
+        else:
+            eligible = select(CrawlState.identifier).where(
+                CrawlState.status == DONE,
+                or_(CrawlState.last_fetched_at.is_(None), CrawlState.last_fetched_at <= fetched_before),
+            ).order_by(CrawlState.last_fetched_at)
+
+        statement = update(CrawlState).where(CrawlState.identifier.in_(eligible.limit(limit))).values(
+            status=IN_FLIGHT,
+            attempts=CrawlState.attempts + 1,
+        ).returning(
+            CrawlState.identifier, CrawlState.attempts, CrawlState.etag, CrawlState.last_modified,
+            CrawlState.content_hash,
+        )
+
+        async with self.async_db_session() as session:
+            async with session.begin():
+                result = await session.execute(statement)
+                claimed = {row.identifier: row._asdict() for row in result}
+
+        self._claimed.update(claimed)
+        self._seen.update(claimed)
+        return list(claimed)
+
+    async def claim_found(
+        self,
+        identifiers: Iterable[str],
+        fetched_before: datetime.datetime | None = None,
+    ) -> List[str]:
+        """
+        Claim the specimens found by the list crawl of the same run, which have to be crawled: the new ones and the
+        pending ones whose next attempt is due. Done specimens are claimed only when they were last fetched before
+        `fetched_before`, failed specimens and the specimens already claimed in this run are left alone.
+
+        Params:
+            identifiers: the specimens of a list page.
+            fetched_before: also claim the done specimens last fetched before this time, to refresh them.
+
+        Returns:
+            List: the claimed identifiers, in the order of `identifiers`.
+        """
+        identifiers = [identifier for identifier in dict.fromkeys(identifiers) if identifier not in self._seen]
+        if not identifiers:
+            return []
+
+        eligible = (CrawlState.status == PENDING) & (CrawlState.next_attempt_at <= utcnow())
+        if fetched_before is not None:
+            eligible |= (CrawlState.status == DONE) & or_(
+                CrawlState.last_fetched_at.is_(None), CrawlState.last_fetched_at <= fetched_before,
+            )
+        statement = update(CrawlState).where(CrawlState.identifier.in_(identifiers), eligible).values(
+            status=IN_FLIGHT,
+            attempts=CrawlState.attempts + 1,
+        ).returning(
+            CrawlState.identifier, CrawlState.attempts, CrawlState.etag, CrawlState.last_modified,
+            CrawlState.content_hash,
+        )
+
+        async with self.async_db_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    select(CrawlState.identifier).where(CrawlState.identifier.in_(identifiers))
+                )
+                existing = set(result.scalars())
+                result = await session.execute(statement)
+                claimed = {row.identifier: row._asdict() for row in result}
+
+        # The new specimens get their crawl state from the writer, with the specimen row
+        for identifier in identifiers:
+            if identifier not in existing:
+                claimed[identifier] = {'attempts': 1}
+
+        self._claimed.update(claimed)
+        self._seen.update(claimed)
+        return [identifier for identifier in identifiers if identifier in claimed]
+
+    def validators(self, identifier: str) -> Dict:
+        """The `etag`, `last_modified` and `content_hash` of the last fetch of a claimed specimen"""
+        claimed = self._claimed.get(identifier, {})
+        return {field: claimed.get(field) for field in ('etag', 'last_modified', 'content_hash')}
+
+    async def done(self, identifier: str, **validators) -> None:
+        """Mark the specimen as crawled, with the `etag`, `last_modified` and `content_hash` of the fetched page"""
+        await self.writer.update_crawl_state({
+            'identifier': identifier,
+            'status': DONE,
+            'attempts': 0,
+            'last_error': '',
+            'last_fetched_at': utcnow(),
+        } | validators)
+        self._claimed.pop(identifier, None)
+
+    async def failed(self, identifier: str, error: Exception | str) -> None:
+        """Schedule the next attempt of the specimen, or give up after `max_attempts`"""
+        attempts = self._claimed.pop(identifier, {}).get('attempts', self.max_attempts)
+        await self.writer.update_crawl_state({
+            'identifier': identifier,
+            'status': FAILED if attempts >= self.max_attempts else PENDING,
+            'attempts': attempts,
+            'last_error': str(error)[:500],
+            'next_attempt_at': utcnow() + datetime.timedelta(seconds=self.retry_delay * 2 ** (attempts - 1)),
+        })
+
+    async def stats(self) -> Dict:
+        async with self.async_db_session() as session:
+            result = await session.execute(
+                select(CrawlState.status, func.count()).group_by(CrawlState.status)
+            )
+            return dict(result.all())
+
+
+class KnownSinicaIds:
+    """
+    Compact in-memory set of the sinica ids already in the database, to drop known specimens of the list pages
+    without a query.
+
+    The ids loaded at start-up are kept as a sorted array of 8-byte integers searched by bisection, the ids added
+    afterwards in a small set.
+
+    Usage:
+        known = await KnownSinicaIds.load(async_db_session)
+        new_ids = known.add_new(page_ids)
+    """
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self._loaded = array.array('q', sorted(ids))
+        self._added = set()
+
+    @classmethod
+    async def load(cls, async_db_session: async_sessionmaker[AsyncSession]) -> 'KnownSinicaIds':
+        ids = array.array('q')
+        async with async_db_session() as session:
+            result = await session.stream_scalars(select(Specimen.identifier).execution_options(yield_per=10000))
+            async for identifier in result:
+                website, _, external_identifier = identifier.partition('-')
+                if website == 'sinica' and external_identifier.isdigit():
+                    ids.append(int(external_identifier))
+        return cls(ids)
+
+    def __len__(self) -> int:
+        return len(self._loaded) + len(self._added)
+
+    def __contains__(self, sinica_id: int) -> bool:
+        i = bisect.bisect_left(self._loaded, sinica_id)
+        return (i < len(self._loaded) and self._loaded[i] == sinica_id) or sinica_id in self._added
+
+    def add_new(self, sinica_ids: Iterable[int | str]) -> List[int]:
+        """Add the ids and return the ones which were not known yet"""
+        new_ids = []
+        for sinica_id in map(int, sinica_ids):
+            if sinica_id not in self:
+                self._added.add(sinica_id)
+                new_ids.append(sinica_id)
+        return new_ids
@@ -0,0 +1,57 @@
+import io
+from typing import Dict, Iterable
+
+from PIL import Image, ImageOps
+
+# Formats of the resized specimen images
+IMAGE_MEDIA_TYPES = {
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+
+def derivative_key(image_url: str, size: str, image_format: str) -> str:
+    """Cache key of a resized image, a new image url gets new derivatives"""
+    return f'{image_url}\n{size}\n{image_format}'
+
+
+def _encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == 'jpeg':
+        image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, format='WEBP', quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def resize_image(
+    image_bytes: bytes,
+    sizes: Dict[str, int],
+    formats: Iterable[str],
+    quality: int = 80,
+) -> Dict[tuple[str, str], bytes]:
+    """
+    Create the resized derivatives of an image, it's decoded once for all of them. It's CPU bound, so it runs in a
+    thread or a worker process.
+
+    Params:
+        image_bytes (bytes): the original image.
+        sizes (Dict[str, int]): the maximum width and height of every size name. Images are never enlarged.
+        formats (Iterable[str]): formats of IMAGE_MEDIA_TYPES.
+        quality (int): the encoder quality.
+
+    Returns:
+        Dict: the data of every (size, format).
+    """
+    with Image.open(io.BytesIO(image_bytes)) as original:
+        # Large JPEGs are decoded at a reduced scale directly, which is much faster than decoding them in full
+        original.draft('RGB', (max(sizes.values()), max(sizes.values())))
+        image = ImageOps.exif_transpose(original).convert('RGB')
+
+    derivatives = {}
+    # Resize from the largest size down, each size is resized from the previous one
+    for size, max_side in sorted(sizes.items(), key=lambda item: -item[1]):
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        for image_format in formats:
+            derivatives[(size, image_format)] = _encode(image, image_format, quality)
+    return derivatives
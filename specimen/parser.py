@@ -0,0 +1,206 @@
+import datetime
+from html.parser import HTMLParser
+from typing import Dict, List
+
+from db.models import create_specimen_identifier
+from specimen.crawl_utils import SINICA_SPECIMEN_FIELD_MAPPING, SINICA_SPECIMEN_V2_FIELD_MAPPING
+from specimen.schemas import SpecimenCreate
+
+
+# Elements which never have content, they are closed as soon as they are opened
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'meta', 'param', 'source',
+    'track', 'wbr',
+])
+
+SINICA_COLLECTION_URL = 'https://sinica.digitalarchives.tw/collection_'
+
+
+class ParseError(Exception):
+    """Raised when a specimen page matches none of the known layouts"""
+
+
+class SinicaPage(HTMLParser):
+    """
+    Collect in a single pass everything the specimen parsers need from a sinica page: the text of every <dd>, the
+    quote textarea, the og:image and og:url metas and the collection title.
+
+    Texts are collected the way BeautifulSoup's get_text() would, including the text of nested elements.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.dd_texts: List[str] = []
+        self.quote: str | None = None
+        self.title: str | None = None
+        self.og_image: Dict | None = None
+        self.og_url: Dict | None = None
+
+        self._quote_found = False
+        # Open elements as (tag, list collecting its text or None)
+        self._stack: List[tuple[str, List[str] | None]] = []
+        self._dd_parts: List[List[str]] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            self.handle_startendtag(tag, attrs)
+            return
+
+        parts = None
+        if tag == 'dd':
+            parts = []
+            self._dd_parts.append(parts)
+        elif tag == 'h1' and self.title is None and dict(attrs).get('id') == 'collection-title':
+            parts = []
+            self.title = parts
+        elif tag == 'div' and not self._quote_found and ' '.join((dict(attrs).get('class') or '').split()) == 'set quote':
+            self._quote_found = True
+            tag = 'div.quote'
+        elif tag == 'textarea' and self.quote is None and any(open_tag == 'div.quote' for open_tag, _ in self._stack):
+            parts = []
+            self.quote = parts
+
+        self._stack.append((tag, parts))
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == 'meta':
+            attributes = dict(attrs)
+            if attributes.get('property') == 'og:image' and self.og_image is None:
+                self.og_image = attributes
+            elif attributes.get('property') == 'og:url' and self.og_url is None:
+                self.og_url = attributes
+
+    def handle_endtag(self, tag):
+        # Close the most recent matching element and everything opened after it, unmatched end tags are ignored
+        for index in range(len(self._stack) - 1, -1, -1):
+            open_tag = self._stack[index][0]
+            if open_tag == tag or (open_tag == 'div.quote' and tag == 'div'):
+                del self._stack[index:]
+                return
+
+    def handle_data(self, data):
+        for _, parts in self._stack:
+            if parts is not None:
+                parts.append(data)
+
+    def close(self):
+        super().close()
+        self.dd_texts = [''.join(parts) for parts in self._dd_parts]
+        if self.title is not None:
+            self.title = ''.join(self.title)
+        if self.quote is not None:
+            self.quote = ''.join(self.quote)
+
+
+def _common_fields(page: SinicaPage, specimen: SpecimenCreate) -> None:
+    if page.quote is not None:
+        specimen.reference = page.quote.split(SINICA_COLLECTION_URL)[0]
+
+    if page.og_image is not None:
+        specimen.image_url = page.og_image['content']
+
+    specimen_sinica_id = page.og_url['content'].split('/')[-1].replace('collection_', '').replace('.html', '')
+
+    specimen.identifier = create_specimen_identifier(
+        external_identifier=specimen_sinica_id,
+        website='sinica'
+    )
+
+
+def _extract_v1(page: SinicaPage) -> SpecimenCreate:
+    specimen = SpecimenCreate()
+
+    for raw_text in page.dd_texts:
+        for parse_field_name, db_field_name in SINICA_SPECIMEN_FIELD_MAPPING.items():
+            if parse_field_name in raw_text:
+                db_value = raw_text.split(':')[1].strip()
+                if db_field_name == 'collection_date':
+                    db_value = datetime.datetime.strptime(db_value, '%Y-%m-%d').date()
+                setattr(specimen, db_field_name, db_value)
+                break
+
+    _common_fields(page, specimen)
+    return specimen
+
+
+def _extract_v2(page: SinicaPage) -> SpecimenCreate:
+    specimen = SpecimenCreate()
+
+    for raw_text in page.dd_texts:
+        raw_text = raw_text.replace('：', ':')
+
+        # A bare date is the collection date, strptime accepts 8 to 10 characters starting with the year
+        if 8 <= len(raw_text) <= 10 and raw_text[0].isdigit():
+            try:
+                specimen.collection_date = datetime.datetime.strptime(raw_text, '%Y-%m-%d').date()
+            except ValueError:
+                pass
+
+        for parse_field_name, db_field_name in SINICA_SPECIMEN_V2_FIELD_MAPPING.items():
+            if parse_field_name in raw_text:
+                db_value = raw_text.split(':')[1].strip()
+                setattr(specimen, db_field_name, db_value)
+                break
+            elif '經緯度' in raw_text:
+                lat, long = raw_text.split(':')[1].strip().split(' ')[:2]
+                specimen.latitude = lat
+                specimen.longitude = long
+            elif '海拔:' in raw_text:
+                raw_text = raw_text.replace('海拔:', '')
+                specimen.minimum_altitude = raw_text.split('-')[0]
+
+    _common_fields(page, specimen)
+    specimen.species_name = page.title
+    return specimen
+
+
+def extract_specimen(page: SinicaPage) -> tuple[str, SpecimenCreate]:
+    """
+    Detect the layout of a specimen page and extract its fields, the page is extracted once per layout tried.
+
+    The v1 layout is the labelled `名稱:值` list. Pages which don't fit it are v2 pages with full-width colons and
+    bare dates, identified by their collection title.
+
+    Returns:
+        tuple: the layout, `v1` or `v2`, and the extracted specimen.
+
+    Raises:
+        ParseError: if the page fits no layout.
+    """
+    if page.og_url is None or 'content' not in page.og_url:
+        raise ParseError('missing og:url')
+
+    try:
+        return 'v1', _extract_v1(page)
+    except Exception:
+        if page.title is None:
+            raise ParseError('page is neither v1 nor v2 layout')
+
+    try:
+        return 'v2', _extract_v2(page)
+    except Exception as e:
+        raise ParseError(str(e)) from e
+
+
+def parse_specimen(html_text: str) -> Dict:
+    """
+    Parse a sinica specimen page of any layout.
+
+    The page is tokenized once, then the fields are extracted from the collected texts according to the layout.
+    The result is the same as trying parse_specimen_from_sinica then parse_specimen_from_sinica_v2.
+
+    Params:
+        html_text (str): the html of the specimen page.
+
+    Returns:
+        Dict: the specimen data.
+
+    Raises:
+        ParseError: if the page can't be parsed.
+    """
+    page = SinicaPage()
+    page.feed(html_text)
+    page.close()
+
+    _, specimen = extract_specimen(page)
+    return specimen.model_dump()
@@ -0,0 +1,327 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import time
+from concurrent.futures import Executor
+from typing import Dict, Iterable, Optional
+
+from aiohttp import ClientSession
+
+from db.models import create_specimen_identifier
+from metrics import CRAWL_PAGES, CRAWL_STAGE_ERRORS, CRAWL_STAGE_ITEMS, CRAWL_STAGE_SECONDS
+from specimen.archive import PageArchive
+from specimen.crawl_utils import fetch_specimen_list_from_sinica, fetch_specimen_page_from_sinica
+from specimen.frontier import CrawlFrontier, KnownSinicaIds
+from specimen.parser import ParseError, parse_specimen
+from specimen.scheduler import AdaptiveConcurrency, TokenBucket, call_with_retries, run_work_queue
+from specimen.writer import SpecimenWriter
+
+# Sentinel closing a stage queue
+_STOP = object()
+
+
+class StageCounter:
+    """Throughput counters of a pipeline stage, mirrored to the crawl stage metrics"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.items = 0
+        self.errors = 0
+        self.busy_time = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.busy_time += seconds
+        CRAWL_STAGE_SECONDS.observe(seconds, stage=self.stage)
+
+    def add_item(self) -> None:
+        self.items += 1
+        CRAWL_STAGE_ITEMS.inc(stage=self.stage)
+
+    def add_error(self) -> None:
+        self.errors += 1
+        CRAWL_STAGE_ERRORS.inc(stage=self.stage)
+
+    def stats(self, elapsed: float) -> Dict:
+        return {
+            'items': self.items,
+            'errors': self.errors,
+            'items_per_second': self.items / elapsed if elapsed else 0.0,
+            'busy_seconds': round(self.busy_time, 3),
+        }
+
+
+class CrawlPipeline:
+    """
+    Streaming crawl of sinica: list pages -> detail pages -> parse -> batched write.
+
+    The stages are connected by bounded queues, a full queue blocks the stage before it, so the list crawl never
+    runs far ahead of the detail crawl and the detail crawl never runs ahead of the parser or the writer. The
+    detail pages of the specimens found in a list page are fetched as soon as that page arrives. List and detail
+    requests share one rate limit.
+
+    The stages to run are chosen by `run`: list pages only (new specimens are added as pending), claimed specimens
+    only, or both.
+
+    Usage:
+        pipeline = CrawlPipeline(session, writer, frontier, parse_pool, rate=2.0)
+        await pipeline.run(pages=range(1, 101), identifiers=await frontier.claim(100))
+    """
+
+    def __init__(
+        self,
+        session: ClientSession,
+        writer: SpecimenWriter,
+        frontier: Optional[CrawlFrontier],
+        parse_pool: Optional[Executor],
+        archive: Optional[PageArchive] = None,
+        rate: float = 2.0,
+        concurrency: int = 8,
+        parse_workers: int = 2,
+        queue_size: int = 1000,
+        test_mode: bool = False,
+    ):
+        self.session = session
+        self.writer = writer
+        self.frontier = frontier
+        self.parse_pool = parse_pool
+        self.archive = archive
+        self.concurrency = concurrency
+        # Without a pool the pages are parsed by a single task in the event loop
+        self.parse_workers = max(1, parse_workers) if parse_pool is not None else 1
+        self.test_mode = test_mode
+
+        self.bucket = TokenBucket(0 if test_mode else rate)
+        self.counters = {stage: StageCounter(stage) for stage in ('list', 'detail', 'parse')}
+        # Detail pages skipped by the refresh, updated and failed to parse
+        self.outcomes = {'not_modified': 0, 'unchanged': 0, 'updated': 0, 'parse_failed': 0}
+
+        self._detail_queue = asyncio.Queue(maxsize=queue_size)
+        self._parse_queue = asyncio.Queue(maxsize=self.parse_workers * 4)
+        self._new_counts = {}
+        self._crawl_details = False
+        self._fetched_before = None
+        self._started_at = None
+
+    def stats(self) -> Dict:
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            'elapsed': elapsed,
+            'stages': {stage: counter.stats(elapsed) for stage, counter in self.counters.items()} | {
+                'write': self.writer.stats(),
+            },
+            'queues': {'detail': self._detail_queue.qsize(), 'parse': self._parse_queue.qsize()},
+            'pages': self.outcomes,
+        }
+
+    async def run(
+        self,
+        pages: Optional[Iterable[int]] = None,
+        identifiers: Iterable[str] = (),
+        known: Optional[KnownSinicaIds] = None,
+        stop_after: int = 3,
+        crawl_details: bool = True,
+        fetched_before: Optional[datetime.datetime] = None,
+        report_interval: float = 10.0,
+    ) -> Dict:
+        """
+        Params:
+            pages: the list pages to crawl, None to crawl no list page.
+            identifiers: the claimed specimens to crawl, before the ones found in the list pages.
+            known: the known sinica ids, for the incremental list crawl which stops after `stop_after` pages
+                without new specimens.
+            stop_after: see `known`.
+            crawl_details: False to only add the specimens found in the list pages.
+            fetched_before: also crawl the done specimens of the list pages last fetched before this time.
+            report_interval: the seconds between progress logs.
+        Returns:
+            Dict: the stats of the stages.
+        """
+        self._started_at = time.monotonic()
+        self._crawl_details = crawl_details
+        self._fetched_before = fetched_before
+        reporter = asyncio.create_task(self._report(report_interval))
+
+        detail_workers = []
+        parse_workers = []
+        if crawl_details:
+            concurrency = AdaptiveConcurrency(maximum=self.concurrency)
+            detail_stats = {'completed': 0, 'failed': 0, 'retries': 0}
+            detail_workers = [
+                asyncio.create_task(self._detail_worker(concurrency, detail_stats)) for _ in range(self.concurrency)
+            ]
+            parse_workers = [asyncio.create_task(self._parse_worker()) for _ in range(self.parse_workers)]
+
+        try:
+            if crawl_details:
+                for identifier in identifiers:
+                    await self._detail_queue.put(identifier)
+
+            if pages is not None:
+                if known is not None:
+                    await self._crawl_incrementally(list(pages), known, stop_after)
+                else:
+                    await run_work_queue(
+                        pages, self._crawl_list_page, max_concurrency=self.concurrency, bucket=self.bucket,
+                    )
+
+            # Close the stages one after another, each drains its queue before the next one is closed
+            for _ in detail_workers:
+                await self._detail_queue.put(_STOP)
+            await asyncio.gather(*detail_workers)
+            for _ in parse_workers:
+                await self._parse_queue.put(_STOP)
+            await asyncio.gather(*parse_workers)
+        finally:
+            for task in detail_workers + parse_workers:
+                task.cancel()
+            reporter.cancel()
+
+        return self.stats()
+
+    async def _report(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            logging.warning(f'[CrawlPipeline] {self.stats()}')
+
+    async def _crawl_incrementally(self, pages: list, known: KnownSinicaIds, stop_after: int) -> None:
+        """
+        Crawl the pages in order, at most `stop_after` pages at a time, and stop once `stop_after`
+        consecutive pages had no new specimen.
+        """
+        window = max(1, min(self.concurrency, stop_after))
+        quiet_pages = 0
+        for start in range(0, len(pages), window):
+            chunk = pages[start:start + window]
+            await run_work_queue(
+                chunk,
+                lambda page: self._crawl_list_page(page, known),
+                max_concurrency=self.concurrency,
+                bucket=self.bucket,
+            )
+
+            for page in chunk:
+                # A failed page may have new specimens
+                if self._new_counts.get(page, 1) > 0:
+                    quiet_pages = 0
+                else:
+                    quiet_pages += 1
+            if quiet_pages >= stop_after:
+                logging.warning(f'[CrawlPipeline] no new specimens in {quiet_pages} pages, stop at page {chunk[-1]}')
+                return
+
+    async def _crawl_list_page(self, page: int, known: Optional[KnownSinicaIds] = None) -> None:
+        start = time.monotonic()
+        try:
+            if not self.test_mode:
+                specimen_raw_data_list = await fetch_specimen_list_from_sinica(self.session, page, self.archive)
+            else:
+                with open(f'example_page/page-{page}.json') as f:
+                    specimen_raw_data_list = json.load(f)
+
+            if 'list' not in specimen_raw_data_list:
+                # Sinica answers with an error page when it's overloaded, let the scheduler retry later
+                raise ValueError(f'page {page} has no specimen list')
+        except Exception:
+            self.counters['list'].add_error()
+            raise
+        finally:
+            self.counters['list'].observe(time.monotonic() - start)
+
+        specimen_website_ids = [specimen.get('id') for specimen in specimen_raw_data_list['list']]
+        if known is not None:
+            # Incremental mode, drop the known specimens without asking the database
+            specimen_website_ids = known.add_new(specimen_website_ids)
+        self._new_counts[page] = len(specimen_website_ids)
+        self.counters['list'].add_item()
+
+        identifiers = [
+            create_specimen_identifier(specimen_website_id, 'sinica') for specimen_website_id in specimen_website_ids
+        ]
+        await self.writer.add_identifiers(identifiers)
+
+        if self._crawl_details:
+            # Only the new, due or outdated specimens, the crawled and the failed ones are left alone
+            for identifier in await self.frontier.claim_found(identifiers, self._fetched_before):
+                await self._detail_queue.put(identifier)
+
+    async def _detail_worker(self, concurrency: AdaptiveConcurrency, stats: Dict) -> None:
+        while True:
+            identifier = await self._detail_queue.get()
+            if identifier is _STOP:
+                return
+            await call_with_retries(
+                self._fetch_specimen, identifier, self.bucket, concurrency, stats, on_failed=self._fetch_failed,
+            )
+
+    async def _fetch_failed(self, identifier: str, error: Exception) -> None:
+        self.counters['detail'].add_error()
+        await self.frontier.failed(identifier, error)
+
+    async def _fetch_specimen(self, identifier: str) -> None:
+        specimen_sinica_id = identifier.split('-')[-1]
+        validators = self.frontier.validators(identifier)
+
+        start = time.monotonic()
+        try:
+            if not self.test_mode:
+                page = await fetch_specimen_page_from_sinica(
+                    self.session, specimen_sinica_id, self.archive, validators['etag'], validators['last_modified'],
+                )
+            else:
+                with open(f'example_html/{specimen_sinica_id}.html') as f:
+                    page = {'html': f.read(), 'etag': None, 'last_modified': None}
+        finally:
+            self.counters['detail'].observe(time.monotonic() - start)
+        self.counters['detail'].add_item()
+
+        # Skip the parse and the write when the page didn't change since the last fetch
+        if page['html'] is None:
+            self.outcomes['not_modified'] += 1
+            CRAWL_PAGES.inc(outcome='not_modified')
+            await self.frontier.done(identifier, etag=page['etag'], last_modified=page['last_modified'])
+            return
+        page['content_hash'] = hashlib.sha256(page['html'].encode()).hexdigest()
+        if page['content_hash'] == validators['content_hash']:
+            self.outcomes['unchanged'] += 1
+            CRAWL_PAGES.inc(outcome='unchanged')
+            await self.frontier.done(identifier, etag=page['etag'], last_modified=page['last_modified'])
+            return
+
+        await self._parse_queue.put((identifier, page))
+
+    async def _parse_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._parse_queue.get()
+            if item is _STOP:
+                return
+            identifier, page = item
+
+            # Parse in the process pool when there is one, a page takes a few milliseconds to parse in the loop
+            start = time.monotonic()
+            try:
+                if self.parse_pool is not None:
+                    specimen = await loop.run_in_executor(self.parse_pool, parse_specimen, page['html'])
+                else:
+                    specimen = parse_specimen(page['html'])
+            except ParseError as e:
+                logging.warning(f'Failed to parse specimen: {identifier}, error: {e}')
+                # Not worth retrying now, the frontier gives up on it after a few runs
+                self.counters['parse'].add_error()
+                self.outcomes['parse_failed'] += 1
+                CRAWL_PAGES.inc(outcome='parse_failed')
+                await self.frontier.failed(identifier, e)
+                continue
+            finally:
+                self.counters['parse'].observe(time.monotonic() - start)
+            self.counters['parse'].add_item()
+
+            # The writer queue is bounded as well, waiting here holds back the parser
+            await self.writer.upsert(specimen)
+            await self.frontier.done(
+                identifier, etag=page['etag'], last_modified=page['last_modified'], content_hash=page['content_hash'],
+            )
+            self.outcomes['updated'] += 1
+            CRAWL_PAGES.inc(outcome='updated')
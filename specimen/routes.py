@@ -1,53 +1,436 @@
+import logging
+import os
+import shutil
+import tempfile
+from email.utils import formatdate
 from http import HTTPStatus
 import io
-from typing import List, Any
+from typing import List, Any, Literal
 
-from fastapi import APIRouter, BackgroundTasks, Depends, Query, Response
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+from starlette.background import BackgroundTask
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from config import settings
+from db.engine import read_db_session
 from db.main import get_db_async_session
+from specimen.cache import DiskCache, ImageCache, PdfCache, ResponseCache, ThumbnailCache
 from specimen.dal import SpecimenDal
-from specimen.schemas import SpecimenPublic
-from specimen.utils import create_specimen_pdf
+from specimen.export import EXPORT_MEDIA_TYPES, ExportUnavailable, check_export_support, export_filename, \
+    iter_specimen_rows, stream_export
+from specimen.images import IMAGE_MEDIA_TYPES, derivative_key
+from specimen.schemas import SpecimenBatchLookup, SpecimenBatchResult, SpecimenBulkDownload, SpecimenCluster, \
+    SpecimenFacets, SpecimenFilter, SpecimenPublic, SPECIMEN_FIELDS
+from specimen.serializers import dumps
+from specimen.utils import PdfRenderer, RenderQueueFull, create_specimen_pdf, etag_matches, iter_specimen_pdfs, \
+    iter_spooled_file, render_specimens_pdf, specimen_pdf_etag, spool_specimen_images, stream_specimens_zip
 
 specimen_router = APIRouter(prefix='/specimens')
 
+# Serializers of the cached responses, they validate the rows like the response_model of the routes
+_SPECIMEN_ADAPTER = TypeAdapter(SpecimenPublic)
+_BATCH_RESULTS_ADAPTER = TypeAdapter(List[SpecimenBatchResult])
 
-@specimen_router.get('/', status_code=HTTPStatus.OK, response_model=List[SpecimenPublic])
+
+# Coroutines, FastAPI would run plain functions in its thread pool on every request
+async def get_image_cache(request: Request) -> ImageCache:
+    """Dependency to provide the image cache created in the app lifespan"""
+    return request.app.state.image_cache
+
+
+async def get_pdf_cache(request: Request) -> PdfCache:
+    """Dependency to provide the rendered PDF cache created in the app lifespan"""
+    return request.app.state.pdf_cache
+
+
+async def get_pdf_renderer(request: Request) -> PdfRenderer:
+    """Dependency to provide the PDF render pool created in the app lifespan"""
+    return request.app.state.pdf_renderer
+
+
+async def get_thumbnail_cache(request: Request) -> ThumbnailCache:
+    """Dependency to provide the resized image store created in the app lifespan"""
+    return request.app.state.thumbnail_cache
+
+
+async def get_response_cache(request: Request) -> ResponseCache:
+    """Dependency to provide the JSON response cache created in the app lifespan"""
+    return request.app.state.response_cache
+
+
+def render_queue_full() -> HTTPException:
+    """Error of the PDF routes when the render queue is full"""
+    return HTTPException(
+        status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+        detail='Too many PDFs are being rendered, please retry later',
+        headers={'Retry-After': str(settings.pdf_render_retry_after)},
+    )
+
+
+def parse_fields(fields: str | None) -> list[str]:
+    """Parse a comma separated list of specimen fields, all of them when it's missing"""
+    if fields is None:
+        return list(SPECIMEN_FIELDS)
+
+    requested = {field.strip() for field in fields.split(',') if field.strip()}
+    unknown = requested - set(SPECIMEN_FIELDS)
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f'fields must be a comma separated list of {", ".join(SPECIMEN_FIELDS)}',
+        )
+
+    return [field for field in SPECIMEN_FIELDS if field in requested]
+
+
+def cached_json_response(request: Request, cached: tuple[bytes, dict]) -> Response:
+    """Create the response of a cached body, or a 304 when the client already has it"""
+    body, headers = cached
+    headers = headers | {'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return Response(body, headers=headers, media_type='application/json')
+
+
+def parse_bbox(bbox: str) -> tuple[float, float, float, float]:
+    """Parse a `min_longitude,min_latitude,max_longitude,max_latitude` bounding box"""
+    try:
+        min_longitude, min_latitude, max_longitude, max_latitude = (float(value) for value in bbox.split(','))
+    except ValueError:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail='bbox must be min_longitude,min_latitude,max_longitude,max_latitude',
+        )
+
+    if min_longitude > max_longitude or min_latitude > max_latitude:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail='bbox minimums must not exceed maximums')
+
+    return min_longitude, min_latitude, max_longitude, max_latitude
+
+
+# The rows are serialized without the response model, the schema of the page is declared instead
+@specimen_router.get('/', status_code=HTTPStatus.OK, response_class=Response, responses={
+    HTTPStatus.OK.value: {
+        'model': List[SpecimenPublic],
+        'description': 'The specimens of the page, with only the requested `fields`',
+        'headers': {
+            'X-Next-Cursor': {
+                'description': 'The `cursor` of the next page, absent on the last page',
+                'schema': {'type': 'string'},
+            },
+            'ETag': {'description': 'Send it back in `If-None-Match` to get a 304', 'schema': {'type': 'string'}},
+        },
+    },
+    HTTPStatus.NOT_MODIFIED.value: {'description': 'The page did not change since its `ETag`'},
+})
 async def get_specimens(
+    request: Request,
+    session: AsyncSession = Depends(get_db_async_session),
+    response_cache: ResponseCache = Depends(get_response_cache),
+    cursor: str | None = Query(default=None, description='The `X-Next-Cursor` header of the previous page'),
+    sort: Literal['id', 'collection_date', 'species_name'] = 'id',
+    offset: int = Query(default=0, ge=0, description='Deprecated, use cursor instead'),
+    limit: int = Query(default=20, ge=1, le=settings.list_max_limit),
+    fields: str | None = Query(default=None, description='Comma separated fields to return, e.g. `id,species_name`'),
+) -> Response:
+    fields = parse_fields(fields)
+    dal = SpecimenDal(session)
+    key = ('specimens', cursor, sort, offset, limit, tuple(fields))
+    version = await response_cache.version(dal.data_version)
+
+    cached = response_cache.get(key, version)
+    if cached is None:
+        # Only the requested columns are selected, plus the ones of the cursor, which are selected last
+        columns = fields + [field for field in dict.fromkeys(('id', sort)) if field not in fields]
+        try:
+            rows, next_cursor = await dal.page(cursor=cursor, limit=limit, sort=sort, offset=offset, columns=columns)
+        except ValueError as e:
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+
+        # The rows come straight from the typed columns, they're serialized without validating them again
+        body = dumps([dict(zip(fields, row)) for row in rows])
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor is not None else {}
+        cached = response_cache.set(key, version, body, headers)
+
+    return cached_json_response(request, cached)
+
+
+@specimen_router.get('/search/', status_code=HTTPStatus.OK, response_model=List[SpecimenPublic])
+async def search_specimens(
+    q: str = Query(min_length=1, description='Terms matched against 中文種名, 學名, 採集者 and 行政區'),
     session: AsyncSession = Depends(get_db_async_session),
-    offset: int = 0,
-    limit: int = Query(default=20, le=100)
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=20, ge=1, le=100)
 ) -> Any:
-    specimens = await SpecimenDal(session).all(offset=offset, limit=limit)
+    specimens = await SpecimenDal(session).search(q, offset=offset, limit=limit)
 
     return specimens
 
 
+@specimen_router.get('/geo/', status_code=HTTPStatus.OK, response_model=List[SpecimenPublic])
+async def get_specimens_by_location(
+    bbox: str | None = Query(default=None, description='min_longitude,min_latitude,max_longitude,max_latitude'),
+    lat: float | None = Query(default=None, ge=-90, le=90, description='Latitude of the radius center'),
+    lon: float | None = Query(default=None, ge=-180, le=180, description='Longitude of the radius center'),
+    radius_km: float | None = Query(default=None, gt=0, le=1000),
+    session: AsyncSession = Depends(get_db_async_session),
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=20, ge=1, le=100)
+) -> Any:
+    if bbox is not None:
+        specimens = await SpecimenDal(session).within_bbox(parse_bbox(bbox), offset=offset, limit=limit)
+    elif lat is not None and lon is not None and radius_km is not None:
+        specimens = await SpecimenDal(session).within_radius(lat, lon, radius_km, offset=offset, limit=limit)
+    else:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail='Either bbox or lat, lon and radius_km is required')
+
+    return specimens
+
+
+@specimen_router.get('/geo/clusters/', status_code=HTTPStatus.OK, response_model=List[SpecimenCluster])
+async def get_specimen_clusters(
+    bbox: str = Query(description='min_longitude,min_latitude,max_longitude,max_latitude'),
+    zoom: int = Query(ge=0, le=20, description='Map zoom level'),
+    session: AsyncSession = Depends(get_db_async_session),
+) -> Any:
+    clusters = await SpecimenDal(session).clusters(parse_bbox(bbox), zoom)
+
+    return clusters
+
+
+@specimen_router.get('/facets/', status_code=HTTPStatus.OK, response_model=SpecimenFacets)
+async def get_specimen_facets(
+    session: AsyncSession = Depends(get_db_async_session),
+    country: str | None = None,
+    area: str | None = None,
+    collector: str | None = None,
+    year: str | None = Query(default=None, description='Collection year, e.g. `2001`'),
+    altitude_band: str | None = Query(default=None, description='Minimum altitude band, e.g. `500-1000`'),
+    size: int = Query(default=20, ge=1, le=1000, description='Maximum number of values per facet'),
+) -> Any:
+    filters = {
+        'country': country, 'area': area, 'collector': collector, 'year': year, 'altitude_band': altitude_band,
+    }
+    facets = await SpecimenDal(session).facets(
+        filters={field: value for field, value in filters.items() if value is not None}, size=size,
+    )
+
+    return facets
+
+
+@specimen_router.get('/export/', status_code=HTTPStatus.OK)
+async def export_specimens(
+    format: Literal['ndjson', 'csv', 'parquet'] = 'ndjson',
+    compression: Literal['gzip', 'zstd'] | None = None,
+    specimen_filter: SpecimenFilter = Depends(),
+) -> StreamingResponse:
+    try:
+        check_export_support(format, compression)
+    except ExportUnavailable as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+
+    filters = specimen_filter.model_dump(exclude_none=True)
+
+    # The request session is closed before the response is streamed, so the stream has its own session
+    async def row_batches():
+        async with read_db_session() as stream_session:
+            async for rows in iter_specimen_rows(stream_session, filters, batch_size=settings.export_batch_size):
+                yield rows
+
+    headers = {'Content-Disposition': f'attachment; filename="{export_filename(format, compression)}"'}
+    return StreamingResponse(
+        stream_export(row_batches(), format, compression), headers=headers, media_type=EXPORT_MEDIA_TYPES[format],
+    )
+
+
+@specimen_router.post('/batch/', status_code=HTTPStatus.OK, response_model=List[SpecimenBatchResult])
+async def get_specimens_batch(
+    lookup: SpecimenBatchLookup,
+    session: AsyncSession = Depends(get_db_async_session),
+) -> Response:
+    specimens = await SpecimenDal(session).get_many(lookup.ids, chunk_size=settings.batch_lookup_chunk_size)
+
+    results = _BATCH_RESULTS_ADAPTER.validate_python([
+        {'key': key, 'found': specimen is not None, 'specimen': specimen}
+        for key, specimen in zip(lookup.ids, specimens)
+    ], from_attributes=True)
+    return Response(_BATCH_RESULTS_ADAPTER.dump_json(results), media_type='application/json')
+
+
+@specimen_router.post('/download/', status_code=HTTPStatus.OK)
+async def download_specimens(
+    download: SpecimenBulkDownload,
+    image_cache: ImageCache = Depends(get_image_cache),
+    renderer: PdfRenderer = Depends(get_pdf_renderer),
+) -> StreamingResponse:
+    filters = download.filter.model_dump(exclude_none=True) if download.filter is not None else None
+
+    # Checked before anything is fetched, the renders of a started ZIP stream wait for their turn instead
+    try:
+        renderer.admit()
+    except RenderQueueFull:
+        raise render_queue_full()
+
+    if download.format == 'pdf':
+        # The specimens are loaded first, the reader connection is released before the images are fetched
+        specimens = []
+        async with read_db_session() as session:
+            async for batch in SpecimenDal(session).iter_batches(ids=download.ids, filters=filters):
+                specimens.extend(batch)
+                if len(specimens) > settings.bulk_pdf_max_specimens:
+                    raise HTTPException(
+                        status_code=HTTPStatus.BAD_REQUEST,
+                        detail=f'A PDF contains at most {settings.bulk_pdf_max_specimens} specimens, '
+                               f'use zip format instead',
+                    )
+
+        # The images and the document are spooled to files, the document is streamed from its file
+        spool = tempfile.mkdtemp(prefix='specimens-pdf-')
+        try:
+            image_paths = await spool_specimen_images(
+                [specimen.image_url for specimen in specimens], image_cache, spool,
+                prefetch=settings.bulk_download_prefetch,
+            )
+            pages = [
+                (specimen.model_dump(exclude={'id', 'identifier', 'image_url'}), image_path)
+                for specimen, image_path in zip(specimens, image_paths)
+            ]
+            path = os.path.join(spool, 'specimens.pdf')
+            await renderer.render(render_specimens_pdf, pages, path)
+        except RenderQueueFull:
+            shutil.rmtree(spool, ignore_errors=True)
+            raise render_queue_full()
+        except BaseException:
+            shutil.rmtree(spool, ignore_errors=True)
+            raise
+
+        headers = {'Content-Disposition': 'attachment; filename="specimens.pdf"'}
+        return StreamingResponse(
+            iter_spooled_file(path, spool),
+            headers=headers,
+            media_type='application/pdf',
+            # The stream removes the spool once read, this is for the clients which disconnect before
+            background=BackgroundTask(shutil.rmtree, spool, ignore_errors=True),
+        )
+
+    # The request session is closed before the response is streamed, so the stream has its own session
+    async def specimen_batches():
+        async with read_db_session() as stream_session:
+            async for batch in SpecimenDal(stream_session).iter_batches(ids=download.ids, filters=filters):
+                yield [specimen.model_dump(exclude={'id'}) for specimen in batch]
+
+    specimen_pdfs = iter_specimen_pdfs(
+        specimen_batches(), image_cache, renderer, prefetch=settings.bulk_download_prefetch,
+    )
+    headers = {'Content-Disposition': 'attachment; filename="specimens.zip"'}
+    return StreamingResponse(stream_specimens_zip(specimen_pdfs), headers=headers, media_type='application/zip')
+
+
 @specimen_router.get(r'/{specimen_id}/download/', status_code=HTTPStatus.OK)
 async def get_specimen_pdf(
     specimen_id: int | str,
+    request: Request,
     background_tasks: BackgroundTasks,
-    session: AsyncSession = Depends(get_db_async_session),
+    image_cache: ImageCache = Depends(get_image_cache),
+    pdf_cache: PdfCache = Depends(get_pdf_cache),
+    renderer: PdfRenderer = Depends(get_pdf_renderer),
 ) -> Response:
+    # The reader connection goes back to the pool before the image fetch and the render, which can take seconds
+    async with read_db_session() as session:
+        specimen = await SpecimenDal(session).get(int(specimen_id))
+    if specimen is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='Specimen not found')
+
+    etag = specimen_pdf_etag(specimen.model_dump())
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers={'ETag': etag})
+
+    cached = pdf_cache.get_pdf(specimen.identifier, etag)
+    if cached is not None:
+        pdf, rendered_at = cached
+    else:
+        buffer = io.BytesIO()
+        specimen_data = specimen.model_dump(exclude={'id', 'identifier'})
 
-    buffer = io.BytesIO()
+        try:
+            await create_specimen_pdf(specimen_data, buffer, image_cache=image_cache, renderer=renderer)
+        except RenderQueueFull:
+            buffer.close()
+            raise render_queue_full()
 
-    specimen = await SpecimenDal(session).get(int(specimen_id))
-    specimen_data = specimen.model_dump(exclude={'id', 'identifier'})
+        background_tasks.add_task(buffer.close)
+        pdf = buffer.getvalue()
 
-    await create_specimen_pdf(specimen_data, buffer)
+        # Don't keep a PDF rendered without its image, e.g. when sinica is unavailable
+        if specimen.image_url and specimen.image_url not in image_cache:
+            # Nor let the client keep it, its ETag would match the complete PDF once the image is available
+            headers = {'Content-Disposition': 'inline; filename="out.pdf"', 'Cache-Control': 'no-store'}
+            return Response(pdf, headers=headers, media_type='application/pdf')
+        rendered_at = await pdf_cache.set_pdf(specimen.identifier, etag, pdf)
 
-    background_tasks.add_task(buffer.close)
-    headers = {'Content-Disposition': 'inline; filename="out.pdf"'}
-    return Response(buffer.getvalue(), headers=headers, media_type='application/pdf')
+    headers = {
+        'Content-Disposition': 'inline; filename="out.pdf"',
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+        'Last-Modified': formatdate(rendered_at, usegmt=True),
+    }
+    return Response(pdf, headers=headers, media_type='application/pdf')
+
+
+@specimen_router.get(r'/{specimen_id}/image/', status_code=HTTPStatus.OK)
+async def get_specimen_image(
+    specimen_id: int,
+    request: Request,
+    size: str = Query(default='medium', description=f'One of {", ".join(settings.thumbnail_sizes)}'),
+    format: Literal['jpeg', 'webp'] = 'jpeg',
+    thumbnail_cache: ThumbnailCache = Depends(get_thumbnail_cache),
+) -> Response:
+    if size not in settings.thumbnail_sizes:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=f'size must be one of {", ".join(settings.thumbnail_sizes)}',
+        )
+
+    # Released before the thumbnail is created from an image which may have to be downloaded
+    async with read_db_session() as session:
+        specimen = await SpecimenDal(session).get(specimen_id)
+    if specimen is None or not specimen.image_url:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='Specimen image not found')
+
+    # A thumbnail only changes with the image url, so its ETag is known before it's read
+    etag = f'"{DiskCache.digest(derivative_key(specimen.image_url, size, format))[:32]}"'
+    headers = {'ETag': etag, 'Cache-Control': f'public, max-age={settings.thumbnail_max_age}'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    try:
+        thumbnail = await thumbnail_cache.fetch(specimen.image_url, size, format)
+    except Exception as e:
+        logging.warning(f'[get_specimen_image] creating thumbnail of specimen {specimen_id} occurs error: {e}')
+        raise HTTPException(status_code=HTTPStatus.BAD_GATEWAY, detail='The specimen image is unavailable')
+
+    return Response(thumbnail, headers=headers, media_type=IMAGE_MEDIA_TYPES[format])
 
 
 @specimen_router.get('/{specimen_id}/', status_code=HTTPStatus.OK, response_model=SpecimenPublic)
 async def get_specimen(
     specimen_id: str | int,
+    request: Request,
     session: AsyncSession = Depends(get_db_async_session),
-) -> Any:
-    specimen = await SpecimenDal(session).get(int(specimen_id))
+    response_cache: ResponseCache = Depends(get_response_cache),
+) -> Response:
+    dal = SpecimenDal(session)
+    key = ('specimen', int(specimen_id))
+    version = await response_cache.version(dal.data_version)
+
+    cached = response_cache.get(key, version)
+    if cached is None:
+        specimen = await dal.get(int(specimen_id))
+        if specimen is None:
+            raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail='Specimen not found')
+
+        body = _SPECIMEN_ADAPTER.dump_json(_SPECIMEN_ADAPTER.validate_python(specimen, from_attributes=True))
+        cached = response_cache.set(key, version, body)
 
-    return specimen
+    return cached_json_response(request, cached)
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+
+class TokenBucket:
+    """
+    Global rate limiter shared by all the workers.
+
+    Tokens are refilled at `rate` per second up to `burst`, each request takes one token. A rate of 0 disables
+    the limit, e.g. in test mode.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit adapted by AIMD (additive increase, multiplicative decrease).
+
+    The limit grows by one per window of successful requests while the latency stays under `latency_tolerance`
+    times the fastest latency seen, it shrinks by 10% when the latency goes over, and it's halved on errors.
+    """
+
+    def __init__(self, initial: int = 1, minimum: int = 1, maximum: int = 8, latency_tolerance: float = 2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.limit = float(min(max(initial, minimum), maximum))
+
+        self._in_flight = 0
+        self._base_latency = None
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+
+    async def release(self) -> None:
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        if self._base_latency is None or latency < self._base_latency:
+            self._base_latency = latency
+
+        if latency > self._base_latency * self.latency_tolerance:
+            self.limit = max(self.minimum, self.limit * 0.9)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_error(self) -> None:
+        self.limit = max(self.minimum, self.limit / 2)
+
+
+def backoff_delay(attempt: int, base_delay: float = 1.0, max_delay: float = 60.0) -> float:
+    """Exponential backoff with full jitter of the given attempt, starting from 1"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+async def call_with_retries(
+    worker: Callable[..., Awaitable],
+    item: Any,
+    bucket: TokenBucket,
+    concurrency: AdaptiveConcurrency,
+    stats: Dict,
+    attempts: int = 3,
+    base_delay: float = 1.0,
+    on_failed: Optional[Callable[[Any, Exception], Awaitable]] = None,
+) -> None:
+    """
+    Call the worker with the item within the rate limit and the concurrency limit, retrying with jittered
+    exponential backoff up to `attempts` times. The `completed`, `failed` and `retries` counts of `stats` are updated.
+    """
+    for attempt in range(1, attempts + 1):
+        await concurrency.acquire()
+        try:
+            await bucket.acquire()
+            start = time.monotonic()
+            await worker(item)
+        except Exception as e:
+            concurrency.on_error()
+            if attempt == attempts:
+                stats['failed'] += 1
+                logging.warning(f'[run_work_queue] {item} failed after {attempts} attempts: {e}')
+                if on_failed is not None:
+                    await on_failed(item, e)
+                return
+            stats['retries'] += 1
+        else:
+            concurrency.on_success(time.monotonic() - start)
+            stats['completed'] += 1
+            return
+        finally:
+            await concurrency.release()
+
+        # Wait outside of the concurrency slot, so other items can go on meanwhile
+        await asyncio.sleep(backoff_delay(attempt, base_delay))
+
+
+async def run_work_queue(
+    items: Iterable,
+    worker: Callable[..., Awaitable],
+    rate: float = 1.0,
+    max_concurrency: int = 8,
+    attempts: int = 3,
+    base_delay: float = 1.0,
+    on_failed: Optional[Callable[[Any, Exception], Awaitable]] = None,
+    bucket: Optional[TokenBucket] = None,
+) -> Dict:
+    """
+    Run the worker on every item from a shared queue, at most `rate` calls per second.
+
+    The number of concurrent calls adapts to the observed latency and errors, up to `max_concurrency`. A call which
+    raises is retried with jittered exponential backoff, up to `attempts` times.
+
+    Params:
+        items (Iterable): the work items.
+        worker (Callable): the coroutine function called with each item.
+        rate (float): the maximum calls per second, 0 for no limit.
+        max_concurrency (int): the maximum concurrent calls.
+        attempts (int): the maximum calls per item.
+        base_delay (float): the backoff delay of the first retry in seconds.
+        on_failed (Callable): the coroutine function called with the item and the last error when all attempts failed.
+        bucket (TokenBucket): a rate limiter shared with other queues, instead of one of `rate`.
+
+    Returns:
+        Dict: the numbers of completed and failed items, of retries and the elapsed time.
+    """
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    bucket = bucket or TokenBucket(rate)
+    concurrency = AdaptiveConcurrency(maximum=max_concurrency)
+    stats = {'completed': 0, 'failed': 0, 'retries': 0}
+    started_at = time.monotonic()
+
+    async def consume():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await call_with_retries(worker, item, bucket, concurrency, stats, attempts, base_delay, on_failed)
+
+    await asyncio.gather(*(consume() for _ in range(max_concurrency)))
+
+    stats['elapsed'] = time.monotonic() - started_at
+    return stats
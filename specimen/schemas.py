@@ -1,3 +1,9 @@
+from typing import List, Literal
+
+from pydantic import model_validator
+from sqlmodel import SQLModel, Field
+
+from config import settings
 from db.models import SpecimenBase
 
 
@@ -7,3 +13,71 @@ class SpecimenCreate(SpecimenBase):
 
 class SpecimenPublic(SpecimenBase):
     id: int
+
+
+# Fields of the specimens in the API responses, in the order they're serialized
+SPECIMEN_FIELDS = tuple(SpecimenPublic.model_fields)
+
+
+class SpecimenFilter(SQLModel):
+    species_name: str | None = Field(default=None, description='中文種名')
+    scientific_name: str | None = Field(default=None, description='學名')
+    collector: str | None = Field(default=None, description='採集者')
+    country: str | None = Field(default=None, description='國家')
+    area: str | None = Field(default=None, description='行政區')
+
+
+class SpecimenCluster(SQLModel):
+    count: int = Field(description='Number of specimens in the cell')
+    latitude: float = Field(description='Average latitude of the specimens in the cell')
+    longitude: float = Field(description='Average longitude of the specimens in the cell')
+    min_latitude: float
+    min_longitude: float
+    max_latitude: float
+    max_longitude: float
+
+
+class SpecimenFacetValue(SQLModel):
+    value: str
+    count: int
+
+
+class SpecimenFacets(SQLModel):
+    country: List[SpecimenFacetValue] = Field(description='國家')
+    area: List[SpecimenFacetValue] = Field(description='行政區')
+    collector: List[SpecimenFacetValue] = Field(description='採集者')
+    year: List[SpecimenFacetValue] = Field(description='採集年份')
+    altitude_band: List[SpecimenFacetValue] = Field(description='最低海拔區間')
+
+
+class SpecimenBulkDownload(SQLModel):
+    ids: List[int] | None = Field(
+        default=None,
+        max_length=settings.bulk_download_max_ids,
+        description='Specimen ids, the documents keep the same order',
+    )
+    filter: SpecimenFilter | None = Field(default=None, description='Download all specimens matching the filter')
+    format: Literal['zip', 'pdf'] = Field(
+        default='zip',
+        description='`zip` of one PDF per specimen, or a single multi-page `pdf`',
+    )
+
+    @model_validator(mode='after')
+    def check_ids_or_filter(self) -> 'SpecimenBulkDownload':
+        if self.ids is None and self.filter is None:
+            raise ValueError('either ids or filter must be provided')
+        return self
+
+
+class SpecimenBatchLookup(SQLModel):
+    ids: List[int | str] = Field(
+        min_length=1,
+        max_length=settings.batch_lookup_max_ids,
+        description='Specimen ids or identifiers such as `sinica-123`, the results keep the same order',
+    )
+
+
+class SpecimenBatchResult(SQLModel):
+    key: int | str = Field(description='The requested id or identifier')
+    found: bool
+    specimen: SpecimenPublic | None = None
@@ -0,0 +1,29 @@
+import datetime
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Serialize plain data to compact UTF-8 JSON, dates included, with orjson when it's installed.
+
+    Params:
+        value (Any): dicts, lists, strings, numbers, None and dates.
+
+    Returns:
+        bytes: the JSON document.
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=_default).encode('utf-8')
@@ -1,11 +1,23 @@
+import asyncio
+import collections
+import hashlib
 import io
+import json
 import logging
-from typing import Dict
+import multiprocessing
+import os
+import shutil
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Callable, Dict, Iterator, List, TypeVar
 
 from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics, ttfonts
 from reportlab.pdfgen import canvas
 
 from db.models import FIELD_DESCRIPTION_MAPPING
+from metrics import PDF_RENDER_QUEUE_SECONDS, PDF_RENDER_REJECTED, PDF_RENDER_SECONDS
+from specimen.cache import ImageCache
 from specimen.crawl_utils import fetch_image_from_sinica
 
 
@@ -14,39 +26,83 @@ PDF_FIELD_SEQUENCE = [
     'latitude', 'longitude', 'country', 'area', 'minimum_altitude', 'reference',
 ]
 
+PDF_FONT_NAME = 'openhuninn'
+PDF_FONT_FILE = 'jf-openhuninn-1.1.ttf'
 
-async def create_specimen_pdf(specimen_data: Dict, buffer: io.BytesIO | None = None) -> io.BytesIO:
+# Bump it whenever the PDF layout changes, so the cached PDFs are re-rendered
+PDF_LAYOUT_VERSION = 1
+
+T = TypeVar('T')
+
+
+def specimen_pdf_etag(specimen_data: Dict) -> str:
     """
-    Create a PDF document for specimen data.
+    Create the ETag of a specimen PDF from the content of the specimen row.
 
     Params:
-        specimen_data (Dict): Dictionary containing specimen data, where keys are field names and values are field values.
-
-        buffer: BytesIO object to store the PDF data. If not provided, a new BytesIO object will be created.
+        specimen_data (Dict): Dictionary containing all the fields of the specimen row.
 
     Returns:
-        Buffer: BytesIO object containing the PDF data.
+        str: the quoted ETag.
     """
-    if buffer is None:
-        buffer = io.BytesIO()
+    content = json.dumps(specimen_data, sort_keys=True, default=str)
+    digest = hashlib.sha256(f'{PDF_LAYOUT_VERSION}:{content}'.encode('utf-8')).hexdigest()
+    return f'"{digest[:32]}"'
 
-    page = canvas.Canvas(buffer)
-    page.setFont(psfontname='openhuninn', size=12)
 
-    image_url = specimen_data.pop('image_url', '')
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Check whether an If-None-Match header matches the ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = {candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')}
+    return etag in candidates
+
+
+def register_pdf_font() -> None:
+    """Register the CJK font used by the PDF documents"""
+    pdfmetrics.registerFont(ttfonts.TTFont(PDF_FONT_NAME, PDF_FONT_FILE))
+
+
+def init_render_worker(idle_priority: bool = False) -> None:
+    """
+    Initializer of the render workers.
+
+    Params:
+        idle_priority (bool): run the worker by the idle scheduling policy of Linux, at niceness 19 elsewhere.
+            A niced worker still keeps the CPU until its time slice ends when an API thread wakes up, an idle one
+            is preempted at once.
+    """
+    if idle_priority:
+        if hasattr(os, 'SCHED_IDLE'):
+            os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+        else:
+            os.nice(19)
+    register_pdf_font()
+
+
+def draw_specimen_page(page: canvas.Canvas, specimen_data: Dict, image_bytes: bytes | None = None) -> None:
+    """
+    Draw the page of a specimen on a canvas.
+
+    Params:
+        page (Canvas): the canvas to draw on.
+
+        specimen_data (Dict): Dictionary containing specimen data, where keys are field names and values are field values.
+
+        image_bytes (bytes): the specimen image. The page is drawn without image if not provided.
+    """
+    page.setFont(psfontname=PDF_FONT_NAME, size=12)
 
     y = 700
-    image_buffer = io.BytesIO()
-    if image_url:
+    if image_bytes:
         try:
-            image_bytes = await fetch_image_from_sinica(image_url)
-            image_buffer.write(image_bytes)
-            image_buffer.seek(0)
-            image = ImageReader(image_buffer)
+            image = ImageReader(io.BytesIO(image_bytes))
+            page.drawImage(image, (page._pagesize[0] - 200) / 2, y - 150, width=200, height=200)
         except Exception as e:
             logging.warning(f'[get_specimen_pdf] handling image occurs error: {e}')
         else:
-            page.drawImage(image, (page._pagesize[0] - 200) / 2, y - 150, width=200, height=200)
             y -= 200
 
     for field in PDF_FIELD_SEQUENCE:
@@ -57,9 +113,299 @@ async def create_specimen_pdf(specimen_data: Dict, buffer: io.BytesIO | None = N
             y -= 20
 
     page.showPage()
+
+
+def render_specimen_pdf(specimen_data: Dict, image_bytes: bytes | None = None) -> bytes:
+    """
+    Render the PDF document of a specimen synchronously.
+
+    Returns:
+        bytes: the PDF data.
+    """
+    buffer = io.BytesIO()
+    page = canvas.Canvas(buffer)
+    draw_specimen_page(page, specimen_data, image_bytes)
     page.save()
+    return buffer.getvalue()
+
+
+def render_specimens_pdf(specimens: List[tuple[Dict, str | None]], path: str) -> None:
+    """
+    Render a multi-page PDF document with one page per specimen synchronously, into a file.
+
+    Params:
+        specimens (List): pairs of specimen data and the path of the specimen image file, None without image. The
+            images are read one page at a time.
+        path (str): the PDF file to write.
+    """
+    page = canvas.Canvas(path)
+    for specimen_data, image_path in specimens:
+        image_bytes = None
+        if image_path is not None:
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+        draw_specimen_page(page, specimen_data, image_bytes)
+    page.save()
+
+
+class RenderQueueFull(Exception):
+    """Raised when too many PDFs are waiting to be rendered"""
+
+
+class PdfRenderer:
+    """
+    Render PDF documents in a process pool, so that reportlab never blocks the event loop.
+
+    At most `max_concurrency` documents are rendered at the same time and at most `max_queue` wait for their turn,
+    further renders are rejected with RenderQueueFull. The streams rendering many documents are admitted once with
+    `admit` before they start, their renders then wait for one of `max_queue` stream slots instead of being
+    rejected.
+    """
+
+    def __init__(self, max_workers: int, max_concurrency: int, max_queue: int, idle_priority: bool = False):
+        self.max_queue = max_queue
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_render_worker,
+            initargs=(idle_priority,),
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._stream_slots = asyncio.Semaphore(max_queue)
+        self._waiting = 0
+
+    def admit(self) -> None:
+        """
+        Check that the queue is not full, e.g. before a stream is started, since a started stream can't be answered 503.
+
+        Raises:
+            RenderQueueFull: when `max_queue` renders are already waiting.
+        """
+        if self._semaphore.locked() and self._waiting >= self.max_queue:
+            PDF_RENDER_REJECTED.inc()
+            raise RenderQueueFull()
+
+    async def render(self, render_function: Callable[..., T], *args, stream: bool = False) -> T:
+        """
+        Run a render function in the process pool.
+
+        Params:
+            render_function (Callable): a picklable function, returning the PDF data or writing it into a file.
+
+            args: the arguments of the render function.
+
+            stream (bool): the render of a stream admitted with `admit`, it waits for a stream slot instead of being
+                rejected when the queue is full.
+
+        Returns:
+            T: the result of the render function.
+        """
+        if not stream:
+            self.admit()
+
+        # The stream renders waiting for a slot are counted too, so a backlog of streams rejects the new ones
+        self._waiting += 1
+        try:
+            with PDF_RENDER_QUEUE_SECONDS.time():
+                if stream:
+                    await self._stream_slots.acquire()
+                try:
+                    await self._semaphore.acquire()
+                except BaseException:
+                    if stream:
+                        self._stream_slots.release()
+                    raise
+        finally:
+            self._waiting -= 1
+
+        try:
+            loop = asyncio.get_running_loop()
+            with PDF_RENDER_SECONDS.time():
+                return await loop.run_in_executor(self._executor, render_function, *args)
+        finally:
+            self._semaphore.release()
+            if stream:
+                self._stream_slots.release()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(cancel_futures=True)
 
-    image_buffer.close()
+
+async def fetch_specimen_image(image_url: str, image_cache: ImageCache | None = None) -> bytes | None:
+    """
+    Get the specimen image from the image cache or from sinica.
+
+    Returns:
+        bytes: the image data, or None if it's unavailable.
+    """
+    if not image_url:
+        return None
+
+    try:
+        if image_cache is not None:
+            return await image_cache.fetch(image_url)
+        return await fetch_image_from_sinica(image_url)
+    except Exception as e:
+        logging.warning(f'[get_specimen_pdf] fetching image occurs error: {e}')
+        return None
+
+
+def write_spool_file(path: str, data: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+async def spool_specimen_images(
+    image_urls: List[str],
+    image_cache: ImageCache | None,
+    directory: str,
+    prefetch: int = 8,
+) -> List[str | None]:
+    """
+    Fetch the specimen images, at most `prefetch` at a time, and write them into files of a spool directory, so
+    they are not all kept in memory until the document is rendered.
+
+    Returns:
+        List: the path of every image file in the same order, None for the unavailable images.
+    """
+    semaphore = asyncio.Semaphore(prefetch)
+
+    async def spool(index: int, image_url: str) -> str | None:
+        async with semaphore:
+            image_bytes = await fetch_specimen_image(image_url, image_cache)
+        if image_bytes is None:
+            return None
+        path = os.path.join(directory, f'{index}.image')
+        await asyncio.get_running_loop().run_in_executor(None, write_spool_file, path, image_bytes)
+        return path
+
+    return await asyncio.gather(*(spool(index, image_url) for index, image_url in enumerate(image_urls)))
+
+
+def iter_spooled_file(path: str, directory: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Read a spooled file chunk by chunk, then remove its spool directory"""
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+async def create_specimen_pdf(
+    specimen_data: Dict,
+    buffer: io.BytesIO | None = None,
+    image_cache: ImageCache | None = None,
+    renderer: PdfRenderer | None = None,
+) -> io.BytesIO:
+    """
+    Create a PDF document for specimen data.
+
+    Params:
+        specimen_data (Dict): Dictionary containing specimen data, where keys are field names and values are field values.
+
+        buffer: BytesIO object to store the PDF data. If not provided, a new BytesIO object will be created.
+
+        image_cache (ImageCache): cache used to get the specimen image. If not provided, the image is downloaded
+            from sinica directly.
+
+        renderer (PdfRenderer): process pool to render the document. If not provided, the document is rendered in
+            the current process.
+
+    Returns:
+        Buffer: BytesIO object containing the PDF data.
+    """
+    if buffer is None:
+        buffer = io.BytesIO()
+
+    image_url = specimen_data.pop('image_url', '')
+    image_bytes = await fetch_specimen_image(image_url, image_cache)
+
+    if renderer is not None:
+        pdf = await renderer.render(render_specimen_pdf, specimen_data, image_bytes)
+    else:
+        pdf = render_specimen_pdf(specimen_data, image_bytes)
+
+    buffer.write(pdf)
     buffer.seek(0)
 
     return buffer
+
+
+class StreamSink(io.RawIOBase):
+    """Write-only file object collecting the written data until it's drained, used to stream generated files"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def iter_specimen_pdfs(
+    specimen_batches: AsyncIterator[List[Dict]],
+    image_cache: ImageCache | None,
+    renderer: PdfRenderer,
+    prefetch: int = 8,
+) -> AsyncIterator[tuple[Dict, bytes]]:
+    """
+    Render the PDF document of every specimen, keeping the order of the specimens.
+
+    Up to `prefetch` specimens have their image fetched and their document rendered ahead of the consumer, so the
+    memory stays bounded whatever the number of specimens.
+
+    Params:
+        specimen_batches (AsyncIterator): batches of specimen data, each one must contain `image_url`.
+
+    Returns:
+        AsyncIterator: pairs of specimen data (without `image_url`) and PDF data.
+    """
+    async def create_pdf(specimen_data: Dict) -> bytes:
+        image_bytes = await fetch_specimen_image(specimen_data.pop('image_url', ''), image_cache)
+        return await renderer.render(render_specimen_pdf, specimen_data, image_bytes, stream=True)
+
+    pending = collections.deque()
+    try:
+        async for batch in specimen_batches:
+            for specimen_data in batch:
+                pending.append((specimen_data, asyncio.ensure_future(create_pdf(specimen_data))))
+                if len(pending) >= prefetch:
+                    specimen_data, task = pending.popleft()
+                    yield specimen_data, await task
+
+        while pending:
+            specimen_data, task = pending.popleft()
+            yield specimen_data, await task
+    finally:
+        # The consumer may stop early, e.g. when the client disconnects
+        for _, task in pending:
+            task.cancel()
+
+
+async def stream_specimens_zip(specimen_pdfs: AsyncIterator[tuple[Dict, bytes]]) -> AsyncIterator[bytes]:
+    """
+    Stream a ZIP archive with one PDF document per specimen, named after the specimen identifier.
+
+    Params:
+        specimen_pdfs (AsyncIterator): pairs of specimen data and PDF data.
+
+    Returns:
+        AsyncIterator: chunks of the ZIP archive.
+    """
+    sink = StreamSink()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        async for specimen_data, pdf in specimen_pdfs:
+            archive.writestr(f'{specimen_data["identifier"]}.pdf', pdf)
+            yield sink.drain()
+
+    yield sink.drain()
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, List
+
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from db.models import CrawlState, Specimen, create_crawl_state_table
+from metrics import CRAWL_STAGE_ERRORS, CRAWL_STAGE_ITEMS, CRAWL_STAGE_SECONDS
+from specimen.cache import invalidate_specimen_pdf
+
+_INSERT = 'insert'
+_UPSERT = 'upsert'
+_STATE = 'state'
+
+# Sentinel asking the writer task to stop
+_STOP = object()
+
+
+class SpecimenWriter:
+    """
+    Single writer task which the crawlers feed through a queue.
+
+    Rows are written in batches of `batch_size`, or whatever arrived within `flush_interval` seconds, with one
+    `INSERT ... ON CONFLICT(identifier)` executemany per batch, so that a transaction and a fsync are shared by many
+    specimens instead of paid by each one.
+
+    Usage:
+        async with SpecimenWriter(async_db_session) as writer:
+            await writer.add_identifiers(['sinica-1'])
+            await writer.upsert(specimen_data)
+    """
+
+    def __init__(
+        self,
+        async_db_session: async_sessionmaker[AsyncSession],
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        queue_size: int = 10000,
+    ):
+        self.async_db_session = async_db_session
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+        self.write_time = 0.0
+
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._task = None
+
+    async def __aenter__(self) -> 'SpecimenWriter':
+        async with self.async_db_session() as session:
+            async with session.begin():
+                await session.run_sync(lambda sync_session: create_crawl_state_table(sync_session.connection()))
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def add_identifiers(self, identifiers: Iterable[str]) -> None:
+        """
+        Queue new specimens found in the list pages, identifiers which already exist are left untouched.
+        The new specimens are added to the crawl frontier as pending.
+        """
+        for identifier in identifiers:
+            await self._queue.put((_INSERT, {'identifier': identifier}))
+
+    async def upsert(self, specimen_data: Dict) -> None:
+        """Queue the crawled data of a specimen, which updates the specimen of the same identifier"""
+        await self._queue.put((_UPSERT, specimen_data))
+
+    async def update_crawl_state(self, state: Dict) -> None:
+        """Queue the crawl state of a specimen, written in the same transaction as the specimens of the batch"""
+        await self._queue.put((_STATE, state))
+
+    async def close(self) -> None:
+        """Write the queued rows and stop the writer task"""
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            'rows': self.rows,
+            'batches': self.batches,
+            'errors': self.errors,
+            'rows_per_second': self.rows / self.write_time if self.write_time else 0.0,
+        }
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stop = False
+
+        while not stop:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[tuple[str, Dict]]) -> None:
+        inserts = [row for kind, row in batch if kind == _INSERT]
+        upserts = [row for kind, row in batch if kind == _UPSERT]
+        states = [row for kind, row in batch if kind == _STATE]
+
+        start = time.monotonic()
+        try:
+            await self._write(inserts, upserts, states)
+        except Exception as e:
+            logging.warning(f'[SpecimenWriter] writing batch of {len(batch)} rows occurs error: {e}, retry row by row')
+            for kind, row in batch:
+                try:
+                    await self._write(*([row] if kind == other else [] for other in (_INSERT, _UPSERT, _STATE)))
+                except Exception as e:
+                    self.errors += 1
+                    CRAWL_STAGE_ERRORS.inc(stage='write')
+                    logging.warning(f'[SpecimenWriter] writing {row.get("identifier")} occurs error: {e}')
+        elapsed = time.monotonic() - start
+        self.write_time += elapsed
+        self.batches += 1
+        CRAWL_STAGE_SECONDS.observe(elapsed, stage='write')
+
+        # The rendered PDFs of the updated rows are outdated now
+        for row in upserts:
+            invalidate_specimen_pdf(row['identifier'])
+
+    async def _write(self, inserts: List[Dict], upserts: List[Dict], states: List[Dict]) -> None:
+        async with self.async_db_session() as session:
+            async with session.begin():
+                if inserts:
+                    statement = insert(Specimen).on_conflict_do_nothing(index_elements=['identifier'])
+                    await session.execute(statement, inserts)
+                    statement = insert(CrawlState).on_conflict_do_nothing(index_elements=['identifier'])
+                    await session.execute(statement, [{'identifier': row['identifier']} for row in inserts])
+
+                if upserts:
+                    statement = insert(Specimen)
+                    fields = [field for field in upserts[0] if field not in ('id', 'identifier')]
+                    statement = statement.on_conflict_do_update(
+                        index_elements=['identifier'],
+                        set_={field: statement.excluded[field] for field in fields},
+                    )
+                    await session.execute(statement, upserts)
+
+                # Rows of one executemany must have the same fields, the groups keep the order of their first row
+                groups = {}
+                for row in states:
+                    groups.setdefault(tuple(row), []).append(row)
+                for fields, rows in groups.items():
+                    statement = insert(CrawlState)
+                    statement = statement.on_conflict_do_update(
+                        index_elements=['identifier'],
+                        set_={field: statement.excluded[field] for field in fields if field != 'identifier'},
+                    )
+                    await session.execute(statement, rows)
+
+        self.rows += len(inserts) + len(upserts)
+        CRAWL_STAGE_ITEMS.inc(len(inserts) + len(upserts), stage='write')